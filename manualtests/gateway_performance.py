@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the pixel decoding of the Blitz gateway.
+
+Feeds canned big-endian buffers from a stub RawPixelsStore to a
+PixelsWrapper and times the current numpy decoding of getPlane() and
+getTiles() against the previous struct.unpack decoding. Run with
+"python gateway_performance.py [SIZE]".
+"""
+
+#
+#  Copyright (C) 2026 University of Dundee & Open Microscopy Environment.
+#  All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+import sys
+import time
+import numpy
+
+from struct import unpack
+
+from omero.gateway import PixelsWrapper
+from omero.model import EventI, PixelsI, PixelsTypeI
+from omero.rtypes import rint, rstring
+
+
+SIZE = 2048
+
+TILE = 256
+
+
+class StubConnection(object):
+
+    SERVICE_OPTS = dict()
+
+    def getPixelsCache(self):
+        return None
+
+    def getMaxPlaneSize(self):
+        return (SIZE, SIZE)
+
+
+class StubRawPixelsStore(object):
+    """
+    Returns canned big-endian planes and tiles, as the server would.
+    """
+
+    def __init__(self, plane):
+        self.plane = plane
+        self.raw = plane.astype(plane.dtype.newbyteorder('>')).tostring()
+
+    def getPlane(self, z, c, t, _ctx=None):
+        return self.raw
+
+    def getTile(self, z, c, t, x, y, w, h, _ctx=None):
+        tile = self.plane[y:y+h, x:x+w]
+        return tile.astype(tile.dtype.newbyteorder('>')).tostring()
+
+    def begin_getTile(self, *args):
+        return self.getTile(*args)
+
+    def end_getTile(self, result):
+        return result
+
+    def close(self, _ctx=None):
+        pass
+
+
+class StubPixelsWrapper(PixelsWrapper):
+
+    def __init__(self, plane, pixelsType):
+        pixels = PixelsI(1L, True)
+        pixels.sizeY = rint(plane.shape[0])
+        pixels.sizeX = rint(plane.shape[1])
+        pixels.pixelsType = PixelsTypeI()
+        pixels.pixelsType.value = rstring(pixelsType)
+        pixels.details.updateEvent = EventI(1L, False)
+        super(StubPixelsWrapper, self).__init__(
+            conn=StubConnection(), obj=pixels)
+        self.store = StubRawPixelsStore(plane)
+
+    def _prepareRawPixelsStore(self):
+        return self.store
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    rv = func(*args, **kwargs)
+    return rv, time.time() - start
+
+
+def bench_plane(size):
+    plane = numpy.random.randint(0, 65535, (size, size)).astype(
+        numpy.uint16)
+    pixels = StubPixelsWrapper(plane, "uint16")
+
+    def legacy(raw):
+        rv = numpy.array(unpack('>%dH' % plane.size, raw), numpy.uint16)
+        rv.resize(plane.shape)
+        return rv
+
+    old, t_old = timed(legacy, pixels.store.raw)
+    new, t_new = timed(pixels.getPlane)
+    print "getPlane %sx%s uint16: unpack %.3fs, frombuffer %.3fs" % (
+        size, size, t_old, t_new)
+    assert (old == new).all()
+
+
+def bench_tiles(size):
+    plane = numpy.random.rand(size, size).astype(numpy.float32)
+    pixels = StubPixelsWrapper(plane, "float")
+    tiles = [(0, 0, 0, (x, y, TILE, TILE))
+             for y in range(0, size, TILE) for x in range(0, size, TILE)]
+
+    def legacy():
+        for z, c, t, (x, y, w, h) in tiles:
+            raw = pixels.store.getTile(z, c, t, x, y, w, h)
+            rv = numpy.array(unpack('>%df' % (w * h), raw), numpy.float32)
+            rv.resize((h, w))
+
+    x, t_old = timed(legacy)
+    print "getTiles %s float tiles: unpack %.3fs" % (len(tiles), t_old)
+    for prefetch in (0, 4):
+        x, t_new = timed(lambda: list(
+            pixels.getTiles(tiles, prefetch=prefetch)))
+        print "getTiles %s float tiles: frombuffer prefetch=%s %.3fs" % (
+            len(tiles), prefetch, t_new)
+
+
+if __name__ == '__main__':
+    size = SIZE
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    bench_plane(size)
+    bench_tiles(size)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the HDF storage for the Tables API.
+
+Times the current HdfStorage implementation of appends, updates and
+compression against the previous (pure Python) approach and prints the
+results. Run with "python tables_performance.py [ROWS]".
+"""
+
+#
+#  Copyright (C) 2026 University of Dundee & Open Microscopy Environment.
+#  All rights reserved.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+import sys
+import time
+import numpy
+import omero
+import threading
+
+from omero.columns import DoubleColumnI, LongColumnI, StringColumnI
+from omero.hdfstorageV2 import HdfStorage, columns2records
+from omero.util.temp_files import create_path
+
+
+ROWS = 200000
+
+# The per-cell update is far slower than the batched one, so only a
+# subset of rows is timed for it. Raise this to compare 1M-row updates.
+UPDATE_ROWS = 20000
+
+
+def timed(func, *args):
+    start = time.time()
+    rv = func(*args)
+    return rv, time.time() - start
+
+
+def new_storage():
+    p = create_path(folder=True) / "test.h5"
+    return p, HdfStorage(p, threading.RLock())
+
+
+def bench_append(rows):
+    cols = []
+    for i in range(10):
+        d = DoubleColumnI("d%s" % i, "", None)
+        d.values = [float(x) for x in xrange(rows)]
+        cols.append(d)
+        l = LongColumnI("l%s" % i, "", None)
+        l.values = range(rows)
+        cols.append(l)
+    s = StringColumnI("s", "", 8, None)
+    s.values = ["well%s" % (x % 384) for x in xrange(rows)]
+    cols.append(s)
+
+    arrays = []
+    dtypes = []
+    for col in cols:
+        arrays.extend(col.arrays())
+        dtypes.extend(col.dtypes())
+
+    def legacy(arrays, dtypes):
+        return numpy.array(zip(*arrays), dtype=dtypes)
+
+    old, t_old = timed(legacy, arrays, dtypes)
+    new, t_new = timed(columns2records, arrays, dtypes, rows)
+    print "append: row-wise %.3fs, columnar %.3fs" % (t_old, t_new)
+    assert (old == new).all()
+
+    ndarrays = [numpy.asarray(a) for a in arrays]
+    new, t_nd = timed(columns2records, ndarrays, dtypes, rows)
+    print "append: columnar from ndarray %.3fs" % t_nd
+
+
+def bench_update(rows):
+    p, hdf = new_storage()
+    a = LongColumnI("a", "", None)
+    b = DoubleColumnI("b", "", None)
+    hdf.initialize([a, b])
+    a.values = numpy.arange(rows)
+    b.values = numpy.zeros(rows)
+    hdf.append([a, b])
+    mea = hdf._HdfStorage__mea
+
+    def data(rowNumbers, offset):
+        col = DoubleColumnI("b", "", None)
+        col.values = [float(x + offset) for x in rowNumbers]
+        return omero.grid.Data(columns=[col], rowNumbers=rowNumbers)
+
+    def legacy(data):
+        for i, rn in enumerate(data.rowNumbers):
+            for col in data.columns:
+                getattr(mea.cols, col.name)[rn] = col.values[i]
+        mea.flush()
+
+    def batched(data):
+        hdf.update(hdf._stamp, data)
+
+    try:
+        # Every other row: one run per row, the worst case for batching
+        for name, rowNumbers in (("", range(rows)),
+                                 (" sparse", range(0, rows, 2))):
+            x, t_old = timed(legacy, data(rowNumbers, 1))
+            x, t_new = timed(batched, data(rowNumbers, 2))
+            print "update %s%s rows: per-cell %.3fs, batched %.3fs" % (
+                len(rowNumbers), name, t_old, t_new)
+    finally:
+        hdf.cleanup()
+
+
+def bench_compression(rows):
+
+    def write_and_read(**options):
+        d = DoubleColumnI("d", "", None)
+        d.values = numpy.round(numpy.random.rand(rows), 2)
+        l = LongColumnI("l", "", None)
+        l.values = numpy.arange(rows) % 384
+        s = StringColumnI("s", "", 8, None)
+        s.values = ["well%s" % (x % 384) for x in xrange(rows)]
+        p, hdf = new_storage()
+        try:
+            hdf.initialize([d, l, s], **options)
+            x, t_write = timed(hdf.append, [d, l, s])
+            x, t_read = timed(hdf._HdfStorage__mea.read)
+        finally:
+            hdf.cleanup()
+        return p.size, t_write, t_read
+
+    for complib in (None, "zlib", "blosc"):
+        options = complib and {"complib": complib} or {}
+        size, t_write, t_read = write_and_read(**options)
+        print "%s: %s bytes, write %.3fs, read %.3fs" % (
+            complib or "uncompressed", size, t_write, t_read)
+
+
+if __name__ == '__main__':
+    rows = ROWS
+    if len(sys.argv) > 1:
+        rows = int(sys.argv[1])
+    bench_append(rows)
+    bench_update(min(rows, UPDATE_ROWS))
+    bench_compression(rows)
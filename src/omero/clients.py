@@ -26,8 +26,11 @@ import IceImport
 import Ice
 import re
 import ssl
+import time
 import uuid
 
+from collections import deque
+
 IceImport.load("Glacier2_Router_ice")
 import Glacier2
 
@@ -811,19 +814,24 @@ class BaseClient(object):
         router = router.ice_context(comm.getImplicitContext().getContext())
         return router
 
-    def sha1(self, filename):
+    def sha1(self, filename, digest=None, length=None):
         """
         Calculates the local sha1 for a file.
+
+        :param digest: sha1 object to update rather than a new one
+        :param length: number of bytes to hash from the start of the file,
+                       by default the whole file
         """
-        try:
-            from hashlib import sha1 as sha_new
-        except ImportError:
-            from sha import new as sha_new
-        digest = sha_new()
+        if digest is None:
+            digest = self._sha1()
         file = open(filename, 'rb')
         try:
-            while True:
-                block = file.read(1024)
+            while length is None or length > 0:
+                n = 1024 * 1024
+                if length is not None:
+                    n = min(n, length)
+                    length -= n
+                block = file.read(n)
                 if not block:
                     break
                 digest.update(block)
@@ -831,10 +839,45 @@ class BaseClient(object):
             file.close()
         return digest.hexdigest()
 
+    def _sha1(self):
+        try:
+            from hashlib import sha1 as sha_new
+        except ImportError:
+            from sha import new as sha_new
+        return sha_new()
+
+    def _progress(self, progress, start, offset, done, size):
+        """
+        Calls progress(done, size, rate) where rate is the number of bytes
+        transferred per second since start, not counting the offset the
+        transfer was resumed from.
+        """
+        if progress is not None:
+            elapsed = time.time() - start
+            rate = elapsed and (done - offset) / elapsed or 0.0
+            progress(done, size, rate)
+
     def upload(self, filename, name=None, path=None, type=None, ofile=None,
-               block_size=1024):
+               block_size=None, inflight=4, resume=False, progress=None):
         """
         Utility method to upload a file to the server.
+
+        The sha1 of the file is calculated while it is being written. Up
+        to inflight blocks of block_size bytes (by default
+        :meth:`getDefaultBlockSize`) are written concurrently using
+        asynchronous calls.
+
+        If resume is True and ofile has already been saved, the upload
+        continues from the data already on the server, less the blocks
+        which may still have been in flight when it was interrupted. The
+        same block_size and inflight should be used for both uploads.
+
+        progress, if given, is called after each block as
+        progress(bytes_done, total_bytes, bytes_per_second).
+
+        :return: The OriginalFile as saved by the RawFileStore once the
+                 transfer is complete, i.e. with its final size and hash,
+                 rather than the ofile saved before the transfer.
         """
         if not self.__sf:
             raise omero.ClientError("No session. Use createSession first.")
@@ -847,6 +890,9 @@ class BaseClient(object):
         if not os.path.exists(filename):
             raise omero.ClientError("File does not exist: " + filename)
 
+        if block_size is None:
+            block_size = self.getDefaultBlockSize()
+
         from path import path as __path__
         filepath = __path__(filename)
         file = open(filename, 'rb')
@@ -854,12 +900,11 @@ class BaseClient(object):
 
             size = os.path.getsize(file.name)
             if block_size > size:
-                block_size = size
+                block_size = max(size, 1)
 
             if not ofile:
                 ofile = omero.model.OriginalFileI()
 
-            ofile.hash = omero.rtypes.rstring(self.sha1(file.name))
             ofile.hasher = omero.model.ChecksumAlgorithmI()
             ofile.hasher.value = omero.rtypes.rstring("SHA1-160")
 
@@ -884,34 +929,102 @@ class BaseClient(object):
             #    ofile.details.permissions = permissions
 
             up = self.__sf.getUpdateService()
-            ofile = up.saveAndReturnObject(ofile)
+            resume = resume and ofile.id is not None
+            if not resume:
+                ofile = up.saveAndReturnObject(ofile)
 
             prx = self.__sf.createRawFileStore()
             try:
                 prx.setFileId(ofile.id.val)
+                digest = self._sha1()
+                offset = 0
+                if resume:
+                    # Blocks after the last confirmed one may be missing
+                    offset = prx.size() - max(inflight, 1) * block_size
+                    offset = max(0, min(offset, size))
+                    offset -= offset % block_size
+                    self.sha1(file.name, digest, offset)
+                    file.seek(offset)
                 prx.truncate(size)  # ticket:2337
-                self.write_stream(file, prx, block_size)
+                self.write_stream(file, prx, block_size, inflight=inflight,
+                                  offset=offset, digest=digest,
+                                  progress=progress, size=size)
+                saved = prx.save()
             finally:
                 prx.close()
         finally:
             file.close()
 
-        return ofile
-
-    def write_stream(self, file, prx, block_size=1024*1024):
-        offset = 0
+        sha1 = digest.hexdigest()
+        if saved is None:
+            saved = self.__sf.getQueryService().get(
+                "OriginalFile", ofile.id.val)
+        if saved.hash is None:
+            # The server did not hash the file, so record the local sha1
+            saved.hash = omero.rtypes.rstring(sha1)
+            return up.saveAndReturnObject(saved)
+        if saved.hash.val != sha1:
+            raise omero.ClientError(
+                "Checksum mismatch for %s: %s != %s"
+                % (filename, saved.hash.val, sha1))
+        return saved
+
+    def write_stream(self, file, prx, block_size=1024*1024, inflight=0,
+                     offset=0, digest=None, progress=None, size=None):
+        """
+        Writes the remainder of file to prx starting at offset, keeping up
+        to inflight writes in flight. 0, the default, waits for each write
+        to complete.
+        If given, digest is updated with each block and progress is called
+        as for :meth:`upload`.
+
+        :return: The offset after the last block written
+        """
+        start = time.time()
+        initial = offset
+        pending = deque()
         while True:
             block = file.read(block_size)
             if not block:
                 break
-            prx.write(block, offset, len(block))
+            if digest is not None:
+                digest.update(block)
+            if inflight > 0:
+                while len(pending) >= inflight:
+                    prx.end_write(pending.popleft())
+                pending.append(prx.begin_write(block, offset, len(block)))
+            else:
+                prx.write(block, offset, len(block))
             offset += len(block)
+            self._progress(progress, start, initial, offset, size)
+        while pending:
+            prx.end_write(pending.popleft())
+        return offset
 
-    def download(self, ofile, filename=None, block_size=1024*1024,
-                 filehandle=None):
+    def download(self, ofile, filename=None, block_size=None,
+                 filehandle=None, inflight=4, resume=False, progress=None):
+        """
+        Utility method to download a file from the server to filename or
+        an open filehandle.
+
+        Up to inflight blocks of block_size bytes (by default
+        :meth:`getDefaultBlockSize`) are read concurrently using
+        asynchronous calls, and written in order.
+
+        If resume is True and filename exists, the download continues
+        after the data already in it.
+
+        progress, if given, is called after each block as
+        progress(bytes_done, total_bytes, bytes_per_second).
+        """
         if not self.__sf:
             raise omero.ClientError("No session. Use createSession first.")
 
+        import os
+
+        if block_size is None:
+            block_size = self.getDefaultBlockSize()
+
         # Search for objects in all groups. See #12146
         ctx = self.getContext(group=-1)
         prx = self.__sf.createRawFileStore()
@@ -923,7 +1036,7 @@ class BaseClient(object):
                 "OriginalFile", ofile.id.val, ctx)
 
             if block_size > ofile.size.val:
-                block_size = ofile.size.val
+                block_size = max(ofile.size.val, 1)
 
             prx.setFileId(ofile.id.val, ctx)
 
@@ -934,23 +1047,58 @@ class BaseClient(object):
                 if filename is None:
                     raise omero.ClientError(
                         "no filename or filehandle specified")
-                filehandle = open(filename, 'wb')
+                if resume and os.path.exists(filename):
+                    offset = os.path.getsize(filename)
+                    if offset > size:
+                        raise omero.ClientError(
+                            "%s is larger than the file to download"
+                            % filename)
+                    filehandle = open(filename, 'ab')
+                else:
+                    filehandle = open(filename, 'wb')
             else:
                 if filename:
                     raise omero.ClientError(
                         "filename and filehandle specified.")
 
             try:
-                while (offset+block_size) < size:
-                    filehandle.write(prx.read(offset, block_size))
-                    offset += block_size
-                filehandle.write(prx.read(offset, (size-offset)))
+                self.read_stream(filehandle, prx, size, block_size,
+                                 inflight=inflight, offset=offset,
+                                 progress=progress, ctx=ctx)
             finally:
                 if filename:
                     filehandle.close()
         finally:
             prx.close()
 
+    def read_stream(self, file, prx, size, block_size=1024*1024, inflight=4,
+                    offset=0, progress=None, ctx=None):
+        """
+        Reads prx from offset up to size into file, keeping up to inflight
+        reads in flight. 0 waits for each read to complete. progress is
+        called as for :meth:`download`.
+        """
+        start = time.time()
+        initial = offset
+        pending = deque()
+        done = offset
+        while offset < size or pending:
+            if offset < size and len(pending) < max(inflight, 1):
+                n = min(block_size, size - offset)
+                if inflight > 0:
+                    pending.append(
+                        (prx.begin_read(offset, n, _ctx=ctx), n))
+                else:
+                    pending.append((prx.read(offset, n, ctx), n))
+                offset += n
+                continue
+            result, n = pending.popleft()
+            if inflight > 0:
+                result = prx.end_read(result)
+            file.write(result)
+            done += n
+            self._progress(progress, start, initial, done, size)
+
     def submit(self, req, loops=10, ms=500,
                failonerror=True, ctx=None, failontimeout=True):
         handle = self.getSession().submit(req, ctx)
@@ -34,6 +34,11 @@ except ImportError:
     has_pytables = False
 
 
+# StringColumn size which opts in to dictionary-encoded, variable length
+# storage rather than fixed-width strings, see StringColumnI
+VARIABLE_SIZE = -1
+
+
 def columns2definition(cols):
     """
     Takes a list of columns and converts them into a map
@@ -56,9 +61,16 @@ class AbstractColumn(object):
     Base logic for all columns
     """
 
+    # Whether values read from the table may be handed to Ice as
+    # numpy arrays rather than being converted to lists first.
+    # Only safe for column types whose sequences Ice can marshal
+    # directly from a buffer.
+    supports_ndarray = False
+
     def __init__(self):
         # Note: don't rely on any properties such as self.name being set if
         # this has been called through Ice
+        self._ndarray = False
         d = self.descriptor(None)
         if isinstance(d, tables.IsDescription):
             cols = d.columns
@@ -83,6 +95,13 @@ class AbstractColumn(object):
         """
         self.__table = tbl
 
+    def setndarray(self, ndarray):
+        """
+        Called by tables.py to enable returning values as numpy arrays.
+        Ignored by column types which do not support it.
+        """
+        self._ndarray = ndarray and self.supports_ndarray
+
     def append(self, tbl):
         """
         Called by tables.py to give columns. By default, does nothing.
@@ -90,18 +109,19 @@ class AbstractColumn(object):
         pass
 
     def readCoordinates(self, tbl, rowNumbers):
+        # Only this column's field is loaded from the table
         if rowNumbers is None or len(rowNumbers) == 0:
-            rows = tbl.read()
+            rows = tbl.read(field=self.name)
         else:
             if has_pytables3:
-                rows = tbl.read_coordinates(rowNumbers)
+                rows = tbl.read_coordinates(rowNumbers, field=self.name)
             else:
-                rows = tbl.readCoordinates(rowNumbers)
-        self.fromrows(rows)
+                rows = tbl.readCoordinates(rowNumbers, field=self.name)
+        self.fromrows({self.name: rows})
 
     def read(self, tbl, start, stop):
-        rows = tbl.read(start, stop)
-        self.fromrows(rows)
+        rows = tbl.read(start, stop, field=self.name)
+        self.fromrows({self.name: rows})
 
     def getsize(self):
         """
@@ -130,6 +150,13 @@ class AbstractColumn(object):
         """
         return [self.values]
 
+    def tostorage(self):
+        """
+        Returns the values as they are stored in the table. Override
+        this method if values are encoded before being stored.
+        """
+        return self.values
+
     def dtypes(self):
         """
         Override this method if descriptor() doesn't return the correct data
@@ -144,6 +171,12 @@ class AbstractColumn(object):
         will need to override this method.
         """
         self.values = rows[self.name]
+        if self._ndarray:
+            # Fields of a record array are strided views; Ice needs a
+            # contiguous buffer to marshal the sequence without copying
+            # each element into a Python object.
+            self.values = numpy.ascontiguousarray(self.values)
+            return
         # WORKAROUND:
         # http://www.zeroc.com/forums/bug-reports/4165-icepy-can-not-handle-buffers-longs-i64.html#post20468
         # see ticket:1951 and #2160
@@ -157,6 +190,8 @@ class AbstractColumn(object):
 
 class FileColumnI(AbstractColumn, omero.grid.FileColumn):
 
+    supports_ndarray = True
+
     def __init__(self, name="Unknown", *args):
         omero.grid.FileColumn.__init__(self, name, *args)
         AbstractColumn.__init__(self)
@@ -167,6 +202,8 @@ class FileColumnI(AbstractColumn, omero.grid.FileColumn):
 
 class ImageColumnI(AbstractColumn, omero.grid.ImageColumn):
 
+    supports_ndarray = True
+
     def __init__(self, name="Unknown", *args):
         omero.grid.ImageColumn.__init__(self, name, *args)
         AbstractColumn.__init__(self)
@@ -177,6 +214,8 @@ class ImageColumnI(AbstractColumn, omero.grid.ImageColumn):
 
 class WellColumnI(AbstractColumn, omero.grid.WellColumn):
 
+    supports_ndarray = True
+
     def __init__(self, name="Unknown", *args):
         omero.grid.WellColumn.__init__(self, name, *args)
         AbstractColumn.__init__(self)
@@ -187,6 +226,8 @@ class WellColumnI(AbstractColumn, omero.grid.WellColumn):
 
 class PlateColumnI(AbstractColumn, omero.grid.PlateColumn):
 
+    supports_ndarray = True
+
     def __init__(self, name="Unknown", *args):
         omero.grid.PlateColumn.__init__(self, name, *args)
         AbstractColumn.__init__(self)
@@ -197,6 +238,8 @@ class PlateColumnI(AbstractColumn, omero.grid.PlateColumn):
 
 class RoiColumnI(AbstractColumn, omero.grid.RoiColumn):
 
+    supports_ndarray = True
+
     def __init__(self, name="Unknown", *args):
         omero.grid.RoiColumn.__init__(self, name, *args)
         AbstractColumn.__init__(self)
@@ -207,6 +250,8 @@ class RoiColumnI(AbstractColumn, omero.grid.RoiColumn):
 
 class BoolColumnI(AbstractColumn, omero.grid.BoolColumn):
 
+    supports_ndarray = True
+
     def __init__(self, name="Unknown", *args):
         omero.grid.BoolColumn.__init__(self, name, *args)
         AbstractColumn.__init__(self)
@@ -217,6 +262,8 @@ class BoolColumnI(AbstractColumn, omero.grid.BoolColumn):
 
 class DoubleColumnI(AbstractColumn, omero.grid.DoubleColumn):
 
+    supports_ndarray = True
+
     def __init__(self, name="Unknown", *args):
         omero.grid.DoubleColumn.__init__(self, name, *args)
         AbstractColumn.__init__(self)
@@ -227,6 +274,8 @@ class DoubleColumnI(AbstractColumn, omero.grid.DoubleColumn):
 
 class LongColumnI(AbstractColumn, omero.grid.LongColumn):
 
+    supports_ndarray = True
+
     def __init__(self, name="Unknown", *args):
         omero.grid.LongColumn.__init__(self, name, *args)
         AbstractColumn.__init__(self)
@@ -236,25 +285,60 @@ class LongColumnI(AbstractColumn, omero.grid.LongColumn):
 
 
 class StringColumnI(AbstractColumn, omero.grid.StringColumn):
+    """
+    Strings are stored in a fixed-width column of the given size.
+    If the size is VARIABLE_SIZE, the column is instead dictionary
+    encoded: each distinct string is stored once in a separate
+    variable-length array and the table holds integer codes into it.
+    This suits long or repetitive values, but such columns cannot be
+    used in getWhereList conditions or aggregates.
+    """
 
     def __init__(self, name="Unknown", *args):
         omero.grid.StringColumn.__init__(self, name, *args)
         AbstractColumn.__init__(self)
+        self._strings = None
 
     def settable(self, tbl):
         AbstractColumn.settable(self, tbl)
-        self.size = getattr(tbl.cols, self.name).dtype.itemsize
+        column = getattr(tbl.cols, self.name)
+        if column.dtype.kind == "S":
+            self.size = column.dtype.itemsize
+            self._strings = None
+        else:
+            self.size = VARIABLE_SIZE
+            self._strings = self._getstrings(tbl)
 
     def arrays(self):
         """
         Check for strings longer than the initialised column width
         """
-        for v in self.values:
-            if len(v) > self.size:
-                raise omero.ValidationException(
-                    None, None, "Maximum string length in column %s is %d" %
-                    (self.name, self.size))
-        return [self.values]
+        if self.size != VARIABLE_SIZE:
+            for v in self.values:
+                if len(v) > self.size:
+                    raise omero.ValidationException(
+                        None, None,
+                        "Maximum string length in column %s is %d" %
+                        (self.name, self.size))
+        return [self.tostorage()]
+
+    def tostorage(self):
+        """
+        Dictionary encodes the values if necessary, adding any strings
+        which have not been seen before.
+        """
+        if self.size != VARIABLE_SIZE:
+            return self.values
+        strings = self._strings
+        codes = dict([(v, i) for i, v in enumerate(strings.read())])
+        rv = numpy.empty(len(self.values), dtype=numpy.int32)
+        for i, v in enumerate(self.values):
+            try:
+                rv[i] = codes[v]
+            except KeyError:
+                rv[i] = codes[v] = len(codes)
+                strings.append(v)
+        return rv
 
     def dtypes(self):
         """
@@ -262,6 +346,8 @@ class StringColumnI(AbstractColumn, omero.grid.StringColumn):
         (Testing suggests this may not be necessary, the size appears to be
         correctly set at initialisation)
         """
+        if self.size == VARIABLE_SIZE:
+            return [(self.name, "i4")]
         return [(self.name, "S", self.size)]
 
     def descriptor(self, pos):
@@ -269,12 +355,46 @@ class StringColumnI(AbstractColumn, omero.grid.StringColumn):
         # to prevent exceptions we temporarily assume size 1
         if pos is None:
             return tables.StringCol(pos=pos, itemsize=1)
+        if self.size == VARIABLE_SIZE:
+            return tables.Int32Col(pos=pos)
         if self.size < 1:
             raise omero.ApiUsageException(
                 None, None, "String size must be > 0 (Column: %s)"
                 % self.name)
         return tables.StringCol(pos=pos, itemsize=self.size)
 
+    def fromrows(self, rows):
+        if self.size != VARIABLE_SIZE:
+            return AbstractColumn.fromrows(self, rows)
+        codes = rows[self.name]
+        if not len(codes):
+            self.values = []
+            return
+        unique = numpy.unique(codes).tolist()
+        first = unique[0]
+        last = unique[-1]
+        if last - first + 1 <= 4 * len(unique):
+            # Dense codes: a single read of the covering range
+            strings = self._strings.read(first, last + 1)
+            lookup = dict(zip(range(first, last + 1), strings))
+        else:
+            lookup = dict([(c, self._strings[c]) for c in unique])
+        self.values = [lookup[c] for c in codes.tolist()]
+
+    def _getstrings(self, tbl):
+        n = tbl._v_name
+        f = tbl._v_file
+        p = tbl._v_parent
+        try:
+            strings = getattr(p, "%s_%s_strings" % (n, self.name))
+        except tables.NoSuchNodeError:
+            if f.mode == "r":
+                # Nothing has been appended yet
+                return None
+            strings = f.create_vlarray(
+                p, "%s_%s_strings" % (n, self.name), tables.VLStringAtom())
+        return strings
+
 
 class AbstractArrayColumn(AbstractColumn):
     """
@@ -14,9 +14,10 @@
 
 # Set up the python include paths
 import os
+import sys
 
 import warnings
-from collections import defaultdict
+from collections import defaultdict, deque
 from types import IntType, LongType, UnicodeType, ListType
 from types import BooleanType, TupleType, StringType, StringTypes
 from datetime import datetime
@@ -30,6 +31,7 @@ from omero.cmd import Chgrp2, Delete2, DoAll, SkipHead
 from omero.cmd.graphs import ChildOption
 from omero.api import Save
 from omero.gateway.utils import ServiceOptsDict, GatewayConfig, toBoolean
+from omero.gateway.utils import PixelsCache
 from omero.model.enums import PixelsTypeint8, PixelsTypeuint8, PixelsTypeint16
 from omero.model.enums import PixelsTypeuint16, PixelsTypeint32
 from omero.model.enums import PixelsTypeuint32, PixelsTypefloat
@@ -40,10 +42,12 @@ import Ice
 import Glacier2
 
 import traceback
+import itertools
+import threading
 import time
-import array
 import math
 from decimal import Decimal
+from Queue import Queue, Empty
 
 from gettext import gettext as _
 
@@ -56,6 +60,14 @@ from omero.rtypes import rtime, rlist, rdouble, unwrap
 logger = logging.getLogger(__name__)
 THISPATH = os.path.dirname(os.path.abspath(__file__))
 
+# Source of the tokens identifying unsaved rendering settings,
+# see ImageWrapper._getRenderingKey
+_renderingEdits = itertools.count(1)
+
+# Bytes of each block of rows converted and measured at once by
+# BlitzGateway.createImageFromNumpySeq, small enough to stay in cache
+CONVERT_BLOCK_SIZE = 256 * 1024
+
 try:
     from PIL import Image, ImageDraw, ImageFont     # see ticket:2597
 except:  # pragma: nocover
@@ -749,16 +761,23 @@ class BlitzObjectWrapper (object):
                 ).findAllByQuery(query, params, self._conn.SERVICE_OPTS)):
             yield child
 
-    def listChildren(self, ns=None, val=None, params=None):
+    def listChildren(self, ns=None, val=None, params=None, prefetch=None):
         """
         Lists available child objects.
 
+        :param prefetch: Relationships to load in bulk for all children.
+                         See :meth:`BlitzGateway.getObjects`
         :rtype: generator of :class:`BlitzObjectWrapper` objs
         :return: child objects.
         """
         childw = self._getChildWrapper()
-        for child in self._listChildren(ns=ns, val=val, params=params):
-            yield childw(self._conn, child, self._cache)
+        children = (childw(self._conn, child, self._cache)
+                    for child in self._listChildren(
+                        ns=ns, val=val, params=params))
+        if prefetch:
+            children = self._conn._prefetch(list(children), prefetch)
+        for child in children:
+            yield child
 
     def getParent(self, withlinks=False):
         """
@@ -1483,6 +1502,15 @@ class _BlitzGateway (object):
     """
     ICE_CONFIG - Defines the path to the Ice configuration
     """
+    QUERY_BATCH_SIZE = 1000
+    """
+    QUERY_BATCH_SIZE - Maximum number of IDs passed to a single query by
+    getObjects and getAnnotationLinks. Longer lists are split into batches
+    """
+    QUERY_BATCH_THREADS = 1
+    """
+    QUERY_BATCH_THREADS - Number of batches of IDs queried concurrently
+    """
 # def __init__ (self, username, passwd, server, port, client_obj=None,
 # group=None, clone=False):
 
@@ -1550,6 +1578,7 @@ class _BlitzGateway (object):
         self._defaultOmeroGroup = None
         self._defaultOmeroUser = None
         self._maxPlaneSize = None
+        self._pixelsCache = None
 
         self._connected = False
         self._user = None
@@ -1676,6 +1705,46 @@ class _BlitzGateway (object):
                 int(c.getConfigValue('omero.pixeldata.max_plane_height')))
         return self._maxPlaneSize
 
+    def setPixelsCache(self, maxBytes=64 * 1024 * 1024, directory=None,
+                       maxDiskBytes=None):
+        """
+        Enables caching of the numpy planes and tiles returned by
+        :meth:`PixelsWrapper.getTiles` and of the JPEG data returned by
+        :meth:`ImageWrapper.renderJpegRegion`. Entries are keyed on the
+        pixels ID and update event, so data is refetched once the pixels
+        have been modified, and on the rendering settings for JPEGs.
+        Disabled by default; pass maxBytes=0 to disable it again.
+
+        Writing pixel data through a RawPixelsStore (setPlane(), setTile()
+        etc.) does not change the update event of the Pixels, so callers
+        that modify the data of existing pixels must clear the cache with
+        ``conn.getPixelsCache().clear()`` to avoid reading stale tiles.
+
+        :param maxBytes:        Maximum number of bytes held in memory
+        :param directory:       Optional local directory that entries
+                                evicted from memory are spilled to
+        :param maxDiskBytes:    Maximum number of bytes held in directory
+        :return:                The new :class:`PixelsCache` or None
+        """
+        if self._pixelsCache is not None:
+            self._pixelsCache.clear()
+        if not maxBytes:
+            self._pixelsCache = None
+        else:
+            self._pixelsCache = PixelsCache(
+                maxBytes, directory=directory, maxDiskBytes=maxDiskBytes)
+        return self._pixelsCache
+
+    def getPixelsCache(self):
+        """
+        Returns the cache set by :meth:`setPixelsCache`, whose hit and miss
+        counters are available from :meth:`PixelsCache.getStats`, or None
+        if caching is disabled.
+
+        :rtype:     :class:`omero.gateway.utils.PixelsCache`
+        """
+        return self._pixelsCache
+
     def getClientSettings(self):
         """
         Returns all client properties matching omero.client.*
@@ -3237,8 +3306,10 @@ class _BlitzGateway (object):
         if result is not None:
             return wrapper(self, result)
 
+    PREFETCH = ('annotations', 'pixels', 'owners')
+
     def getObjects(self, obj_type, ids=None, params=None, attributes=None,
-                   respect_order=False, opts=None):
+                   respect_order=False, opts=None, prefetch=None):
         """
         Retrieve Objects by type E.g. "Image"
         Returns generator of appropriate :class:`BlitzObjectWrapper` type.
@@ -3260,13 +3331,83 @@ class _BlitzGateway (object):
         :param opts:        Dict of additional options for filtering or
                             defining extra data to load.
                             offset, limit and owner for all objects.
+                            'page_size': N to stream the objects N at a
+                            time, see below.
                             Additional opts handled by _getQueryString()
                             e.g. filter Dataset by 'project'
+        :param prefetch:    Tuple of relationships to load in bulk for all
+                            the objects, so that accessing them later does
+                            not query the server once per object. Any of
+                            'annotations' (:meth:`listAnnotations`),
+                            'pixels' (:meth:`ImageWrapper.getPrimaryPixels`)
+                            and 'owners' (:meth:`getOwner`).
         :return:            Generator of :class:`BlitzObjectWrapper` subclasses
-        """
+
+        If opts contains 'page_size' the objects are loaded in pages of that
+        size using keyset pagination on the object ID, and each page is
+        yielded as it arrives, so that memory use doesn't grow with the
+        number of objects. Objects are then ordered by ID, or by ids if
+        respect_order is True. 'page_size' can't be combined with
+        'order_by' or with offset and limit, nor used for queries that load
+        collections (e.g. Fileset, Plate or Image with 'load_pixels') since
+        the server would then apply each page in memory.
+
+        Lists of more than :attr:`QUERY_BATCH_SIZE` ids are queried in
+        batches, :attr:`QUERY_BATCH_THREADS` at a time, unless 'order_by'
+        or offset and limit are used. Without 'page_size' or respect_order
+        the objects are not ordered across batches.
+        """
+        self._checkPrefetch(prefetch)
+        page_size = opts is not None and opts.get('page_size') or None
+        if ids is not None and (
+                page_size or len(ids) > self.QUERY_BATCH_SIZE):
+            # Raises if page_size is combined with order_by etc.
+            query, baseParams, wrapper = self.buildQuery(
+                obj_type, None, params, attributes, opts)
+            ordered = (opts is not None and 'order_by' in opts or
+                       baseParams.theFilter is not None and
+                       baseParams.theFilter.limit is not None)
+            if page_size or not ordered:
+                # Query slices of the ids, each ordered if needed
+                batchOpts = opts is not None and dict(opts) or None
+                size = self.QUERY_BATCH_SIZE
+                if page_size:
+                    del batchOpts['page_size']
+                    size = min(page_size, size)
+                ids = unwrap(ids)
+                if page_size and not respect_order:
+                    ids = sorted(set(ids))
+
+                def query(batch):
+                    rv = list(self.getObjects(
+                        obj_type, batch, params, attributes, respect_order,
+                        batchOpts, prefetch))
+                    if page_size and not respect_order:
+                        rv.sort(key=lambda obj: obj.getId())
+                    return rv
+                for result in self._queryBatches(ids, query, size):
+                    for r in result:
+                        yield r
+                return
         query, params, wrapper = self.buildQuery(
             obj_type, ids, params, attributes, opts)
         qs = self.getQueryService()
+        if page_size:
+            while True:
+                result = qs.findAllByQuery(query, params, self.SERVICE_OPTS)
+                if not result:
+                    break
+                lastId = result[-1].id.val
+                result = [wrapper(self, r) for r in result]
+                if prefetch:
+                    self._prefetch(result, prefetch)
+                for r in result:
+                    yield r
+                if len(result) < page_size:
+                    break
+                params.map["lastId"] = rlong(lastId)
+                del result
+            return
         result = qs.findAllByQuery(query, params, self.SERVICE_OPTS)
         if respect_order and ids is not None:
             idMap = {}
@@ -3274,8 +3415,154 @@ class _BlitzGateway (object):
                 idMap[r.id.val] = r
             ids = unwrap(ids)       # in case we had a list of rlongs
             result = [idMap.get(i) for i in ids if i in idMap]
+        if prefetch:
+            result = self._prefetch(
+                [wrapper(self, r) for r in result], prefetch)
+        else:
+            result = (wrapper(self, r) for r in result)
         for r in result:
-            yield wrapper(self, r)
+            yield r
+
+    def _queryBatches(self, ids, query, size=None):
+        """
+        Splits ids into batches of at most size (by default
+        :attr:`QUERY_BATCH_SIZE`) and yields the result of query(batch)
+        for each batch, in order. Up to :attr:`QUERY_BATCH_THREADS`
+        batches are queried concurrently.
+
+        :param ids:     List of IDs
+        :param query:   Function taking a list of IDs
+        :param size:    Maximum number of IDs per batch
+        :return:        Generator of the results of query
+        """
+        if size is None:
+            size = self.QUERY_BATCH_SIZE
+        batches = (ids[i:i + size] for i in xrange(0, len(ids), size))
+        threads = self.QUERY_BATCH_THREADS
+        if threads <= 1:
+            for batch in batches:
+                yield query(batch)
+            return
+
+        def start(batch):
+            holder = dict()
+
+            def run():
+                try:
+                    holder['rv'] = query(batch)
+                except Exception:
+                    holder['exc'] = sys.exc_info()
+            thread = threading.Thread(target=run)
+            thread.start()
+            return thread, holder
+
+        def finish(thread, holder):
+            thread.join()
+            if 'exc' in holder:
+                exc_type, exc, tb = holder['exc']
+                raise exc_type, exc, tb
+            return holder['rv']
+
+        pending = deque()
+        for batch in batches:
+            if len(pending) >= threads:
+                yield finish(*pending.popleft())
+            pending.append(start(batch))
+        while pending:
+            yield finish(*pending.popleft())
+
+    def _checkPrefetch(self, prefetch):
+        """
+        Raises AttributeError if prefetch holds unknown relationships.
+
+        :param prefetch:    Tuple of relationships, see :attr:`PREFETCH`
+        """
+        if prefetch:
+            for p in prefetch:
+                if p not in self.PREFETCH:
+                    raise AttributeError(
+                        "prefetch must be in %s, not '%s'"
+                        % (str(self.PREFETCH), p))
+
+    def _prefetch(self, wrappers, prefetch):
+        """
+        Loads the given relationships of all the wrappers with one query
+        per relationship (and group for annotations) and attaches them to
+        the wrapped objects. Used by :meth:`getObjects` and
+        :meth:`BlitzObjectWrapper.listChildren`.
+
+        :param wrappers:    List of :class:`BlitzObjectWrapper`
+        :param prefetch:    Tuple of relationships, see :attr:`PREFETCH`
+        :return:            The wrappers
+        """
+        self._checkPrefetch(prefetch)
+        qs = self.getQueryService()
+
+        def find(query, ids, ctx):
+            def run(batch):
+                params = omero.sys.ParametersI().addIds(batch)
+                return qs.findAllByQuery(query, params, ctx)
+            for result in self._queryBatches(list(ids), run):
+                for r in result:
+                    yield r
+
+        if 'annotations' in prefetch:
+            # Load links in the group of their parent, as done by
+            # _loadAnnotationLinks, so that canDelete() etc are correct.
+            byGroup = defaultdict(lambda: defaultdict(list))
+            for w in wrappers:
+                if (hasattr(w._obj, 'isAnnotationLinksLoaded') and
+                        not w._obj.isAnnotationLinksLoaded()):
+                    byGroup[(w.OMERO_CLASS, w.details.group.id.val)][
+                        w.getId()].append(w)
+            for (omeroClass, gid), byId in byGroup.items():
+                ctx = self.SERVICE_OPTS.copy()
+                ctx.setOmeroGroup(gid)
+                query = ("select l from %sAnnotationLink as l join "
+                         "fetch l.details.owner join "
+                         "fetch l.details.creationEvent "
+                         "join fetch l.child as a join fetch a.details.owner "
+                         "left outer join fetch a.file "
+                         "join fetch a.details.creationEvent "
+                         "where l.parent.id in (:ids)" % omeroClass)
+                links = defaultdict(list)
+                for l in find(query, byId.keys(), ctx):
+                    links[l.parent.id.val].append(l)
+                for oid, ws in byId.items():
+                    for w in ws:
+                        w._obj._annotationLinksLoaded = True
+                        w._obj._annotationLinksSeq = list(links[oid])
+        ctx = self.SERVICE_OPTS.copy()
+        ctx.setOmeroGroup(-1)
+        if 'pixels' in prefetch:
+            byId = defaultdict(list)
+            for w in wrappers:
+                if w.OMERO_CLASS == 'Image' and not w._obj.pixelsLoaded:
+                    byId[w.getId()].append(w)
+            if byId:
+                query = ("select p from Pixels as p "
+                         "join fetch p.pixelsType "
+                         "where p.image.id in (:ids)")
+                pixels = defaultdict(list)
+                for p in find(query, byId.keys(), ctx):
+                    pixels[p.image.id.val].append(p)
+                for iid, ws in byId.items():
+                    for w in ws:
+                        w._obj._pixelsLoaded = True
+                        w._obj._pixelsSeq = list(pixels[iid])
+        if 'owners' in prefetch:
+            byId = defaultdict(list)
+            for w in wrappers:
+                details = w._obj.getDetails()
+                owner = details is not None and details.getOwner() or None
+                if owner is not None and not owner.loaded:
+                    byId[owner.id.val].append(w)
+            if byId:
+                query = "select e from Experimenter as e where e.id in (:ids)"
+                for e in find(query, byId.keys(), ctx):
+                    for w in byId[e.id.val]:
+                        w._obj.getDetails().setOwner(e)
+        return wrappers
 
     def buildQuery(self, obj_type, ids=None, params=None, attributes=None,
                    opts=None):
@@ -3298,6 +3585,9 @@ class _BlitzGateway (object):
                             defining extra data to load.
                             offset, limit and owner for all objects.
                             Also 'order_by': 'obj.name' to order results.
+                            'page_size': N to return the first N objects
+                            by ID, and those after the ID set as the
+                            'lastId' parameter. See :meth:`getObjects`
                             Additional opts handled by _getQueryString()
                             e.g. filter Dataset by 'project'
         :return:            (query, params, wrapper)
@@ -3318,6 +3608,7 @@ class _BlitzGateway (object):
         order_by = None
         offset = None
         limit = None
+        page_size = None
 
         # We get the query from the ObjectWrapper class:
         if wrapper.__name__ == "_wrap":
@@ -3338,6 +3629,8 @@ class _BlitzGateway (object):
                 owner = rlong(opts['owner'])
             if 'order_by' in opts:
                 order_by = opts['order_by']
+            if 'page_size' in opts:
+                page_size = opts['page_size']
         # Handle additional Parameters - need to retrieve owner filter
         if params is not None and params.theFilter is not None:
             if params.theFilter.ownerId is not None:
@@ -3350,7 +3643,25 @@ class _BlitzGateway (object):
                 limit = lmt.val
             # Other params args will be ignored unless we handle here
 
-        if limit is not None and offset is not None:
+        if page_size is not None:
+            if order_by is not None or (
+                    limit is not None and offset is not None):
+                raise AttributeError(
+                    "page_size can't be combined with order_by or "
+                    "offset and limit")
+            # Hibernate pages queries which fetch a collection in memory
+            words = query.split()
+            for fetch, path in zip(words, words[1:]):
+                if fetch == "fetch" and \
+                        path.split(".")[-1] in FETCHED_COLLECTIONS:
+                    raise AttributeError(
+                        "page_size can't be used with %s queries which "
+                        "load %s" % (obj_type, path))
+            # Keyset pagination: getObjects() updates lastId for each page
+            clauses.append("obj.id > :lastId")
+            baseParams.map["lastId"] = rlong(-1)
+            baseParams.page(0, page_size)
+        elif limit is not None and offset is not None:
             baseParams.page(offset, limit)
 
         # getting object by ids
@@ -3376,6 +3687,8 @@ class _BlitzGateway (object):
         # Order by... e.g. 'lower(obj.name)' or 'obj.column, obj.row' for wells
         if order_by is not None:
             query += " order by %s, obj.id" % order_by
+        elif page_size is not None:
+            query += " order by obj.id"
 
         return (query, baseParams, wrapper)
 
@@ -3449,6 +3762,9 @@ class _BlitzGateway (object):
         Returns generator of :class:`AnnotationLinkWrapper`
         If parent_ids is None, all available objects will be returned.
         i.e. listObjects()
+        Lists of more than :attr:`QUERY_BATCH_SIZE` parent_ids are queried
+        in batches, :attr:`QUERY_BATCH_THREADS` at a time, unless params
+        sets an offset or limit, which must apply to the whole result.
 
         :param obj_type:    Object type, e.g. "Project" see above
         :type obj_type:     String
@@ -3485,7 +3801,6 @@ class _BlitzGateway (object):
         clauses = []
         if parent_ids:
             clauses.append("parent.id in (:pids)")
-            params.map["pids"] = rlist([rlong(a) for a in parent_ids])
 
         if ann_ids:
             clauses.append("ann.id in (:ann_ids)")
@@ -3502,9 +3817,27 @@ class _BlitzGateway (object):
         if len(clauses) > 0:
             query += " where %s" % (" and ".join(clauses))
 
-        result = q.findAllByQuery(query, params, self.SERVICE_OPTS)
-        for r in result:
-            yield AnnotationLinkWrapper(self, r)
+        def find(batch):
+            p = omero.sys.Parameters()
+            p.map = dict(params.map)
+            p.theFilter = params.theFilter
+            p.theOptions = params.theOptions
+            if batch is not None:
+                p.map["pids"] = rlist([rlong(a) for a in batch])
+            return q.findAllByQuery(query, p, self.SERVICE_OPTS)
+
+        paged = params.theFilter is not None and (
+            params.theFilter.offset is not None or
+            params.theFilter.limit is not None)
+        if parent_ids and not paged:
+            results = self._queryBatches(list(parent_ids), find)
+        elif parent_ids:
+            results = [find(parent_ids)]
+        else:
+            results = [find(None)]
+        for result in results:
+            for r in result:
+                yield AnnotationLinkWrapper(self, r)
 
     def countAnnotations(self, obj_type, obj_ids=[]):
         """
@@ -3676,7 +4009,8 @@ class _BlitzGateway (object):
 
     def createImageFromNumpySeq(self, zctPlanes, imageName, sizeZ=1, sizeC=1,
                                 sizeT=1, description=None, dataset=None,
-                                sourceImageId=None, channelList=None):
+                                sourceImageId=None, channelList=None,
+                                pipeline=4):
         """
         Creates a new multi-dimensional image from the sequence of 2D numpy
         arrays in zctPlanes. zctPlanes should be a generator of numpy 2D
@@ -3715,7 +4049,15 @@ class _BlitzGateway (object):
                                 then add pixel data
         :param channelList:     Copies metadata from these channels in
                                 source image (if specified). E.g. [0,2]
+        :param pipeline:        Number of setPlane() or setTile() calls kept
+                                in flight using asynchronous (AMI) calls.
+                                0 waits for each call to complete.
         :return: The new OMERO image: omero.model.ImageI
+
+        Each plane is converted to the pixels type of the new image and to
+        big-endian order into a reused buffer, gathering the channel min
+        and max in the same pass. Planes larger than
+        :meth:`getMaxPlaneSize` are written tile by tile.
         """
         queryService = self.getQueryService()
         pixelsService = self.getPixelsService()
@@ -3788,18 +4130,50 @@ class _BlitzGateway (object):
             return (containerService.getImages(
                 "Image", [imageId], None, self.SERVICE_OPTS)[0], convertToType)
 
-        def uploadPlane(plane, z, c, t, convertToType):
-            # if we're given a numpy dtype, need to convert plane to that dtype
-            if convertToType is not None:
-                p = numpy.zeros(plane.shape, dtype=convertToType)
-                p += plane
-                plane = p
-            byteSwappedPlane = plane.byteswap()
-            convertedPlane = byteSwappedPlane.tostring()
-            rawPixelsStore.setPlane(convertedPlane, z, c, t, self.SERVICE_OPTS)
+        pending = deque()
+
+        def send(method, *args):
+            if pipeline > 0:
+                while len(pending) >= pipeline:
+                    end, result = pending.popleft()
+                    end(result)
+                begin = getattr(rawPixelsStore, "begin_" + method)
+                end = getattr(rawPixelsStore, "end_" + method)
+                pending.append((end, begin(*args, _ctx=self.SERVICE_OPTS)))
+            else:
+                getattr(rawPixelsStore, method)(*args, _ctx=self.SERVICE_OPTS)
+
+        def convertPlane(plane):
+            # Converts to the pixels type and byte order and gathers the
+            # min and max in a single pass: each block of rows is still in
+            # the CPU cache when its stats are taken.
+            minValue = maxValue = None
+            for y in xrange(0, plane.shape[0], blockRows):
+                block = plane[y:y + blockRows]
+                buf[y:y + blockRows] = block
+                blockMin = block.min()
+                blockMax = block.max()
+                if minValue is None:
+                    minValue, maxValue = blockMin, blockMax
+                else:
+                    minValue = min(minValue, blockMin)
+                    maxValue = max(maxValue, blockMax)
+            return minValue, maxValue
+
+        def uploadPlane(plane, z, c, t):
+            minMax = convertPlane(plane)
+            if tiles is None:
+                send("setPlane", buf.tostring(), z, c, t)
+            else:
+                for x, y, w, h in tiles:
+                    send("setTile", buf[y:y + h, x:x + w].tostring(),
+                         z, c, t, x, y, w, h)
+            return minMax
 
         image = None
-        dtype = None
+        buf = None
+        blockRows = None
+        tiles = None
         channelsMinMax = []
         exc = None
         try:
@@ -3814,10 +4188,25 @@ class _BlitzGateway (object):
                                 ).getId().getValue()
                             rawPixelsStore.setPixelsId(
                                 pixelsId, True, self.SERVICE_OPTS)
-                        uploadPlane(plane, theZ, theC, theT, dtype)
-                        # init or update min and max for this channel
-                        minValue = plane.min()
-                        maxValue = plane.max()
+                            if dtype is None:
+                                dtype = plane.dtype
+                            # Pixel data is big-endian
+                            buf = numpy.empty(plane.shape, dtype=numpy.dtype(
+                                dtype).newbyteorder('>'))
+                            blockRows = max(
+                                1, CONVERT_BLOCK_SIZE // max(1, buf[0].nbytes))
+                            sizeY, sizeX = plane.shape
+                            maxX, maxY = self.getMaxPlaneSize()
+                            if sizeX > maxX or sizeY > maxY:
+                                tileW, tileH = rawPixelsStore.getTileSize(
+                                    self.SERVICE_OPTS)
+                                tiles = [
+                                    (x, y, min(tileW, sizeX - x),
+                                     min(tileH, sizeY - y))
+                                    for y in xrange(0, sizeY, tileH)
+                                    for x in xrange(0, sizeX, tileW)]
+                        minValue, maxValue = uploadPlane(
+                            plane, theZ, theC, theT)
                         # first plane of each channel
                         if len(channelsMinMax) < (theC + 1):
                             channelsMinMax.append([minValue, maxValue])
@@ -3826,11 +4215,23 @@ class _BlitzGateway (object):
                                 channelsMinMax[theC][0], minValue)
                             channelsMinMax[theC][1] = max(
                                 channelsMinMax[theC][1], maxValue)
+            while pending:
+                end, result = pending.popleft()
+                end(result)
         except Exception, e:
             logger.error(
                 "Failed to setPlane() on rawPixelsStore while creating Image",
                 exc_info=True)
             exc = e
+            # Complete the calls still in flight before closing
+            while pending:
+                end, result = pending.popleft()
+                try:
+                    end(result)
+                except Exception:
+                    logger.error(
+                        "Failed to setPlane() or setTile() on rawPixelsStore",
+                        exc_info=True)
         try:
             rawPixelsStore.close(self.SERVICE_OPTS)
         except Exception, e:
@@ -4652,6 +5053,95 @@ class _BlitzGateway (object):
                 tb.close()
         return _resp
 
+    def getThumbnails(self, images, size=(64, 64), z=None, t=None,
+                      direct=True, rdefIds=None, threads=4, batchSize=25):
+        """
+        Retrieves thumbnails for a number of images, as returned by
+        :meth:`ImageWrapper.getThumbnail` for each of them.
+
+        Images are grouped by their group and split into batches of at
+        most batchSize images. The batches are rendered by a pool of
+        worker threads, each of which reuses a single ThumbnailStore for
+        all the images it renders.
+
+        :param images:      A list of image IDs or :class:`ImageWrapper`
+        :param size:        A tuple with one or two ints, or an integer.
+                            See :meth:`ImageWrapper.getThumbnail`
+        :param z:           The Z position to use for rendering, or None
+                            for the default
+        :param t:           The T position to use for rendering, or None
+                            for the default
+        :param direct:      If True, force creation of new thumbnails
+        :param rdefIds:     Optional dict of image ID to the rendering def
+                            ID to apply to its thumbnail
+        :param threads:     Number of worker threads and ThumbnailStores
+        :param batchSize:   Maximum number of images per batch
+        :return:            Tuple of two dicts keyed by image ID, holding
+                            the rendered JPEGs and the exceptions raised
+                            for images that failed
+        """
+        if rdefIds is None:
+            rdefIds = dict()
+        rv = dict()
+        errors = dict()
+        wrappers = [i for i in images if isinstance(i, BlitzObjectWrapper)]
+        ids = [long(i) for i in images
+               if not isinstance(i, BlitzObjectWrapper)]
+        if ids:
+            ctx = self.SERVICE_OPTS.copy()
+            if ctx.getOmeroGroup() is None:
+                ctx.setOmeroGroup(-1)
+            query, params, wrapper = self.buildQuery(
+                "Image", ids, opts={'load_pixels': True})
+            result = self.getQueryService().findAllByQuery(
+                query, params, ctx)
+            loaded = [ImageWrapper(self, r) for r in result]
+            found = set([i.getId() for i in loaded])
+            for iid in ids:
+                if iid not in found:
+                    errors[iid] = omero.ApiUsageException(
+                        None, None, "Image:%s not found" % iid)
+            wrappers.extend(loaded)
+
+        byGroup = defaultdict(list)
+        for image in wrappers:
+            byGroup[image.details.group.id.val].append(image)
+        batches = Queue()
+        for groupImages in byGroup.values():
+            for i in range(0, len(groupImages), batchSize):
+                batches.put(groupImages[i:i + batchSize])
+
+        def work():
+            tb = self.createThumbnailStore().clone()
+            try:
+                while True:
+                    try:
+                        batch = batches.get_nowait()
+                    except Empty:
+                        break
+                    for image in batch:
+                        iid = image.getId()
+                        try:
+                            image._prepareTB(
+                                rdefId=rdefIds.get(iid), tb=tb)
+                            rv[iid] = image._getThumbnail(
+                                tb, size, z, t, direct)
+                        except Exception, e:
+                            logger.debug(
+                                "Failed to get thumbnail of Image:%s",
+                                iid, exc_info=True)
+                            errors[iid] = e
+            finally:
+                tb.close()
+
+        workers = [threading.Thread(target=work)
+                   for i in range(min(threads, batches.qsize()))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return rv, errors
+
 
 class OmeroGatewaySafeCallWrapper(object):  # pragma: no cover
     """
@@ -4699,6 +5189,19 @@ class OmeroGatewaySafeCallWrapper(object):  # pragma: no cover
         try:
             return self.f(*args, **kwargs)
         except Exception, e:
+            f = None
+            if isinstance(e, Ice.ObjectNotExistException) or (
+                    isinstance(e, Ice.ConnectionLostException) and
+                    self.attr in self.proxyObjectWrapper.RETRY_METHODS):
+                f = self.proxyObjectWrapper._recover(self.attr)
+            if f is not None:
+                # The service was recreated, so retry once
+                self.f = f
+                try:
+                    return self.f(*args, **kwargs)
+                except Exception, e:
+                    self.debug(e.__class__.__name__, args, kwargs)
+                    return self.handle_exception(e, *args, **kwargs)
             self.debug(e.__class__.__name__, args, kwargs)
             return self.handle_exception(e, *args, **kwargs)
 
@@ -4747,7 +5250,33 @@ class ProxyObjectWrapper (object):
     Wrapper for services. E.g. Admin Service, Delete Service etc.
     Maintains reference to connection.
     Handles creation of service when requested.
-    """
+
+    Calls on an existing service are never preceded by a ping. When a call
+    raises ObjectNotExistException a stateless service is recreated and
+    the call retried once. After a ConnectionLostException the call may
+    already have reached the server, so only the read-only methods in
+    :attr:`RETRY_METHODS` are retried.
+    """
+
+    # Seconds a service may be idle before _getObj() pings it.
+    # 0 pings on every call to _getObj().
+    PING_INTERVAL = 60
+
+    # Read-only methods which are safe to retry after a lost connection
+    RETRY_METHODS = frozenset((
+        'find', 'findAll', 'findByExample', 'findAllByExample',
+        'findByString', 'findAllByString', 'findByQuery', 'findAllByQuery',
+        'get', 'projection', 'getEventContext', 'getMyOpenShares',
+        'loadContainerHierarchy', 'getImages', 'countAnnotations',
+        'loadAnnotations', 'loadAnnotationsLinkedTo', 'getTaggedObjectsCount',
+        'loadSpecifiedAnnotations', 'getPixelsDescription',
+        'retrievePixDescription', 'retrieveRndSettings',
+        'retrieveAllRndSettings', 'getAllEnumerations', 'getEnumeration',
+        'lookupExperimenter', 'lookupGroup', 'lookupExperimenters',
+        'lookupGroups', 'getGroup', 'getExperimenter', 'containedGroups',
+        'containedExperimenters', 'getDefaultGroup', 'getMemberOfGroupIds',
+        'getLeaderOfGroupIds', 'getSecurityRoles', 'getConfigValue',
+        'getVersion', 'getDatabaseUuid'))
 
     def __init__(self, conn, func_str, cast_to=None, service_name=None):
         """
@@ -4771,6 +5300,7 @@ class ProxyObjectWrapper (object):
         self._service_name = service_name
         self._resyncConn(conn)
         self._tainted = False
+        self._lastUsed = 0
 
     def clone(self):
         """
@@ -4867,6 +5397,9 @@ class ProxyObjectWrapper (object):
     def _getObj(self):
         """
         Returns the wrapped service. If it is None, service is created.
+        If it has been idle for more than :attr:`PING_INTERVAL` seconds it
+        is pinged first. Calls made through :meth:`__getattr__` do not
+        ping an existing service.
 
         :return:    The wrapped service
         :rtype:     omero.api.ServiceInterface subclass
@@ -4879,10 +5412,43 @@ class ProxyObjectWrapper (object):
                 logger.debug('... lost, reconnecting (_getObj)')
                 self._connect()
                 # self._obj = self._create_func()
-        else:
+        elif time.time() - self._lastUsed >= self.PING_INTERVAL:
             self._ping()
+        self._lastUsed = time.time()
         return self._obj
 
+    def _recover(self, attr):
+        """
+        Called when a call to the wrapped service failed with
+        ObjectNotExistException or ConnectionLostException. Stateless
+        services are recreated, reconnecting if needed, and the named
+        method of the new service returned so that the call can be retried.
+        Stateful services can't be recovered since their state is lost.
+
+        :param attr:    Method name
+        :type attr:     String
+        :return:        Method of the recreated service or None
+        """
+
+        if self._obj is None or isinstance(
+                self._obj, omero.api.StatefulServiceInterfacePrx):
+            return None
+        logger.debug("... %s failed, recreating" %
+                     (self._func_str or self._service_name))
+        try:
+            try:
+                self._obj = self._create_func()
+            except Exception:
+                logger.debug("... lost, reconnecting (_recover)",
+                             exc_info=True)
+                if not self._connect():
+                    return None
+        except Exception:
+            logger.debug("... failed to recreate", exc_info=True)
+            return None
+        self._lastUsed = time.time()
+        return getattr(self._obj, attr)
+
     def _ping(self):  # pragma: no cover
         """
         For some reason, it seems that keepAlive doesn't, so every so often I
@@ -7263,19 +7829,21 @@ class _PixelsWrapper (BlitzObjectWrapper):
         for pi in result:
             yield PlaneInfoWrapper(self._conn, pi)
 
-    def getPlanes(self, zctList):
+    def getPlanes(self, zctList, prefetch=0):
         """
         Returns generator of numpy 2D planes from this set of pixels for a
         list of Z, C, T indexes.
 
         :param zctList:     A list of indexes: [(z,c,t), ]
+        :param prefetch:    Number of requests to keep in flight.
+                            See :meth:`getTiles`
         """
 
         zctTileList = []
         for zct in zctList:
             z, c, t = zct
             zctTileList.append((z, c, t, None))
-        return self.getTiles(zctTileList)
+        return self.getTiles(zctTileList, prefetch=prefetch)
 
     def getPlane(self, theZ=0, theC=0, theT=0):
         """
@@ -7287,17 +7855,28 @@ class _PixelsWrapper (BlitzObjectWrapper):
         planeList = list(self.getPlanes([(theZ, theC, theT)]))
         return planeList[0]
 
-    def getTiles(self, zctTileList):
+    def getTiles(self, zctTileList, prefetch=0):
         """
         Returns generator of numpy 2D planes from this set of pixels for a
         list of (Z, C, T, tile) where tile is (x, y, width, height) or None if
         you want the whole plane.
 
+        By default each tile is requested only once the previous one has
+        been returned. If prefetch is greater than 0, up to that many
+        requests are kept in flight using asynchronous (AMI) calls so that
+        the round trip latency of one tile overlaps with the others. Tiles
+        are still returned in the order requested and at most prefetch
+        tiles are held in memory.
+
+        If a cache has been enabled with :meth:`BlitzGateway.setPixelsCache`
+        tiles found there are not requested again. A copy of the cached
+        array is returned so that callers may modify it.
+
         :param zctrList:     A list of indexes: [(z,c,t, region), ]
+        :param prefetch:     Number of requests to keep in flight
         """
 
         import numpy
-        from struct import unpack
 
         pixelTypes = {PixelsTypeint8: ['b', numpy.int8],
                       PixelsTypeuint8: ['B', numpy.uint8],
@@ -7312,28 +7891,63 @@ class _PixelsWrapper (BlitzObjectWrapper):
         sizeY = self.sizeY
         pixelType = self.getPixelsType().value
         numpyType = pixelTypes[pixelType][1]
+        cache = self._conn.getPixelsCache()
+        updateEventId = self._getUpdateEventId()
+        if updateEventId is None:
+            cache = None
+
+        def decode(end, result, shape, key):
+            if end is None:
+                return result
+            plane = self._rawToArray(end(result), numpyType, shape)
+            if key is not None:
+                cache.put(key, plane.copy())
+            return plane
+
         exc = None
         try:
-            rawPixelsStore = self._prepareRawPixelsStore()
+            pending = deque()
             for zctTile in zctTileList:
                 z, c, t, tile = zctTile
+                key = None
+                if cache is not None:
+                    key = ("tile", self.getId(), updateEventId, z, c, t,
+                           tile is not None and tuple(tile) or None)
+                    cached = cache.get(key)
+                    if cached is not None:
+                        while pending and len(pending) >= prefetch:
+                            yield decode(*pending.popleft())
+                        if pending:
+                            pending.append((None, cached.copy(), None, None))
+                        else:
+                            yield cached.copy()
+                        continue
+                if rawPixelsStore is None:
+                    rawPixelsStore = self._prepareRawPixelsStore()
                 if tile is None:
-                    rawPlane = rawPixelsStore.getPlane(z, c, t)
+                    method = "getPlane"
+                    args = (z, c, t)
                     planeY = sizeY
                     planeX = sizeX
                 else:
                     x, y, width, height = tile
-                    rawPlane = rawPixelsStore.getTile(
-                        z, c, t, x, y, width, height)
+                    method = "getTile"
+                    args = (z, c, t, x, y, width, height)
                     planeY = height
                     planeX = width
-                # +str(sizeX*sizeY)+pythonTypes[pixelType]
-                convertType = '>%d%s' % (
-                    (planeY*planeX), pixelTypes[pixelType][0])
-                convertedPlane = unpack(convertType, rawPlane)
-                remappedPlane = numpy.array(convertedPlane, numpyType)
-                remappedPlane.resize(planeY, planeX)
-                yield remappedPlane
+                if prefetch > 0:
+                    while len(pending) >= prefetch:
+                        yield decode(*pending.popleft())
+                    begin = getattr(rawPixelsStore, "begin_" + method)
+                    end = getattr(rawPixelsStore, "end_" + method)
+                    pending.append(
+                        (end, begin(*args), (planeY, planeX), key))
+                else:
+                    rawPlane = getattr(rawPixelsStore, method)(*args)
+                    yield decode(
+                        lambda raw: raw, rawPlane, (planeY, planeX), key)
+            while pending:
+                yield decode(*pending.popleft())
         except Exception, e:
             logger.error(
                 "Failed to getPlane() or getTile() from rawPixelsStore",
@@ -7349,6 +7963,42 @@ class _PixelsWrapper (BlitzObjectWrapper):
         if exc is not None:
             raise exc
 
+    def _getUpdateEventId(self):
+        """
+        Returns the ID of the event that last updated these pixels, used
+        to key cached data, or None if it is not loaded. Note that this
+        event is not changed by writes to the RawPixelsStore, see
+        :meth:`BlitzGateway.setPixelsCache`.
+        """
+        details = self._obj.getDetails()
+        event = details is not None and details.getUpdateEvent() or None
+        if event is None or event.getId() is None:
+            return None
+        return event.getId().val
+
+    @staticmethod
+    def _rawToArray(rawPlane, numpyType, shape):
+        """
+        Interprets the big-endian bytes returned by the RawPixelsStore as a
+        numpy array of the given type and shape in native byte order.
+        The array is built directly over the buffer. If the buffer is
+        writable (e.g. a bytearray) it is byteswapped in place, otherwise
+        a single vectorized copy is made.
+
+        :param rawPlane:    Bytes from getPlane() or getTile()
+        :param numpyType:   Native numpy type of the pixels
+        :param shape:       Tuple of (sizeY, sizeX)
+        :return:            numpy array of numpyType
+        """
+        import numpy
+        bigEndian = numpy.dtype(numpyType).newbyteorder('>')
+        plane = numpy.frombuffer(rawPlane, dtype=bigEndian).reshape(shape)
+        if not plane.flags.writeable:
+            return plane.astype(numpyType)
+        if not plane.dtype.isnative:
+            plane.byteswap(True)
+        return plane.view(numpyType)
+
     def getTile(self, theZ=0, theC=0, theT=0, tile=None):
         """
         Gets the specified plane as a 2D numpy array by calling
@@ -7585,6 +8235,8 @@ class _ChannelWrapper (BlitzObjectWrapper):
     def setWindow(self, minval, maxval):
         self._re.setChannelWindow(
             self._idx, float(minval), float(maxval), self._conn.SERVICE_OPTS)
+        if self._img is not None:
+            self._img._onRenderingChange()
 
     def getWindowMin(self):
         """
@@ -7768,6 +8420,8 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
 
     _re = None
     _pd = None
+    _renderingKey = None
+    _renderingEdit = None
     _rm = {}
     _qf = {}
     _pixels = None
@@ -8215,7 +8869,7 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
         return self._obj.getPrimaryPixels().getId().val
 
     # @setsessiongroup
-    def _prepareTB(self, _r=False, rdefId=None):
+    def _prepareTB(self, _r=False, rdefId=None, tb=None):
         """
         Prepares Thumbnail Store for the image.
 
@@ -8224,6 +8878,9 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
         :type _r:           Boolean
         :param rdefId:      Rendering def ID to use for rendering thumbnail
         :type rdefId:       Long
+        :param tb:          Thumbnail Store to prepare. If None, the store
+                            of the connection is used
+        :type tb:           :class:`ProxyObjectWrapper`
         :return:            Thumbnail Store or None
         :rtype:             :class:`ProxyObjectWrapper`
         """
@@ -8231,7 +8888,8 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
         pid = self.getPrimaryPixels().id
         if rdefId is None:
             rdefId = self._getRDef()
-        tb = self._conn.createThumbnailStore()
+        if tb is None:
+            tb = self._conn.createThumbnailStore()
 
         ctx = self._conn.SERVICE_OPTS.copy()
         ctx.setOmeroGroup(self.details.group.id.val)
@@ -8377,58 +9035,7 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
             tb = self._prepareTB(rdefId=rdefId)
             if tb is None:
                 return None
-            if isinstance(size, IntType):
-                size = (size,)
-            if z is not None or t is not None:
-                if z is None:
-                    z = self.getDefaultZ()
-                if t is None:
-                    t = self.getDefaultT()
-                pos = z, t
-            else:
-                pos = None
-                # The following was commented out in the context of
-                # omero:#5191. Preparing the rendering engine has the
-                # potential to cause the raising of ConcurrencyException's
-                # which prevent OMERO.web from executing the thumbnail methods
-                # below and consequently showing "in-progress" thumbnails.
-                # Tue 24 May 2011 10:42:47 BST -- cxallan
-                # re = self._prepareRE()
-                # if re:
-                #     if z is None:
-                #         z = re.getDefaultZ()
-                #     if t is None:
-                #         t = re.getDefaultT()
-                #     pos = z,t
-                # else:
-                #     pos = None
-            if self.getProjection() != 'normal':
-                return self._getProjectedThumbnail(size, pos)
-            if len(size) == 1:
-                if pos is None:
-                    if direct:
-                        thumb = tb.getThumbnailByLongestSideDirect
-                    else:
-                        thumb = tb.getThumbnailByLongestSide
-                else:
-                    thumb = tb.getThumbnailForSectionByLongestSideDirect
-            else:
-                if pos is None:
-                    if direct:
-                        thumb = tb.getThumbnailDirect
-                    else:
-                        thumb = tb.getThumbnail
-                else:
-                    thumb = tb.getThumbnailForSectionDirect
-            args = map(lambda x: rint(x), size)
-            if pos is not None:
-                args = list(pos) + args
-            ctx = self._conn.SERVICE_OPTS.copy()
-            ctx.setOmeroGroup(self.details.group.id.val)
-            args += [ctx]
-            rv = thumb(*args)
-            self._thumbInProgress = tb.isInProgress()
-            return rv
+            return self._getThumbnail(tb, size, z, t, direct)
         except Exception:  # pragma: no cover
             logger.error(traceback.format_exc())
             return None
@@ -8436,6 +9043,69 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
             if tb is not None:
                 tb.close()
 
+    def _getThumbnail(self, tb, size, z, t, direct):
+        """
+        Renders the thumbnail with a prepared Thumbnail Store. See
+        :meth:`getThumbnail` for the parameters. Exceptions are raised
+        rather than logged.
+
+        :param tb:          Thumbnail Store prepared by :meth:`_prepareTB`
+        :rtype:             string
+        :return:            the rendered JPEG
+        """
+        if isinstance(size, IntType):
+            size = (size,)
+        if z is not None or t is not None:
+            if z is None:
+                z = self.getDefaultZ()
+            if t is None:
+                t = self.getDefaultT()
+            pos = z, t
+        else:
+            pos = None
+            # The following was commented out in the context of
+            # omero:#5191. Preparing the rendering engine has the
+            # potential to cause the raising of ConcurrencyException's
+            # which prevent OMERO.web from executing the thumbnail methods
+            # below and consequently showing "in-progress" thumbnails.
+            # Tue 24 May 2011 10:42:47 BST -- cxallan
+            # re = self._prepareRE()
+            # if re:
+            #     if z is None:
+            #         z = re.getDefaultZ()
+            #     if t is None:
+            #         t = re.getDefaultT()
+            #     pos = z,t
+            # else:
+            #     pos = None
+        if self.getProjection() != 'normal':
+            return self._getProjectedThumbnail(size, pos)
+        if len(size) == 1:
+            if pos is None:
+                if direct:
+                    thumb = tb.getThumbnailByLongestSideDirect
+                else:
+                    thumb = tb.getThumbnailByLongestSide
+            else:
+                thumb = tb.getThumbnailForSectionByLongestSideDirect
+        else:
+            if pos is None:
+                if direct:
+                    thumb = tb.getThumbnailDirect
+                else:
+                    thumb = tb.getThumbnail
+            else:
+                thumb = tb.getThumbnailForSectionDirect
+        args = map(lambda x: rint(x), size)
+        if pos is not None:
+            args = list(pos) + args
+        ctx = self._conn.SERVICE_OPTS.copy()
+        ctx.setOmeroGroup(self.details.group.id.val)
+        args += [ctx]
+        rv = thumb(*args)
+        self._thumbInProgress = tb.isInProgress()
+        return rv
+
     @assert_pixels
     def getPixelRange(self):
         """
@@ -8619,6 +9289,7 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
                 DeprecationWarning)
             if invertMaps is None:
                 invertMaps = reverseMaps
+        self._onRenderingChange()
         abs_channels = [abs(c) for c in channels]
         idx = 0     # index of windows/colors args above
         for c in range(len(self.getChannels(noRE=noRE))):
@@ -8730,14 +9401,6 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
 
         self._invertedAxis = inverted
 
-    LINE_PLOT_DTYPES = {
-        (4, True, True): 'f',  # signed float
-        (2, False, False): 'H',  # unsigned short
-        (2, False, True): 'h',  # signed short
-        (1, False, False): 'B',  # unsigned char
-        (1, False, True): 'b',  # signed char
-        }
-
     @assert_pixels
     def getHistogram(self, channels, binCount, globalRange=True,
                      theZ=0, theT=0):
@@ -8769,23 +9432,31 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
         finally:
             rp.close()
 
-    def getPixelLine(self, z, t, pos, axis, channels=None, range=None):
+    def getPixelLine(self, z, t, pos, axis, channels=None, range=None,
+                     asarray=False):
         """
         Grab a horizontal or vertical line from the image pixel data, for the
         specified channels (or 'active' if not specified) and using the
         specified range (or 1:1 relative to the image size). Axis may be 'h'
         or 'v', for horizontal or vertical respectively.
 
+        Several positions may be given as a list, e.g. to build a kymograph,
+        in which case all lines are read with a single RawPixelsStore.
+
         :param z:           Z index
         :param t:           T index
-        :param pos:         X or Y position
+        :param pos:         X or Y position, or list of positions
         :param axis:        Axis 'h' or 'v'
         :param channels:    map of {index: :class:`ChannelWrapper` }
         :param range:       height of scale
                             (use image height (or width) by default)
-        :return: rv         List of lists (one per channel)
+        :param asarray:     If True, return numpy arrays instead of lists
+        :return: rv         List of lists (one per channel), or a list of
+                            these (one per position) if pos is a list
         """
 
+        import numpy
+
         if not self._loadPixels():
             logger.debug("No pixels!")
             return None
@@ -8798,6 +9469,9 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
             range = axis == 'h' and self.getSizeY() or self.getSizeX()
         if not isinstance(channels, (TupleType, ListType)):
             channels = (channels,)
+        positions = pos
+        if not isinstance(pos, (TupleType, ListType)):
+            positions = (pos,)
         chw = map(
             lambda x: (x.getWindowMin(), x.getWindowMax()), self.getChannels())
         rv = []
@@ -8805,35 +9479,37 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
         rp = self._conn.createRawPixelsStore()
         try:
             rp.setPixelsId(pixels_id, True, self._conn.SERVICE_OPTS)
-            for c in channels:
-                bw = rp.getByteWidth()
-                key = self.LINE_PLOT_DTYPES.get(
-                    (bw, rp.isFloat(), rp.isSigned()), None)
-                if key is None:
-                    logger.error(
-                        "Unknown data type: " +
-                        str((bw, rp.isFloat(), rp.isSigned())))
-                plot = array.array(key, (axis == 'h' and
-                                   rp.getRow(pos, z, c, t) or
-                                   rp.getCol(pos, z, c, t)))
-                plot.byteswap()  # TODO: Assuming ours is a little endian
-                # system now move data into the windowMin..windowMax range
-                offset = -chw[c][0]
-                if offset != 0:
-                    plot = map(lambda x: x+offset, plot)
-                try:
-                    normalize = 1.0/chw[c][1]*(range-1)
-                except ZeroDivisionError:
-                    # This channel has zero sized window, no plot here
-                    continue
-                if normalize != 1.0:
-                    plot = map(lambda x: x*normalize, plot)
-                if isinstance(plot, array.array):
-                    plot = plot.tolist()
-                rv.append(plot)
-            return rv
+            bw = rp.getByteWidth()
+            # Pixel data is big-endian
+            dtype = numpy.dtype('>%s%d' % (
+                rp.isFloat() and 'f' or rp.isSigned() and 'i' or 'u', bw))
+            for p in positions:
+                lines = []
+                for c in channels:
+                    raw = (axis == 'h' and rp.getRow(p, z, c, t) or
+                           rp.getCol(p, z, c, t))
+                    plot = numpy.frombuffer(raw, dtype=dtype).astype(
+                        dtype.newbyteorder('='))
+                    # move data into the windowMin..windowMax range
+                    offset = -chw[c][0]
+                    if offset != 0:
+                        plot = plot + offset
+                    try:
+                        normalize = 1.0/chw[c][1]*(range-1)
+                    except ZeroDivisionError:
+                        # This channel has zero sized window, no plot here
+                        continue
+                    if normalize != 1.0:
+                        plot = plot * normalize
+                    if not asarray:
+                        plot = plot.tolist()
+                    lines.append(plot)
+                rv.append(lines)
         finally:
             rp.close()
+        if positions is pos:
+            return rv
+        return rv[0]
 
     def getRow(self, z, t, y, channels=None, range=None):
         """
@@ -8897,6 +9573,7 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
 
         rm = self.getRenderingModels()
         self._re.setModel(self._rm.get('greyscale', rm[0])._obj)
+        self._onRenderingChange()
 
     @assert_re()
     def setColorRenderingModel(self):
@@ -8906,6 +9583,7 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
 
         rm = self.getRenderingModels()
         self._re.setModel(self._rm.get('rgb', rm[0])._obj)
+        self._onRenderingChange()
 
     def isGreyscaleRenderingModel(self):
         """
@@ -8940,6 +9618,7 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
         # If we want to invert, add it to the channel (again)
         if inverted:
             self._re.addCodomainMapToChannel(r, channelIndex)
+        self._onRenderingChange()
 
     def getFamilies(self):
         """
@@ -8965,6 +9644,7 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
         """
         f = self.getFamilies().get(family)
         self._re.setQuantizationMap(channelIndex, f._obj, coefficient, False)
+        self._onRenderingChange()
 
     @assert_re()
     def setQuantizationMaps(self, maps):
@@ -9125,6 +9805,19 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
         :type compression:      Float
         """
 
+        cache = self._conn.getPixelsCache()
+        key = None
+        if cache is not None:
+            pixels = self.getPrimaryPixels()
+            updateEventId = pixels._getUpdateEventId()
+            if updateEventId is not None:
+                key = ("jpeg", pixels.getId(), updateEventId, z, t,
+                       (x, y, width, height), level, compression,
+                       self._getRenderingKey())
+                rv = cache.get(key)
+                if rv is not None:
+                    return rv
+
         self._pd.z = long(z)
         self._pd.t = long(t)
 
@@ -9146,6 +9839,8 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
                     self._closeRE()
                     return self.renderJpeg(z, t, None)
             rv = self._re.renderCompressed(self._pd, self._conn.SERVICE_OPTS)
+            if key is not None:
+                cache.put(key, rv)
             return rv
         except (omero.ApiUsageException, omero.InternalException):
             logger.debug('On renderJpegRegion', exc_info=True)
@@ -9167,6 +9862,43 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
             logger.debug(e)
         finally:
             self._re = None  # This should be the ONLY location to null _re!
+            self._renderingKey = None
+            self._renderingEdit = None
+
+    def _onRenderingChange(self):
+        """
+        Records that the settings of the rendering engine no longer match
+        the saved rendering def. Called by the methods of this wrapper and
+        of :class:`ChannelWrapper` that change the rendering settings.
+        """
+        self._renderingEdit = next(_renderingEdits)
+
+    def _getRenderingKey(self):
+        """
+        Returns a tuple describing the current state of the rendering
+        engine, used to key rendered images in the
+        :meth:`BlitzGateway.getPixelsCache`. Rather than reading every
+        channel setting back from the rendering engine, the key is the
+        rendering def ID and the update event of its saved version,
+        looked up once per rendering engine, and a token unique to this
+        wrapper if its settings have been changed without being saved.
+
+        :return:    Tuple of the rendering def ID, update event ID and
+                    unsaved changes token
+        :rtype:     Tuple
+        """
+        if self._renderingKey is None:
+            ctx = self._conn.SERVICE_OPTS.copy()
+            ctx.setOmeroGroup(self.details.group.id.val)
+            rdid = self._re.getRenderingDefId(ctx)
+            params = omero.sys.ParametersI()
+            params.addId(rdid)
+            rows = self._conn.getQueryService().projection(
+                "select r.details.updateEvent.id from RenderingDef r "
+                "where r.id = :id", params, ctx)
+            updateEventId = rows and unwrap(rows[0][0]) or None
+            self._renderingKey = (rdid, updateEventId)
+        return self._renderingKey + (self._renderingEdit,)
 
     @assert_re()
     def renderJpeg(self, z=None, t=None, compression=0.9):
@@ -9963,6 +10695,8 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
         ctx = self._conn.SERVICE_OPTS.copy()
         ctx.setOmeroGroup(self.details.group.id.val)
         self._re.saveCurrentSettings(ctx)
+        self._renderingKey = None
+        self._renderingEdit = None
         return True
 
     @assert_re()
@@ -9981,6 +10715,11 @@ class _ImageWrapper (BlitzObjectWrapper, OmeroRestrictionWrapper):
         if not self.canAnnotate():
             save = False
         self._re.resetDefaultSettings(save, ctx)
+        self._renderingKey = None
+        if save:
+            self._renderingEdit = None
+        else:
+            self._onRenderingChange()
         return True
 
     def countArchivedFiles(self):
@@ -10819,6 +11558,12 @@ InstrumentWrapper = _InstrumentWrapper
 
 KNOWN_WRAPPERS = {}
 
+# Collections loaded by the queries of the wrappers above, see buildQuery
+FETCHED_COLLECTIONS = frozenset((
+    "annotationLinks", "channels", "groupExperimenterMap", "images",
+    "pixels", "screenLinks", "shapes", "thumbnails", "usedFiles",
+    "wellSamples"))
+
 
 def refreshWrappers():
     """
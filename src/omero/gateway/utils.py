@@ -23,8 +23,13 @@
 # Version: 1.0
 #
 
+import os
 import logging
 import json
+import hashlib
+import threading
+
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -211,3 +216,184 @@ def propertiesToDict(m, prefix=None):
         except:
             d[items[-1]] = value
     return nested_dict
+
+
+class PixelsCache(object):
+
+    """
+    Least-recently-used cache of decoded pixel data (numpy arrays) and
+    rendered images (strings), bounded by the number of bytes held.
+
+    Entries evicted from memory are written to ``directory`` if one is
+    given, up to ``maxDiskBytes``, and promoted back into memory when they
+    are requested again. Keys must be hashable and have a stable repr,
+    e.g. tuples of ints and strings.
+
+    The :attr:`hits` and :attr:`misses` counters (see :meth:`getStats`)
+    can be used to tune the size of the cache.
+    """
+
+    def __init__(self, maxBytes=64 * 1024 * 1024, directory=None,
+                 maxDiskBytes=None):
+        """
+        :param maxBytes:        Maximum number of bytes held in memory
+        :param directory:       Optional directory to spill evicted
+                                entries to
+        :param maxDiskBytes:    Maximum number of bytes held in directory.
+                                Defaults to 4 times maxBytes.
+        """
+        if maxDiskBytes is None:
+            maxDiskBytes = 4 * maxBytes
+        self.maxBytes = maxBytes
+        self.maxDiskBytes = maxDiskBytes
+        self.directory = directory
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.RLock()
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()
+        self._bytes = 0
+        self._diskBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _sizeOf(value):
+        nbytes = getattr(value, "nbytes", None)
+        if nbytes is not None:
+            return nbytes
+        return len(value)
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for key, or default if there is none.
+        """
+        with self._lock:
+            if key in self._memory:
+                value, size = self._memory.pop(key)
+                self._memory[key] = (value, size)
+                self.hits += 1
+                return value
+            if key in self._disk:
+                value = self._readDisk(key)
+                if value is not None:
+                    self.hits += 1
+                    self._put(key, value)
+                    return value
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """
+        Caches value under key, evicting the least recently used entries
+        if needed. Values larger than maxBytes are not cached.
+        """
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        self._discard(key)
+        size = self._sizeOf(value)
+        if size > self.maxBytes:
+            return
+        self._memory[key] = (value, size)
+        self._bytes += size
+        while self._bytes > self.maxBytes:
+            oldKey, (oldValue, oldSize) = self._memory.popitem(last=False)
+            self._bytes -= oldSize
+            self.evictions += 1
+            self._writeDisk(oldKey, oldValue, oldSize)
+
+    def _discard(self, key):
+        if key in self._memory:
+            value, size = self._memory.pop(key)
+            self._bytes -= size
+        if key in self._disk:
+            self._removeDisk(key)
+
+    def _writeDisk(self, key, value, size):
+        if self.directory is None or size > self.maxDiskBytes:
+            return
+        while self._disk and self._diskBytes + size > self.maxDiskBytes:
+            self._removeDisk(next(iter(self._disk)))
+        try:
+            f = open(self._path(key), "wb")
+            try:
+                if hasattr(value, "nbytes"):
+                    import numpy
+                    numpy.save(f, value)
+                else:
+                    f.write(value)
+            finally:
+                f.close()
+        except (IOError, OSError):
+            logger.warn("Failed to spill %r to %s", key, self.directory,
+                        exc_info=True)
+            return
+        self._disk[key] = (hasattr(value, "nbytes"), size)
+        self._diskBytes += size
+
+    def _readDisk(self, key):
+        isArray, size = self._disk[key]
+        try:
+            f = open(self._path(key), "rb")
+            try:
+                if isArray:
+                    import numpy
+                    value = numpy.load(f)
+                else:
+                    value = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            logger.warn("Failed to read %r from %s", key, self.directory,
+                        exc_info=True)
+            value = None
+        self._removeDisk(key)
+        return value
+
+    def _removeDisk(self, key):
+        isArray, size = self._disk.pop(key)
+        self._diskBytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        """
+        Removes all entries, including those spilled to disk.
+        The counters are not reset.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._bytes = 0
+            for key in list(self._disk):
+                self._removeDisk(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._memory or key in self._disk
+
+    def __len__(self):
+        with self._lock:
+            return len(self._memory) + len(self._disk)
+
+    def getStats(self):
+        """
+        Returns a dict of the hit, miss and eviction counters along with
+        the number of entries and bytes held in memory and on disk.
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self._memory),
+                    "bytes": self._bytes,
+                    "diskEntries": len(self._disk),
+                    "diskBytes": self._diskBytes}
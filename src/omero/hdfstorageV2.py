@@ -6,6 +6,7 @@
 # Use is subject to license terms supplied in LICENSE.txt
 #
 
+import re
 import time
 import numpy
 import logging
@@ -32,6 +33,21 @@ tables = __import__("tables")  # Pytables
 
 VERSION = '2'
 
+# Aggregates supported by HdfStorage.aggregate in addition to
+# histograms and quantiles
+AGGREGATES = ("count", "sum", "min", "max", "mean", "std")
+
+# Number of rows processed per pass when aggregating
+CHUNKSIZE = 1 << 18
+
+# PyTables index kinds accepted by HdfStorage.create_index. A "full"
+# index with optlevel 9 is a completely sorted index (CSI)
+INDEX_KINDS = ("ultralight", "light", "medium", "full")
+
+# Server property (or per-call context key) which enables returning
+# numeric columns as numpy arrays, see AbstractColumn.setndarray
+NDARRAY = "omero.tables.ndarray"
+
 
 def internal_attr(s):
     """
@@ -40,6 +56,57 @@ def internal_attr(s):
     return s.startswith('__')
 
 
+def columns2records(arrays, dtypes, size):
+    """
+    Converts column-wise data into a record array suitable for
+    Table.append(). Rather than building one Python tuple per row,
+    the record buffer is preallocated and filled field by field so
+    that the cost scales with the number of bytes being written.
+    Values which are already numpy arrays are copied with a single
+    vectorized cast.
+    """
+    if size is None:
+        size = 0
+    records = numpy.empty(size, dtype=dtypes)
+    for name, values in zip(records.dtype.names, arrays):
+        if not isinstance(values, numpy.ndarray):
+            values = numpy.asarray(values, dtype=records.dtype[name].base)
+        records[name] = values
+    return records
+
+
+def row_runs(rowNumbers):
+    """
+    Groups row numbers into runs of consecutive rows. Returns the
+    permutation which sorts rowNumbers (stable, so that the last of
+    any duplicate rows still wins) and a list of (start, stop, lo, hi)
+    tuples where rows [start, stop) receive the sorted values [lo, hi).
+    """
+    rows = numpy.asarray(rowNumbers, dtype=numpy.int64)
+    order = numpy.argsort(rows, kind="mergesort")
+    rows = rows[order]
+    # Indexes at which a new run starts
+    breaks = numpy.flatnonzero(numpy.diff(rows) != 1) + 1
+    bounds = [0] + breaks.tolist() + [len(rows)]
+    runs = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if lo < hi:
+            runs.append((int(rows[lo]), int(rows[hi - 1]) + 1, lo, hi))
+    return order, runs
+
+
+def bad_condition(condition, variables, err):
+    """
+    Creates the exception raised when PyTables cannot evaluate a
+    condition. Must be called from within the except block.
+    """
+    aue = omero.ApiUsageException()
+    aue.message = "Bad condition: %s, %s" % (condition, variables)
+    aue.serverStackTrace = "".join(traceback.format_exc())
+    aue.serverExceptionClass = str(err.__class__.__name__)
+    return aue
+
+
 def stamped(func, update=False):
     """
     Decorator which takes the first argument after "self" and compares
@@ -93,11 +160,17 @@ class HdfList(object):
     This also holds a global lock for all HDF5 calls since libhdf5 is usually
     compiled without --enable-threadsafe, see
     https://trac.openmicroscopy.org/ome/ticket/10464
+
+    If libhdf5 is known to be thread-safe, threadsafe can be set to True
+    in which case files which are opened read-only are given their own
+    lock so that reads of different tables can proceed in parallel.
+    Writable files continue to share the global lock.
     """
 
     def __init__(self):
         self.logger = logging.getLogger("omero.tables.HdfList")
         self._lock = threading.RLock()
+        self.threadsafe = False
         self.__filenos = {}
         self.__paths = {}
 
@@ -145,8 +218,21 @@ class HdfList(object):
         try:
             return self.__paths[hdfpath]
         except KeyError:
+            lock = self._lock
+            if self.threadsafe and self.__readable_only(hdfpath, read_only):
+                lock = threading.RLock()
             # Adds itself to the global list
-            return HdfStorage(hdfpath, self._lock, read_only=read_only)
+            return HdfStorage(hdfpath, lock, read_only=read_only)
+
+    def __readable_only(self, hdfpath, read_only):
+        """
+        Whether the file will be opened read-only, either because it
+        was requested or because it is not writable (see openfile)
+        """
+        if read_only:
+            return True
+        p = path(hdfpath)
+        return p.exists() and p.size > 0 and not p.access(W_OK)
 
     @locked
     def remove(self, hdfpath, hdffile):
@@ -185,6 +271,8 @@ class HdfStorage(object):
 
         self._lock = hdf5lock
         self._stamp = time.time()
+        # Time of the last append or update, see read_batch
+        self._written = 0
 
         # These are what we'd like to have
         self.__mea = None
@@ -260,6 +348,27 @@ class HdfStorage(object):
     def __length(self):
         return self.__mea.nrows
 
+    def __varstrings(self):
+        """
+        Names of the dictionary-encoded StringColumns, whose stored
+        values are integer codes rather than the strings themselves
+        """
+        rv = set()
+        for name, t in zip(self.__mea.colnames, self.__types):
+            if t == "::omero::grid::StringColumn" and \
+                    self.__mea.coldtypes[name].kind != "S":
+                rv.add(name)
+        return rv
+
+    def __stringcheck(self, condition):
+        if not condition:
+            return
+        for name in self.__varstrings():
+            if re.search(r"\b%s\b" % re.escape(name), condition):
+                raise omero.ApiUsageException(
+                    None, None, "Conditions are not supported on variable"
+                    " length string column: %s" % name)
+
     def __sizecheck(self, colNumbers, rowNumbers):
         if colNumbers is not None:
             if len(colNumbers) > 0:
@@ -285,6 +394,21 @@ class HdfStorage(object):
                 raise omero.ApiUsageException(
                     None, None, "Rows not specified: %s" % rowNumbers)
 
+    def __ndarray(self, current):
+        """
+        Checks whether numeric columns should be passed to Ice as numpy
+        arrays. The call context takes precedence over the server
+        configuration.
+        """
+        value = None
+        ctx = getattr(current, "ctx", None)
+        if ctx:
+            value = ctx.get(NDARRAY)
+        if value is None:
+            props = current.adapter.getCommunicator().getProperties()
+            value = props.getPropertyWithDefault(NDARRAY, "false")
+        return value.lower() == "true"
+
     def __getversion(self):
         """
         In OMERO.tables v2 the version attribute name was changed to __version
@@ -322,9 +446,16 @@ class HdfStorage(object):
 
     @locked
     @modifies
-    def initialize(self, cols, metadata=None):
+    def initialize(self, cols, metadata=None, complib=None, complevel=5,
+                   shuffle=True, chunkshape=None, expectedrows=None):
         """
-
+        Creates the table for the given columns. If complib (one of
+        tables.filters.all_complibs, e.g. "zlib" or "blosc") is given,
+        data is compressed at complevel, optionally with the shuffle
+        filter. chunkshape (in rows) and expectedrows are passed to
+        PyTables; by default the chunk shape is chosen from expectedrows.
+        Any of these choices which are set are recorded as internal
+        metadata attributes.
         """
         if metadata is None:
             metadata = {}
@@ -343,10 +474,32 @@ class HdfStorage(object):
                 raise omero.ApiUsageException(
                     None, None, "Reserved column name: %s" % c.name)
 
+        options = {}
+        internal = {}
+        if complib:
+            if complib not in tables.filters.all_complibs:
+                raise omero.ApiUsageException(
+                    None, None, "Unknown compression library: %s" % complib)
+            if complevel < 1 or complevel > 9:
+                raise omero.ApiUsageException(
+                    None, None, "Compression level must be 1-9: %s"
+                    % complevel)
+            options["filters"] = tables.Filters(
+                complevel=complevel, complib=complib, shuffle=shuffle)
+            internal['__complib'] = complib
+            internal['__complevel'] = complevel
+            internal['__shuffle'] = int(bool(shuffle))
+        if chunkshape:
+            options["chunkshape"] = (chunkshape,)
+            internal['__chunkshape'] = chunkshape
+        if expectedrows:
+            options["expectedrows"] = expectedrows
+            internal['__expectedrows'] = expectedrows
+
         self.__definition = columns2definition(cols)
         self.__ome = self.__hdf_file.create_group("/", "OME")
         self.__mea = self.__hdf_file.create_table(
-            self.__ome, "Measurements", self.__definition)
+            self.__ome, "Measurements", self.__definition, **options)
 
         self.__types = [x.ice_staticId() for x in cols]
         self.__descriptions = [
@@ -358,6 +511,7 @@ class HdfStorage(object):
         md = {}
         if metadata:
             md = metadata.copy()
+        md.update(internal)
         md['__version'] = VERSION
         md['__initialized'] = time.time()
         self.add_meta_map(md, replace=True, init=True)
@@ -405,6 +559,7 @@ class HdfStorage(object):
         types = self.__types
         names = self.__mea.colnames
         descs = self.__descriptions
+        ndarray = self.__ndarray(current)
         cols = []
         for i in range(len(types)):
             t = types[i]
@@ -416,6 +571,7 @@ class HdfStorage(object):
                 col.description = d
                 col.setsize(size)
                 col.settable(self.__mea)
+                col.setndarray(ndarray)
                 cols.append(col)
             except:
                 msg = traceback.format_exc()
@@ -480,6 +636,71 @@ class HdfStorage(object):
             # convert it to a numpy type or keep it as a native Python type
             attr[k] = unwrap(v)
 
+    @locked
+    def get_indexes(self):
+        """
+        Returns a map from the names of indexed columns to a tuple
+        of their index kind and optimization level.
+        """
+        self.__initcheck()
+        rv = {}
+        for name in self.__mea.colnames:
+            col = self.__mea.cols._f_col(name)
+            if col.is_indexed:
+                rv[name] = (col.index.kind, col.index.optlevel)
+        return rv
+
+    @locked
+    @modifies
+    def create_index(self, colNumber, kind="medium", optlevel=6):
+        """
+        Creates a persistent index on the given column so that conditions
+        passed to getWhereList can avoid a full table scan. Any existing
+        index on the column is replaced. Indexes are kept up to date on
+        append and update and are recorded in /OME/ColumnIndexes.
+        """
+        self.__initcheck()
+        self.__sizecheck([colNumber], None)
+        if kind not in INDEX_KINDS:
+            raise omero.ApiUsageException(
+                None, None, "Unknown index kind: %s" % kind)
+        if optlevel < 0 or optlevel > 9:
+            raise omero.ApiUsageException(
+                None, None, "Index optlevel must be 0-9: %s" % optlevel)
+        name = self.__mea.colnames[colNumber]
+        col = self.__mea.cols._f_col(name)
+        if col.dtype.shape or col.dtype.kind not in "biufS":
+            raise omero.ApiUsageException(
+                None, None, "Column cannot be indexed: %s" % name)
+        if col.is_indexed:
+            col.remove_index()
+        col.create_index(optlevel=optlevel, kind=kind)
+        self.__save_indexes()
+
+    @locked
+    @modifies
+    def remove_index(self, colNumber):
+        self.__initcheck()
+        self.__sizecheck([colNumber], None)
+        col = self.__mea.cols._f_col(self.__mea.colnames[colNumber])
+        if col.is_indexed:
+            col.remove_index()
+        self.__save_indexes()
+
+    def __save_indexes(self):
+        """
+        Records the names of indexed columns beside ColumnTypes and
+        ColumnDescriptions.
+        """
+        names = [n for n in self.__mea.colnames
+                 if self.__mea.cols._f_col(n).is_indexed]
+        try:
+            self.__hdf_file.remove_node(self.__ome, "ColumnIndexes")
+        except tables.NoSuchNodeError:
+            pass
+        if names:
+            self.__hdf_file.create_array(self.__ome, "ColumnIndexes", names)
+
     @locked
     @modifies
     def append(self, cols):
@@ -489,6 +710,7 @@ class HdfStorage(object):
         dtypes = []
         sz = None
         for col in cols:
+            col.settable(self.__mea)
             if sz is None:
                 sz = col.getsize()
             else:
@@ -500,9 +722,10 @@ class HdfStorage(object):
             col.append(self.__mea)  # Potential corruption !!!
 
         # Convert column-wise data to row-wise records
-        records = numpy.array(zip(*arrays), dtype=dtypes)
+        records = columns2records(arrays, dtypes, sz)
 
         self.__mea.append(records)
+        self._written = time.time()
 
     #
     # Stamped methods
@@ -513,23 +736,187 @@ class HdfStorage(object):
     def update(self, stamp, data):
         self.__initcheck()
         if data:
-            for i, rn in enumerate(data.rowNumbers):
+            if data.rowNumbers:
+                self.__sizecheck(None, data.rowNumbers)
+            # Rows appended to an indexed table are indexed incrementally
+            # on flush, but each modification would reindex the whole
+            # column. Defer this until all values have been written.
+            indexed = self.__mea.indexed
+            if indexed:
+                self.__mea.autoindex = False
+            try:
+                # One write per run of consecutive rows per column
+                order, runs = row_runs(data.rowNumbers)
                 for col in data.columns:
-                    getattr(self.__mea.cols, col.name)[rn] = col.values[i]
+                    col.settable(self.__mea)
+                    values = numpy.asarray(col.tostorage())[order]
+                    for start, stop, lo, hi in runs:
+                        self.__mea.modify_column(
+                            start, stop, column=values[lo:hi],
+                            colname=col.name)
+            finally:
+                self._written = time.time()
+                if indexed:
+                    self.__mea.autoindex = True
+                    self.__mea.reindex_dirty()
 
     @stamped
     def getWhereList(self, stamp, condition, variables, unused,
                      start, stop, step):
         self.__initcheck()
+        self.__stringcheck(condition)
         try:
             return self.__mea.get_where_list(condition, variables, None,
                                              start, stop, step).tolist()
         except (NameError, SyntaxError, TypeError, ValueError), err:
-            aue = omero.ApiUsageException()
-            aue.message = "Bad condition: %s, %s" % (condition, variables)
-            aue.serverStackTrace = "".join(traceback.format_exc())
-            aue.serverExceptionClass = str(err.__class__.__name__)
-            raise aue
+            raise bad_condition(condition, variables, err)
+
+    @stamped
+    def aggregate(self, stamp, colNumber, aggregates, condition, variables,
+                  start, stop, bins=None, binrange=None, quantiles=None):
+        """
+        Computes summary statistics of a single numeric column without
+        returning its values. The column is processed in chunks of
+        CHUNKSIZE rows, optionally restricted to the rows matching a
+        getWhereList-style condition.
+
+        aggregates is a list of names from AGGREGATES. If bins is
+        given, a histogram with that number of fixed-width bins over
+        binrange (or the column's min and max) is added. If quantiles
+        is a list of fractions between 0 and 1, the matching quantiles
+        are added; this requires holding the selected values of the
+        column in memory.
+        """
+        self.__initcheck()
+        self.__sizecheck([colNumber], None)
+        for a in aggregates:
+            if a not in AGGREGATES:
+                raise omero.ApiUsageException(
+                    None, None, "Unknown aggregate: %s" % a)
+        name = self.__mea.colnames[colNumber]
+        dtype = self.__mea.coldtypes[name]
+        if dtype.kind not in "biuf" or dtype.shape or \
+                name in self.__varstrings():
+            raise omero.ApiUsageException(
+                None, None, "Column is not numeric: %s" % name)
+        if bins is not None and bins < 1:
+            raise omero.ApiUsageException(
+                None, None, "Number of bins must be > 0: %s" % bins)
+        if quantiles:
+            for q in quantiles:
+                if q < 0 or q > 1:
+                    raise omero.ApiUsageException(
+                        None, None, "Quantile must be in [0, 1]: %s" % q)
+        self.__stringcheck(condition)
+
+        nrows = self.__length()
+        if start is None:
+            start = 0
+        if stop is None or stop > nrows:
+            stop = nrows
+
+        count = 0
+        total = 0
+        mean = 0.0
+        m2 = 0.0
+        minimum = None
+        maximum = None
+        selected = []
+        hist = None
+        edges = None
+        if bins and binrange is not None:
+            hist = numpy.zeros(bins, dtype=numpy.int64)
+
+        try:
+            for values in self._chunks(
+                    name, condition, variables, start, stop):
+                n = len(values)
+                if not n:
+                    continue
+                # Combine per-chunk moments (Chan et al.)
+                f = values.astype(numpy.float64)
+                cmean = f.mean()
+                cm2 = ((f - cmean) ** 2).sum()
+                delta = cmean - mean
+                both = count + n
+                mean += delta * n / both
+                m2 += cm2 + delta ** 2 * count * n / both
+                count = both
+                total += values.sum().item()
+                cmin = values.min().item()
+                cmax = values.max().item()
+                if minimum is None or cmin < minimum:
+                    minimum = cmin
+                if maximum is None or cmax > maximum:
+                    maximum = cmax
+                if quantiles:
+                    selected.append(values)
+                if hist is not None:
+                    hist += numpy.histogram(f, bins, binrange)[0]
+
+            if bins and hist is None and count:
+                # Range depends on the first pass
+                if minimum == maximum:
+                    binrange = (minimum - 0.5, maximum + 0.5)
+                else:
+                    binrange = (minimum, maximum)
+                hist = numpy.zeros(bins, dtype=numpy.int64)
+                for values in self._chunks(
+                        name, condition, variables, start, stop):
+                    hist += numpy.histogram(
+                        values.astype(numpy.float64), bins, binrange)[0]
+        except (NameError, SyntaxError, TypeError, ValueError), err:
+            raise bad_condition(condition, variables, err)
+
+        results = {
+            "count": long(count),
+            "sum": total,
+            "min": minimum,
+            "max": maximum,
+            "mean": None,
+            "std": None,
+        }
+        if count:
+            results["mean"] = mean
+            results["std"] = (m2 / count) ** 0.5
+
+        rv = {}
+        for a in aggregates:
+            rv[a] = results[a]
+        if bins:
+            if hist is None:
+                hist = numpy.zeros(bins, dtype=numpy.int64)
+                edges = []
+            else:
+                edges = numpy.linspace(
+                    binrange[0], binrange[1], bins + 1).tolist()
+            rv["histogram"] = hist.tolist()
+            rv["bins"] = edges
+        if quantiles:
+            if selected:
+                rv["quantiles"] = numpy.percentile(
+                    numpy.concatenate(selected),
+                    [100.0 * q for q in quantiles]).tolist()
+            else:
+                rv["quantiles"] = [None] * len(quantiles)
+        return rv
+
+    def _chunks(self, name, condition, variables, start, stop):
+        """
+        Yields the values of the named column in blocks of at most
+        CHUNKSIZE rows between start and stop. If a condition is given,
+        only the values of matching rows are returned.
+        """
+        for lo in xrange(start, stop, CHUNKSIZE):
+            hi = min(lo + CHUNKSIZE, stop)
+            if condition:
+                coords = self.__mea.get_where_list(
+                    condition, variables, None, lo, hi)
+                if not len(coords):
+                    continue
+                yield self.__mea.read_coordinates(coords, field=name)
+            else:
+                yield self.__mea.read(lo, hi, field=name)
 
     def _as_data(self, cols, rowNumbers):
         """
@@ -557,12 +944,23 @@ class HdfStorage(object):
         self.__sizecheck(colNumbers, None)
         cols = self.cols(None, current)
 
-        rows = self._getrows(start, stop)
+        names = [cols[i].name for i in colNumbers]
+        rows = self._getrows(start, stop, names)
         rv, l = self._rowstocols(rows, colNumbers, cols)
         return self._as_data(rv, range(start, start + l))
 
-    def _getrows(self, start, stop):
-        return self.__mea.read(start, stop)
+    def _getrows(self, start, stop, names=None):
+        """
+        Reads the rows between start and stop. If names is passed, only
+        those fields are loaded and a map from name to values is returned
+        rather than a record array of all columns.
+        """
+        if names is None:
+            return self.__mea.read(start, stop)
+        rows = {}
+        for name in names:
+            rows[name] = self.__mea.read(start, stop, field=name)
+        return rows
 
     def _rowstocols(self, rows, colNumbers, cols):
         l = 0
@@ -575,6 +973,101 @@ class HdfStorage(object):
                 l = len(col.values)
         return rv, l
 
+    @locked
+    def rowsize(self, colNumbers):
+        """
+        Returns an estimate of the number of bytes needed to store one
+        row of the given columns. Columns whose values are held in a
+        separate variable length array (variable length strings and
+        masks) add the mean size of an entry of that array.
+        """
+        self.__initcheck()
+        self.__sizecheck(colNumbers, None)
+        names = self.__mea.colnames
+        varstrings = self.__varstrings()
+        tblname = self.__mea._v_name
+        rv = 0
+        for i in colNumbers:
+            name = names[i]
+            rv += self.__mea.coldtypes[name].itemsize
+            if name in varstrings:
+                rv += self.__vlsize("%s_%s_strings" % (tblname, name))
+            elif self.__types[i] == "::omero::grid::MaskColumn":
+                rv += self.__vlsize("%s_masks" % tblname)
+        return rv
+
+    def __vlsize(self, nodename):
+        """
+        Mean number of bytes per entry of the variable length array
+        stored beside the table, or 0 if it is missing or empty
+        """
+        try:
+            vlarray = getattr(self.__mea._v_parent, nodename)
+        except tables.NoSuchNodeError:
+            return 0
+        if not vlarray.nrows:
+            return 0
+        nrows = vlarray.nrows
+        return (vlarray.size_in_memory + nrows - 1) // nrows
+
+    @stamped
+    def read_batch(self, stamp, colNumbers, start, nrows,
+                   condition, variables, current):
+        """
+        Reads at most nrows rows of the given columns beginning at row
+        start, optionally only those rows matching condition. Returns
+        the data (or None if no rows remain) and the row at which the
+        next batch should begin.
+
+        In addition to the usual stamp check, raises an
+        omero.OptimisticLockException if rows have been appended or
+        updated since stamp so that a batched reader never combines
+        data from before and after a write.
+        """
+        self.__initcheck()
+        self.__sizecheck(colNumbers, None)
+        self.__stringcheck(condition)
+        if stamp < self._written:
+            raise omero.OptimisticLockException(
+                None, None, "Resource modified by another thread")
+
+        length = self.__length()
+        if not condition:
+            stop = min(start + nrows, length)
+            if start >= stop:
+                return None, length
+            cols = self.cols(None, current)
+            names = [cols[i].name for i in colNumbers]
+            rows = self._getrows(start, stop, names)
+            rv, l = self._rowstocols(rows, colNumbers, cols)
+            return self._as_data(rv, range(start, stop)), stop
+
+        coords = []
+        pos = start
+        try:
+            while len(coords) < nrows and pos < length:
+                hi = min(pos + CHUNKSIZE, length)
+                found = self.__mea.get_where_list(
+                    condition, variables, None, pos, hi).tolist()
+                needed = nrows - len(coords)
+                if len(found) > needed:
+                    found = found[:needed]
+                    hi = found[-1] + 1
+                coords.extend(found)
+                pos = hi
+        except (NameError, SyntaxError, TypeError, ValueError), err:
+            raise bad_condition(condition, variables, err)
+
+        if not coords:
+            return None, length
+        cols = self.cols(None, current)
+        rv = []
+        for i in colNumbers:
+            col = cols[i]
+            col.readCoordinates(self.__mea, coords)
+            rv.append(col)
+        return self._as_data(rv, coords), pos
+
     @stamped
     def slice(self, stamp, colNumbers, rowNumbers, current):
         self.__initcheck()
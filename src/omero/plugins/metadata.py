@@ -212,6 +212,9 @@ class MetadataControl(BaseControl):
         populateroi.add_argument(
             "--measurement", type=int, default=None,
             help="Index of the measurement to populate. By default, all")
+        populateroi.add_argument(
+            "--threads", type=int, default=1,
+            help="Number of threads saving ROI in parallel (default: 1)")
 
         pixelsize.add_argument(
             "--x", type=float, default=None, help="Physical pixel size X")
@@ -546,6 +549,7 @@ class MetadataControl(BaseControl):
             populate_roi.log.setLevel(logging.DEBUG)
         else:
             populate_roi.log.setLevel(logging.INFO)
+        populate_roi.set_thread_count(args.threads)
         factory = populate_roi.PlateAnalysisCtxFactory(client.sf)
         ctx = factory.get_analysis_ctx(md.get_id())
         count = ctx.get_measurement_count()
@@ -554,17 +558,15 @@ class MetadataControl(BaseControl):
         if args.measurement is not None and args.measurement >= count:
             self.ctx.die(
                 100, "Invalid measurement index: %d" % args.measurement)
-        for i in range(count):
-            if args.dry_run:
+        if args.dry_run:
+            for i in range(count):
                 self.ctx.out(
                     "Measurement %d has %s result files." % (
                         i, ctx.get_result_file_count(i)))
-            else:
-                if args.measurement is not None:
-                    if args.measurement != i:
-                        continue
-                meas = ctx.get_measurement_ctx(i)
-                meas.parse_and_populate()
+        elif args.measurement is not None:
+            ctx.get_measurement_ctx(args.measurement).parse_and_populate()
+        else:
+            ctx.parse_and_populate()
 
     def pixelsize(self, args):
         "Set physical pixel size"
@@ -10,6 +10,7 @@ import Ice
 import time
 import traceback
 
+from collections import OrderedDict
 from path import path
 
 import omero  # Do we need both??
@@ -20,6 +21,7 @@ import omero.callbacks
 from omero import LockTimeout
 from omero.rtypes import rstring
 from omero.rtypes import unwrap
+from omero.rtypes import wrap
 from omero.util.decorators import remoted, perf
 
 
@@ -29,6 +31,11 @@ tables = __import__("tables")  # Pytables
 VERSION = '2'
 RETRIES = 20
 
+# Cursors kept open per table. Beyond this the least recently used
+# cursor is closed, as is any cursor unused for CURSOR_TIMEOUT seconds.
+MAX_CURSORS = 16
+CURSOR_TIMEOUT = 600
+
 
 def slen(rv):
     """
@@ -40,6 +47,41 @@ def slen(rv):
     return len(rv)
 
 
+class TableCursor(object):
+
+    """
+    Server-side state for reading a table in batches. Each call to
+    next() returns the following batch of at most nrows rows until
+    the table (or the rows matching condition) is exhausted. The
+    cursor is stamped when opened so that appends or updates made
+    while it is being read cause an OptimisticLockException rather
+    than a torn read.
+    """
+
+    def __init__(self, storage, colNumbers, condition, variables, nrows):
+        self.uuid = Ice.generateUUID()
+        self.storage = storage
+        self.colNumbers = colNumbers
+        self.condition = condition
+        self.variables = variables
+        self.nrows = nrows
+        self.stamp = time.time()
+        self.used = self.stamp
+        self.position = 0
+        self.exhausted = False
+
+    def next(self, current):
+        self.used = time.time()
+        if self.exhausted:
+            return None
+        data, self.position = self.storage.read_batch(
+            self.stamp, self.colNumbers, self.position, self.nrows,
+            self.condition, self.variables, current)
+        if data is None:
+            self.exhausted = True
+        return data
+
+
 class TableI(omero.grid.Table, omero.util.SimpleServant):
 
     """
@@ -47,7 +89,7 @@ class TableI(omero.grid.Table, omero.util.SimpleServant):
     """
 
     def __init__(self, ctx, file_obj, factory, storage, uuid="unknown",
-                 call_context=None, adapter=None):
+                 call_context=None, adapter=None, storage_options=None):
         self.id = Ice.Identity()
         self.id.name = uuid
         self.uuid = uuid
@@ -56,6 +98,9 @@ class TableI(omero.grid.Table, omero.util.SimpleServant):
         self.storage = storage
         self.call_context = call_context
         self.adapter = adapter
+        if storage_options is None:
+            storage_options = {}
+        self.storage_options = storage_options
         self.can_write = factory.getAdminService().canUpdate(
             file_obj, call_context)
         omero.util.SimpleServant.__init__(self, ctx)
@@ -63,6 +108,9 @@ class TableI(omero.grid.Table, omero.util.SimpleServant):
         self.stamp = time.time()
         self.storage.incr(self)
 
+        # Ordered from least to most recently used
+        self._cursors = OrderedDict()
+
         self._closed = False
 
         if (not self.file_obj.isLoaded() or
@@ -115,6 +163,7 @@ class TableI(omero.grid.Table, omero.util.SimpleServant):
         Decrements the counter on the held storage to allow it to
         be cleaned up. Returns the current file-size.
         """
+        self._cursors.clear()
         if self.storage:
             try:
                 self.storage.decr(self)
@@ -225,6 +274,29 @@ class TableI(omero.grid.Table, omero.util.SimpleServant):
                          start, stop, step, slen(rv))
         return rv
 
+    @remoted
+    @perf
+    def aggregate(self, colNumber, aggregates, condition, variables,
+                  start, stop, bins=0, binrange=None, quantiles=None,
+                  current=None):
+        """
+        Returns a map from the requested aggregate names (and optionally
+        "histogram", "bins" and "quantiles") to their values for the given
+        column, computed on the server. See HdfStorage.aggregate.
+        """
+        variables = unwrap(variables)
+        if stop == 0:
+            stop = None
+        if not bins:
+            bins = None
+        rv = self.storage.aggregate(
+            self.stamp, colNumber, aggregates, condition, variables,
+            start, stop, bins, binrange, quantiles)
+        self.logger.info("%s.aggregate(%s, %s, %s, %s, %s, %s) => size=%s",
+                         self, colNumber, aggregates, condition, variables,
+                         start, stop, slen(rv))
+        return dict([(k, wrap(v)) for k, v in rv.items()])
+
     @remoted
     @perf
     def readCoordinates(self, rowNumbers, current=None):
@@ -263,13 +335,90 @@ class TableI(omero.grid.Table, omero.util.SimpleServant):
             slen(colNumbers), slen(rowNumbers))
         return self.storage.slice(self.stamp, colNumbers, rowNumbers, current)
 
+    @remoted
+    @perf
+    def openCursor(self, colNumbers, condition, variables, batchBytes,
+                   current=None):
+        """
+        Opens a cursor over the given columns (all if empty), optionally
+        restricted to the rows matching condition, and returns its id
+        for use with nextBatch. Each batch holds as many rows as fit in
+        batchBytes, which defaults to half of Ice.MessageSizeMax.
+        Cursors unused for CURSOR_TIMEOUT seconds, or beyond the
+        MAX_CURSORS most recently used, are closed.
+        """
+        if not colNumbers:
+            colNumbers = range(len(self.storage.cols(None, current)))
+        if batchBytes <= 0:
+            props = current.adapter.getCommunicator().getProperties()
+            batchBytes = props.getPropertyAsIntWithDefault(
+                "Ice.MessageSizeMax", 1024) * 1024 / 2
+        rowsize = self.storage.rowsize(colNumbers)
+        nrows = max(1, batchBytes / max(1, rowsize))
+        cursor = TableCursor(self.storage, colNumbers, condition,
+                             unwrap(variables), nrows)
+        self._cursors[cursor.uuid] = cursor
+        self._expire_cursors()
+        self.logger.info("%s.openCursor(%s, %s, %s, %s) => %s rows/batch",
+                         self, colNumbers, condition, unwrap(variables),
+                         batchBytes, nrows)
+        return cursor.uuid
+
+    @remoted
+    @perf
+    def nextBatch(self, cursorId, current=None):
+        """
+        Returns the next batch of data for the cursor, or None once it
+        is exhausted at which point the cursor is closed.
+        """
+        self._expire_cursors()
+        try:
+            cursor = self._cursors[cursorId]
+        except KeyError:
+            raise omero.ApiUsageException(
+                None, None, "Unknown cursor: %s" % cursorId)
+        try:
+            rv = cursor.next(current)
+        except omero.OptimisticLockException:
+            del self._cursors[cursorId]
+            raise
+        if rv is None:
+            del self._cursors[cursorId]
+        else:
+            # Now the most recently used
+            self._cursors[cursorId] = self._cursors.pop(cursorId)
+        self.logger.info("%s.nextBatch(%s) => size=%s", self, cursorId,
+                         rv and slen(rv.rowNumbers))
+        return rv
+
+    @remoted
+    @perf
+    def closeCursor(self, cursorId, current=None):
+        self._cursors.pop(cursorId, None)
+        self.logger.info("%s.closeCursor(%s)", self, cursorId)
+
+    def _expire_cursors(self):
+        """
+        Closes the cursors which have not been used for CURSOR_TIMEOUT
+        seconds and, beyond MAX_CURSORS, the least recently used ones so
+        that abandoned cursors are not held until the table is closed.
+        """
+        now = time.time()
+        while self._cursors:
+            cursorId, cursor = next(self._cursors.iteritems())
+            if len(self._cursors) <= MAX_CURSORS and \
+                    now - cursor.used <= CURSOR_TIMEOUT:
+                break
+            del self._cursors[cursorId]
+            self.logger.info("%s expired cursor %s", self, cursorId)
+
     # TABLES WRITE API ===========================
 
     @remoted
     @perf
     def initialize(self, cols, current=None):
         self.assert_write()
-        self.storage.initialize(cols)
+        self.storage.initialize(cols, **self.storage_options)
         if cols:
             self.logger.info("Initialized %s with %s col(s)", self, slen(cols))
 
@@ -328,6 +477,30 @@ class TableI(omero.grid.Table, omero.util.SimpleServant):
 
         self.file_obj = None
 
+    # TABLES INDEX API ==============================
+
+    @remoted
+    @perf
+    def getIndexes(self, current=None):
+        rv = self.storage.get_indexes()
+        self.logger.info("%s.getIndexes() => %s", self, rv.keys())
+        return dict([(k, wrap(list(v))) for k, v in rv.items()])
+
+    @remoted
+    @perf
+    def createIndex(self, colNumber, kind, optlevel, current=None):
+        self.assert_write()
+        self.storage.create_index(colNumber, kind, optlevel)
+        self.logger.info("%s.createIndex(%s, %s, %s)",
+                         self, colNumber, kind, optlevel)
+
+    @remoted
+    @perf
+    def removeIndex(self, colNumber, current=None):
+        self.assert_write()
+        self.storage.remove_index(colNumber)
+        self.logger.info("%s.removeIndex(%s)", self, colNumber)
+
     # TABLES METADATA API ===========================
 
     @remoted
@@ -403,6 +576,14 @@ class TablesI(omero.grid.Tables, omero.util.Servant):
                          str(self._storage_factory.__module__),
                          self._storage_factory.__class__.__name__)
 
+        # Only enable if libhdf5 was built with --enable-threadsafe
+        threadsafe = self.communicator.getProperties().getPropertyWithDefault(
+            "omero.tables.threadsafe", "false").lower() == "true"
+        if hasattr(self._storage_factory, "threadsafe"):
+            self._storage_factory.threadsafe = threadsafe
+            if threadsafe:
+                self.logger.info("Using per-file locks for read-only tables")
+
         self.repo_cfg = None
         self.repo_mgr = None
         self.repo_obj = None
@@ -420,6 +601,11 @@ class TablesI(omero.grid.Tables, omero.util.Servant):
         if self.read_only:
             self.logger.info("Starting in read-only mode.")
 
+        self.storage_options = self._get_storage_options()
+        if self.storage_options:
+            self.logger.info("New tables created with: %s",
+                             self.storage_options)
+
         if retries is None:
             retries = RETRIES
 
@@ -446,6 +632,33 @@ class TablesI(omero.grid.Tables, omero.util.Servant):
         if e:
             raise e
 
+    def _get_storage_options(self):
+        """
+        Reads the compression and chunking options for newly initialized
+        tables from the server configuration:
+
+          omero.tables.complib       compression library (default: none)
+          omero.tables.complevel     compression level 1-9 (default: 5)
+          omero.tables.shuffle       apply the shuffle filter (default: true)
+          omero.tables.chunkshape    rows per HDF5 chunk (default: automatic)
+          omero.tables.expectedrows  expected number of rows (default: none)
+        """
+        props = self.communicator.getProperties()
+        options = {}
+        complib = props.getPropertyWithDefault("omero.tables.complib", "")
+        if complib:
+            options["complib"] = complib
+            options["complevel"] = props.getPropertyAsIntWithDefault(
+                "omero.tables.complevel", 5)
+            options["shuffle"] = props.getPropertyWithDefault(
+                "omero.tables.shuffle", "true").lower() == "true"
+        for key in ("chunkshape", "expectedrows"):
+            value = props.getPropertyAsIntWithDefault(
+                "omero.tables.%s" % key, 0)
+            if value > 0:
+                options[key] = value
+        return options
+
     def _get_dir(self):
         """
         Second step in initialization is to find the .omero/repository
@@ -533,7 +746,8 @@ class TablesI(omero.grid.Tables, omero.util.Servant):
         table = TableI(self.ctx, file_obj, factory, storage,
                        uuid=Ice.generateUUID(),
                        call_context=current.ctx,
-                       adapter=current.adapter)
+                       adapter=current.adapter,
+                       storage_options=self.storage_options)
         self.resources.add(table)
         prx = current.adapter.add(table, table.id)
         return self._table_cast(prx)
@@ -29,10 +29,11 @@ import sys
 import csv
 import re
 import json
+import time
 from getpass import getpass
 from getopt import getopt, GetoptError
-from itertools import izip
-from collections import defaultdict
+from itertools import compress, islice, izip, repeat
+from collections import defaultdict, deque
 import warnings
 
 import omero.clients
@@ -314,126 +315,161 @@ class ValueResolver(object):
                 'Unsupported target object class: %s' % self.target_class)
 
     def get_plate_name_by_id(self, plate):
-        return self.wrapper.get_plate_name_by_id(plate)
+        return self._found(self.get_plate_names([plate])[0], plate)
+
+    def get_plate_names(self, plates):
+        return self.wrapper.get_plate_names(plates)
 
     def get_well_name(self, well_id, plate=None):
-        well = self.wrapper.get_well_by_id(well_id, plate)
-        row = well.row.val
-        col = well.column.val
-        row = self.AS_ALPHA[row]
-        return '%s%d' % (row, col + 1)
+        return self._found(self.get_well_names([well_id])[0], well_id)
+
+    def get_well_names(self, well_ids):
+        return self.wrapper.get_well_names(well_ids)
 
     def get_image_id_by_name(self, iname, dname=None):
         return self.wrapper.get_image_id_by_name(iname, dname)
 
+    def get_image_ids_by_name(self, inames, dnames=None):
+        return self.wrapper.get_image_ids_by_name(inames, dnames)
+
     def get_image_name_by_id(self, iid, pid=None):
-        return self.wrapper.get_image_name_by_id(iid, pid)
+        return self._found(self.get_image_names([iid])[0], iid)
+
+    def get_image_names(self, iids):
+        return self.wrapper.get_image_names(iids)
+
+    def _found(self, value, key):
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get_name_widths(self):
+        return self.wrapper.get_name_widths()
 
     def subselect(self, valuerows, names):
         return self.wrapper.subselect(valuerows, names)
 
     def resolve(self, column, value, row):
-        images_by_id = None
+        plates = None
+        for other, plate in row:
+            if other.__class__ is PlateColumn:
+                plates = [plate]
+                break
+        return self.resolve_column(column, [value], plates)[0]
+
+    def resolve_column(self, column, values, plates=None):
+        """
+        Resolves all the values of a column at once.
+
+        :param plates: the plate name of each value, if the file has a
+                       Plate column
+        """
         column_class = column.__class__
         column_as_lower = column.name.lower()
         if ImageColumn is column_class:
-            if len(self.wrapper.images_by_id) == 1:
-                images_by_id = self.wrapper.images_by_id.values()[0]
-            else:
-                for column, plate in row:
-                    if column.__class__ is PlateColumn:
-                        images_by_id = self.images_by_id[
-                            self.plates_by_name[plate].id.val
-                        ]
-                        log.debug(
-                            "Got plate %i", self.plates_by_name[plate].id.val
-                        )
-                    break
-            if images_by_id is None:
-                raise MetadataError(
-                    'Unable to locate Plate column in Row: %r' % row
-                )
-            try:
-                return images_by_id[long(value)].id.val
-            except KeyError:
-                log.debug('Image Id: %i not found!' % (value))
-                return -1L
-            return
+            return self.wrapper.resolve_images(values, plates)
         if WellColumn is column_class:
-            return self.wrapper.resolve_well(column, row, value)
+            return self.wrapper.resolve_wells(values, plates)
         if PlateColumn is column_class:
-            return self.wrapper.resolve_plate(column, row, value)
+            return self.wrapper.resolve_plates(values)
         if column_as_lower in ('row', 'column') \
            and column_class is LongColumn:
-            try:
-                # The value is not 0 offsetted
-                return long(value) - 1
-            except ValueError:
-                return long(self.AS_ALPHA.index(value.lower()))
+            return [self.resolve_position(value) for value in values]
         if StringColumn is column_class:
-            return value
+            return list(values)
         if LongColumn is column_class:
-            return long(value)
+            return [long(value) for value in values]
         if DoubleColumn is column_class:
-            return float(value)
+            return [float(value) for value in values]
         if BoolColumn is column_class:
-            return value.lower() in BOOLEAN_TRUE
+            return [value.lower() in BOOLEAN_TRUE for value in values]
         raise MetadataError('Unsupported column class: %s' % column_class)
 
-
-class PlateData(object):
-    """
-    Largely "mock" object which is intended to simulate the data returned
-    by querying a Plate but without the overhead of storing all the Ice
-    fields.
-    """
-
-    def __init__(self, plate):
-        self.id = plate.id
-        self.name = plate.name
-        self.wells = []
-        for well in plate.copyWells():
-            self.wells.append(WellData(well))
-
-
-class WellData(object):
-    """
-    Largely "mock" object which is intended to simulate the data returned
-    by querying a Well but without the overhead of storing all the Ice
-    fields.
-    """
-
-    def __init__(self, well):
-        self.id = well.id
-        self.row = well.row
-        self.column = well.column
-        self.well_samples = []
-        for well_sample in well.copyWellSamples():
-            self.well_samples.append(WellSampleData(well_sample))
+    def resolve_position(self, value):
+        try:
+            # The value is not 0 offsetted
+            return long(value) - 1
+        except ValueError:
+            return long(self.AS_ALPHA.index(value.lower()))
 
 
-class WellSampleData(object):
+class SPWIndex(object):
     """
-    Largely "mock" object which is intended to simulate the data returned
-    by querying a WellSample but without the overhead of storing all the Ice
-    fields.
+    Ids, names, rows and columns of the plates, wells and images of a
+    Screen or Plate as returned by projection queries. Wells and images
+    are held in arrays sorted by id so that whole columns of ids can be
+    looked up at once, without the overhead of storing the object graph.
     """
 
-    def __init__(self, well_sample):
-        self.id = well_sample.id
-        self.image = ImageData(well_sample.getImage())
+    def __init__(self, plates, rows, as_alpha):
+        """
+        :param plates: (id, name) of each plate
+        :param rows: (plate id, well id, row, column, image id, image name)
+                     of each well sample
+        """
+        import numpy
+        self.plate_names = dict(plates)
+        self.plate_ids = dict((name, pid) for pid, name in plates)
+        if rows:
+            pids, wids, wrows, wcols, iids, inames = zip(*rows)
+        else:
+            pids = wids = wrows = wcols = iids = inames = ()
+
+        pids = numpy.array(pids, dtype=numpy.int64)
+        self.well_ids, first = numpy.unique(
+            numpy.array(wids, dtype=numpy.int64), return_index=True)
+        well_plates = pids[first].tolist()
+        well_rows = numpy.array(wrows, dtype=numpy.int64)[first].tolist()
+        well_cols = numpy.array(wcols, dtype=numpy.int64)[first].tolist()
+        self.well_names = numpy.array(
+            ['%s%d' % (as_alpha[r], c + 1)
+             for r, c in izip(well_rows, well_cols)], dtype=object)
+        # Well ids by 0-offsetted (plate id, row, column)
+        self.wells_by_location = dict(izip(
+            izip(well_plates, well_rows, well_cols), self.well_ids.tolist()))
+
+        self.image_ids, first = numpy.unique(
+            numpy.array(iids, dtype=numpy.int64), return_index=True)
+        self.image_names = numpy.array(inames, dtype=object)[first]
+        self.image_plates = pids[first]
+        log.debug('Indexed %d plates, %d wells and %d images',
+                  len(self.plate_names), len(self.well_ids),
+                  len(self.image_ids))
 
+    @staticmethod
+    def lookup(keys, ids, values):
+        """
+        Returns the element of values at the position of each of ids in
+        the sorted array keys, or None for ids which are not present.
+        """
+        import numpy
+        if not len(keys):
+            return [None] * len(ids)
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        pos = numpy.searchsorted(keys, ids)
+        pos[pos == len(keys)] = 0
+        rv = values[pos].tolist()
+        for i in numpy.flatnonzero(keys[pos] != ids):
+            rv[i] = None
+        return rv
+
+    def find_images(self, ids, pids=None):
+        """
+        Returns each of ids which is present, or None. If pids is given
+        an image must also be in the plate with the matching id.
+        """
+        found = self.lookup(self.image_ids, ids, self.image_ids)
+        if pids is None:
+            return found
+        plates = self.lookup(self.image_ids, ids, self.image_plates)
+        return [iid if plate is not None and plate == pid else None
+                for iid, plate, pid in izip(found, plates, pids)]
 
-class ImageData(object):
-    """
-    Largely "mock" object which is intended to simulate the data returned
-    by querying a Image but without the overhead of storing all the Ice
-    fields.
-    """
+    def get_image_names(self, ids):
+        return self.lookup(self.image_ids, ids, self.image_names)
 
-    def __init__(self, image):
-        self.id = image.id
-        self.name = image.name
+    def get_well_names(self, ids):
+        return self.lookup(self.well_ids, ids, self.well_names)
 
 
 class ValueWrapper(object):
@@ -447,6 +483,38 @@ class ValueWrapper(object):
     def subselect(self, rows, names):
         return rows
 
+    def get_name_widths(self):
+        """
+        Returns the maximum width of the names which post processing may
+        fill into the derived name columns, keyed by column name.
+        """
+        return dict()
+
+    def unsupported(self, what):
+        raise MetadataError(
+            'Cannot resolve %s for %s' % (what, self.target_class))
+
+    def resolve_images(self, values, plates=None):
+        self.unsupported('image ids')
+
+    def resolve_wells(self, values, plates=None):
+        self.unsupported('wells')
+
+    def resolve_plates(self, values):
+        self.unsupported('plates')
+
+    def get_image_names(self, iids):
+        self.unsupported('image names')
+
+    def get_image_ids_by_name(self, inames, dnames=None):
+        self.unsupported('image ids by name')
+
+    def get_well_names(self, well_ids):
+        self.unsupported('well names')
+
+    def get_plate_names(self, plates):
+        self.unsupported('plate names')
+
 
 class SPWWrapper(ValueWrapper):
 
@@ -455,72 +523,113 @@ class SPWWrapper(ValueWrapper):
         self.AS_ALPHA = value_resolver.AS_ALPHA
         self.WELL_REGEX = value_resolver.WELL_REGEX
 
-    def get_well_by_id(self, well_id, plate=None):
-        raise Exception("to be implemented by subclasses")
+    def load_index(self, plates):
+        """
+        Loads the well samples of plates, a list of (id, name) tuples,
+        into an :class:`SPWIndex`, one plate at a time.
+        """
+        query_service = self.client.getSession().getQueryService()
+        rows = list()
+        for pid, name in plates:
+            parameters = omero.sys.ParametersI()
+            parameters.addId(pid)
+            rows.extend(unwrap(query_service.projection((
+                'select p.id, w.id, w.row, w.column, i.id, i.name '
+                'from WellSample ws '
+                'join ws.well as w '
+                'join w.plate as p '
+                'join ws.image as i '
+                'where p.id = :id'), parameters, {'omero.group': '-1'})))
+            log.debug('Completed loading plate: %s' % name)
+        self.index = SPWIndex(plates, rows, self.AS_ALPHA)
+
+    def get_name_widths(self):
+        index = self.index
+        return {
+            WELL_NAME_COLUMN: max([len(n) for n in index.well_names] or [0]),
+            IMAGE_NAME_COLUMN: max(
+                [len(n) for n in index.image_names] or [0]),
+            PLATE_NAME_COLUMN: max(
+                [len(n) for n in index.plate_names.values()] or [0]),
+        }
 
-    def get_image_name_by_id(self, iid, pid=None):
-        if not pid and len(self.images_by_id):
-            pid = self.images_by_id.keys()[0]
-        else:
-            raise Exception("Cannot resolve image to plate")
-        return self.images_by_id[pid][iid].name.val
+    def get_image_names(self, iids):
+        return self.index.get_image_names(iids)
+
+    def get_well_names(self, well_ids):
+        return self.index.get_well_names(well_ids)
 
-    def parse_plate(self, plate, wells_by_location, wells_by_id, images_by_id):
+    def get_plate_names(self, plates):
+        return [self.index.plate_names.get(plate) for plate in plates]
+
+    def resolve_images(self, values, plates=None):
         """
-        Accepts PlateData instances
+        Resolves image ids, in the plate named by plates if given.
         """
-        # TODO: This should use the PlateNamingConvention. We're assuming rows
-        # as alpha and columns as numeric.
-        for well in plate.wells:
-            wells_by_id[well.id.val] = well
-            row = well.row.val
-            # 0 offsetted is not what people use in reality
-            column = str(well.column.val + 1)
-            try:
-                columns = wells_by_location[self.AS_ALPHA[row]]
-            except KeyError:
-                wells_by_location[self.AS_ALPHA[row]] = columns = dict()
-            columns[column] = well
-
-            for well_sample in well.well_samples:
-                image = well_sample.image
-                images_by_id[image.id.val] = image
-        log.debug('Completed parsing plate: %s' % plate.name.val)
-        for row in wells_by_location:
-            log.debug('%s: %r' % (row, wells_by_location[row].keys()))
-
-    def resolve_well(self, column, row, value):
-            m = self.WELL_REGEX.match(value)
-            if m is None or len(m.groups()) != 2:
-                msg = 'Cannot parse well identifier "%s" from row: %r'
-                msg = msg % (value, [o[1] for o in row])
-                raise MetadataError(msg)
-            plate_row = m.group(1).lower()
-            plate_column = str(long(m.group(2)))
-            wells_by_location = None
-            if len(self.wells_by_location) == 1:
-                wells_by_location = self.wells_by_location.values()[0]
-                log.debug(
-                    'Parsed "%s" row: %s column: %s' % (
-                        value, plate_row, plate_column))
-            else:
-                for column, plate in row:
-                    if column.__class__ is PlateColumn:
-                        wells_by_location = self.wells_by_location[plate]
-                        log.debug(
-                            'Parsed "%s" row: %s column: %s plate: %s' % (
-                                value, plate_row, plate_column, plate))
-                        break
-            if wells_by_location is None:
+        ids = [long(value) for value in values]
+        if plates is None:
+            if len(self.index.plate_ids) > 1:
                 raise MetadataError(
-                    'Unable to locate Plate column in Row: %r' % row
-                )
-            try:
-                return wells_by_location[plate_row][plate_column].id.val
-            except KeyError:
-                log.debug('Row: %s Column: %s not found!' % (
-                    plate_row, plate_column))
-                return -1L
+                    'Unable to locate Plate column for images: %s'
+                    % ', '.join(str(iid) for iid in ids[:10]))
+            found = self.index.find_images(ids)
+        else:
+            found = self.index.find_images(
+                ids, [self.index.plate_ids.get(plate) for plate in plates])
+        missing = found.count(None)
+        if missing:
+            log.debug('%d of %d image ids not found!', missing, len(found))
+        return [-1L if iid is None else iid for iid in found]
+
+    def resolve_wells(self, values, plates=None):
+        """
+        Resolves well identifiers such as "A1", in the plate named by
+        plates if given. Each distinct (plate, well) pair is only parsed
+        once.
+        """
+        import numpy
+        if not len(values):
+            return []
+        names, inverse = numpy.unique(
+            numpy.array(values, dtype=object), return_inverse=True)
+        if plates is None:
+            if len(self.index.plate_ids) != 1:
+                raise MetadataError(
+                    'Unable to locate Plate column for wells: %s'
+                    % ', '.join(names[:10]))
+            pid = self.index.plate_ids.values()[0]
+            wids = [self.resolve_well(name, pid) for name in names]
+            return numpy.array(wids, dtype=numpy.int64)[inverse].tolist()
+
+        pnames, pinverse = numpy.unique(
+            numpy.array(plates, dtype=object), return_inverse=True)
+        keys, kinverse = numpy.unique(
+            pinverse * len(names) + inverse, return_inverse=True)
+        wids = [self.resolve_well(
+            names[key % len(names)],
+            self.index.plate_ids.get(pnames[key // len(names)]))
+            for key in keys]
+        return numpy.array(wids, dtype=numpy.int64)[kinverse].tolist()
+
+    def resolve_well(self, value, plate):
+        m = self.WELL_REGEX.match(value)
+        if m is None or len(m.groups()) != 2:
+            raise MetadataError(
+                'Cannot parse well identifier "%s"' % value)
+        plate_row = m.group(1).lower()
+        plate_column = long(m.group(2))
+        try:
+            row = self.AS_ALPHA.index(plate_row)
+        except ValueError:
+            row = -1
+        try:
+            # 0 offsetted is not what people use in reality
+            return self.index.wells_by_location[
+                (plate, row, plate_column - 1)]
+        except KeyError:
+            log.debug('Row: %s Column: %s not found!' % (
+                plate_row, plate_column))
+            return -1L
 
 
 class ScreenWrapper(SPWWrapper):
@@ -529,60 +638,30 @@ class ScreenWrapper(SPWWrapper):
         super(ScreenWrapper, self).__init__(value_resolver)
         self._load()
 
-    def get_plate_name_by_id(self, plate):
-        plate = self.plates_by_id[plate]
-        return plate.name.val
-
-    def get_well_by_id(self, well_id, plate=None):
-        wells = self.wells_by_id[plate]
-        return wells[well_id]
-
-    def resolve_plate(self, column, row, value):
-        try:
-            return self.plates_by_name[value].id.val
-        except KeyError:
-            log.warn('Screen is missing plate: %s' % value)
-            return Skip()
+    def resolve_plates(self, values):
+        rv = list()
+        for value in values:
+            try:
+                rv.append(self.index.plate_ids[value])
+            except KeyError:
+                log.warn('Screen is missing plate: %s' % value)
+                rv.append(Skip())
+        return rv
 
     def _load(self):
         query_service = self.client.getSession().getQueryService()
         parameters = omero.sys.ParametersI()
         parameters.addId(self.target_object.id.val)
         log.debug('Loading Screen:%d' % self.target_object.id.val)
-        self.target_object = query_service.findByQuery((
-            'select s from Screen as s '
-            'join fetch s.plateLinks as p_link '
-            'join fetch p_link.child as p '
-            'where s.id = :id'), parameters, {'omero.group': '-1'})
-        if self.target_object is None:
+        rows = unwrap(query_service.projection((
+            'select s.name, p.id, p.name from Screen as s '
+            'join s.plateLinks as p_link '
+            'join p_link.child as p '
+            'where s.id = :id'), parameters, {'omero.group': '-1'}))
+        if not rows:
             raise MetadataError('Could not find target object!')
-        self.target_name = unwrap(self.target_object.getName())
-        self.images_by_id = dict()
-        self.wells_by_location = dict()
-        self.wells_by_id = dict()
-        self.plates_by_name = dict()
-        self.plates_by_id = dict()
-        images_by_id = dict()
-        self.images_by_id[self.target_object.id.val] = images_by_id
-        for plate in (l.child for l in self.target_object.copyPlateLinks()):
-            parameters = omero.sys.ParametersI()
-            parameters.addId(plate.id.val)
-            plate = query_service.findByQuery((
-                'select p from Plate p '
-                'join fetch p.wells as w '
-                'join fetch w.wellSamples as ws '
-                'join fetch ws.image as i '
-                'where p.id = :id'), parameters, {'omero.group': '-1'})
-            plate = PlateData(plate)
-            self.plates_by_name[plate.name.val] = plate
-            self.plates_by_id[plate.id.val] = plate
-            wells_by_location = dict()
-            wells_by_id = dict()
-            self.wells_by_location[plate.name.val] = wells_by_location
-            self.wells_by_id[plate.id.val] = wells_by_id
-            self.parse_plate(
-                plate, wells_by_location, wells_by_id, images_by_id
-            )
+        self.target_name = rows[0][0]
+        self.load_index([(pid, pname) for name, pid, pname in rows])
 
 
 class PlateWrapper(SPWWrapper):
@@ -591,11 +670,6 @@ class PlateWrapper(SPWWrapper):
         super(PlateWrapper, self).__init__(value_resolver)
         self._load()
 
-    def get_well_by_id(self, well_id, plate=None):
-        plate = self.target_object.id.val
-        wells = self.wells_by_id[plate]
-        return wells[well_id]
-
     def subselect(self, rows, names):
         """
         If we're processing a plate but the bulk-annotations file contains
@@ -604,10 +678,10 @@ class PlateWrapper(SPWWrapper):
         for i, name in enumerate(names):
             if name.lower() == 'plate':
                 valuerows = [row for row in rows if row[i] ==
-                             self.value_resolver.target_name]
+                             self.target_name]
                 log.debug(
                     'Selected %d/%d rows for plate "%s"', len(valuerows),
-                    len(rows), self.value_resolver.target_name)
+                    len(rows), self.target_name)
                 return valuerows
         return rows
 
@@ -616,30 +690,13 @@ class PlateWrapper(SPWWrapper):
         parameters = omero.sys.ParametersI()
         parameters.addId(self.target_object.id.val)
         log.debug('Loading Plate:%d' % self.target_object.id.val)
-        self.target_object = query_service.findByQuery((
-            'select p from Plate as p '
-            'join fetch p.wells as w '
-            'join fetch w.wellSamples as ws '
-            'join fetch ws.image as i '
-            'where p.id = :id'), parameters, {'omero.group': '-1'})
-        if self.target_object is None:
+        rows = unwrap(query_service.projection(
+            'select p.name from Plate as p where p.id = :id',
+            parameters, {'omero.group': '-1'}))
+        if not rows:
             raise MetadataError('Could not find target object!')
-        self.target_name = unwrap(self.target_object.getName())
-        self.wells_by_location = dict()
-        self.wells_by_id = dict()
-        wells_by_location = dict()
-        wells_by_id = dict()
-
-        self.images_by_id = dict()
-        images_by_id = dict()
-
-        self.wells_by_location[self.target_object.name.val] = wells_by_location
-        self.wells_by_id[self.target_object.id.val] = wells_by_id
-        self.images_by_id[self.target_object.id.val] = images_by_id
-        self.parse_plate(
-            PlateData(self.target_object),
-            wells_by_location, wells_by_id, images_by_id
-        )
+        self.target_name = rows[0][0]
+        self.load_index([(self.target_object.id.val, self.target_name)])
 
 
 class PDIWrapper(ValueWrapper):
@@ -647,6 +704,17 @@ class PDIWrapper(ValueWrapper):
     def get_image_id_by_name(self, iname, dname=None):
         raise Exception("to be implemented by subclasses")
 
+    def get_image_ids_by_name(self, inames, dnames=None):
+        if dnames is None:
+            dnames = repeat(None)
+        rv = list()
+        for iname, dname in izip(inames, dnames):
+            try:
+                rv.append(self.get_image_id_by_name(iname, dname))
+            except KeyError:
+                rv.append(None)
+        return rv
+
 
 class DatasetWrapper(PDIWrapper):
 
@@ -659,6 +727,19 @@ class DatasetWrapper(PDIWrapper):
     def get_image_id_by_name(self, iname, dname=None):
         return self.images_by_name[iname]
 
+    def get_image_names(self, iids):
+        return [self.images_by_id.get(iid) for iid in iids]
+
+    def resolve_images(self, values, plates=None):
+        rv = list()
+        for value in values:
+            iid = long(value)
+            if iid not in self.images_by_id:
+                log.debug('Image Id: %i not found!' % iid)
+                iid = -1L
+            rv.append(iid)
+        return rv
+
     def _load(self):
         query_service = self.client.getSession().getQueryService()
         parameters = omero.sys.ParametersI()
@@ -767,8 +848,18 @@ class ParsingContext(object):
 
     def __init__(self, client, target_object, file=None, fileid=None,
                  cfg=None, cfgid=None, attach=False, column_types=None,
-                 options=None):
+                 options=None, width_sample=None, streaming=False):
         '''
+        By default parse() loads the resolved values of every row into
+        the columns. If streaming is set, parse() only reads the header
+        and discovers the width of each StringColumn; the rows are then
+        read again, resolved and written to the table one batch at a time
+        by write_to_omero(), so memory use is bounded by the batch size
+        rather than the size of the file. The widths are found with a pass
+        over the whole file, if width_sample is set only the first
+        width_sample rows are read and a longer value found later is an
+        error.
+
         This lines should be handled outside of the constructor:
 
         if not file:
@@ -785,6 +876,8 @@ class ParsingContext(object):
         self.target_object = target_object
         self.file = file
         self.column_types = column_types
+        self.width_sample = width_sample
+        self.streaming = streaming
         self.value_resolver = ValueResolver(self.client, self.target_object)
 
     def create_annotation_link(self):
@@ -809,87 +902,175 @@ class ParsingContext(object):
                 widths.append(None)
         return widths
 
-    def parse_from_handle(self, data):
-        rows = list(csv.reader(data, delimiter=','))
-        first_row_is_types = HeaderResolver.is_row_column_types(rows[0])
-        header_index = 0
-        rows_index = 1
+    def parse_header(self, rows):
+        """
+        Reads the optional column types row and the header row from the
+        csv reader `rows` and creates the columns.
+
+        :return: the header row
+        """
+        first = rows.next()
+        header = first
+        first_row_is_types = HeaderResolver.is_row_column_types(first)
         if first_row_is_types:
-            header_index = 1
-            rows_index = 2
-        log.debug('Header: %r' % rows[header_index])
-        for h in rows[0]:
+            header = rows.next()
+        log.debug('Header: %r' % header)
+        for h in first:
             if not h:
-                raise Exception('Empty column header in CSV: %s'
-                                % rows[header_index])
+                raise Exception('Empty column header in CSV: %s' % header)
         if self.column_types is None and first_row_is_types:
-            self.column_types = HeaderResolver.get_column_types(rows[0])
+            self.column_types = HeaderResolver.get_column_types(first)
         log.debug('Column types: %r' % self.column_types)
         self.header_resolver = HeaderResolver(
-            self.target_object, rows[header_index],
-            column_types=self.column_types)
+            self.target_object, header, column_types=self.column_types)
         self.columns = self.header_resolver.create_columns()
         log.debug('Columns: %r' % self.columns)
+        self.header = header
+        return header
 
-        valuerows = rows[rows_index:]
+    def parse_from_handle(self, data):
+        rows = csv.reader(data, delimiter=',')
+        header = self.parse_header(rows)
+        valuerows = list(rows)
         log.debug('Got %d rows', len(valuerows))
-        valuerows = self.value_resolver.subselect(
-            valuerows, rows[header_index])
+        valuerows = self.value_resolver.subselect(valuerows, header)
         self.populate(valuerows)
         self.post_process()
         log.debug('Column widths: %r' % self.get_column_widths())
         log.debug('Columns: %r' % [
             (o.name, len(o.values)) for o in self.columns])
 
-    def parse(self):
+    def scan_from_handle(self, data):
+        """
+        First pass over the file: creates the columns and sets the size of
+        each StringColumn to the longest value it will hold, without
+        keeping any rows.
+        """
+        rows = csv.reader(data, delimiter=',')
+        self.parse_header(rows)
+        nheaders = len(self.header)
+        string_columns = [
+            (i, column) for i, column in enumerate(self.columns[:nheaders])
+            if column.__class__ is StringColumn]
+        count = 0
+        for row in rows:
+            if self.width_sample is not None and count >= self.width_sample:
+                break
+            count += 1
+            for i, column in string_columns:
+                if i < len(row):
+                    column.size = max(column.size, len(row[i]))
+        widths = self.value_resolver.get_name_widths()
+        for column in self.columns[nheaders:]:
+            if column.name in widths:
+                column.size = max(column.size, widths[column.name])
+        self.streaming = True
+        log.debug('Scanned %d rows', count)
+        log.debug('Column widths: %r' % self.get_column_widths())
+
+    def open(self):
         if self.file.endswith(".gz"):
-            data = gzip.open(self.file, "rb")
-        else:
-            data = open(self.file, 'U')
+            return gzip.open(self.file, "rb")
+        return open(self.file, 'U')
 
+    def parse(self):
+        data = self.open()
         try:
+            if self.streaming:
+                return self.scan_from_handle(data)
             return self.parse_from_handle(data)
         finally:
             data.close()
 
-    def populate(self, rows):
-        nrows = len(rows)
-        for (r, row) in enumerate(rows):
-            values = list()
-            row = [(self.columns[i], value) for i, value in enumerate(row)]
-            for column, original_value in row:
-                log.debug('Row %d/%d Original value %s, %s',
-                          r + 1, nrows, original_value, column.name)
-                value = self.value_resolver.resolve(
-                    column, original_value, row)
-                if value.__class__ is Skip:
+    def iter_batches(self, batch_size):
+        """
+        Second pass over the file: yields the value rows in lists of up to
+        batch_size rows, selected for the target object.
+        """
+        data = self.open()
+        try:
+            rows = csv.reader(data, delimiter=',')
+            if HeaderResolver.is_row_column_types(rows.next()):
+                rows.next()
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
                     break
-                values.append(value)
-                try:
-                    log.debug("Value's class: %s" % value.__class__)
-                    if value.__class__ is str:
-                        column.size = max(column.size, len(value))
-                except TypeError:
-                    log.error('Original value "%s" now "%s" of bad type!' % (
-                        original_value, value))
-                    raise
-            if value.__class__ is not Skip:
-                values.reverse()
-                for column in self.columns:
-                    if not values:
-                        if isinstance(column, ImageColumn) or \
-                           column.name in (PLATE_NAME_COLUMN,
-                                           WELL_NAME_COLUMN,
-                                           IMAGE_NAME_COLUMN):
-                            # Then assume that the values will be calculated
-                            # later based on another column.
-                            continue
-                        else:
-                            msg = 'Column %s has no values.' % column.name
-                            log.error(msg)
-                            raise IndexError(msg)
-                    else:
-                        column.values.append(values.pop())
+                yield self.value_resolver.subselect(batch, self.header)
+        finally:
+            data.close()
+
+    def populate(self, rows):
+        """
+        Resolves the values of rows one column at a time and appends them
+        to the columns. Rows for plates missing from the screen are
+        skipped. Rows may be shorter than the header if the columns they
+        leave out are calculated later by post_process(), but every row
+        must then leave out the same columns.
+        """
+        if not rows:
+            return
+        nheaders = len(self.header)
+        widths = [min(nheaders, len(row)) for row in rows]
+        width = min(widths)
+        for i, column in enumerate(self.columns[width:nheaders], width):
+            if i >= max(widths) and (
+                    isinstance(column, ImageColumn) or
+                    column.name in (PLATE_NAME_COLUMN,
+                                    WELL_NAME_COLUMN,
+                                    IMAGE_NAME_COLUMN)):
+                # Then assume that the values will be calculated
+                # later based on another column.
+                continue
+            msg = 'Column %s has no values.' % column.name
+            log.error(msg)
+            raise IndexError(msg)
+
+        values = [[row[i] for row in rows] for i in xrange(width)]
+        plates = None
+        for i, column in enumerate(self.columns[:width]):
+            if column.__class__ is PlateColumn:
+                plates = values[i]
+                values[i] = self.value_resolver.resolve_column(
+                    column, plates)
+                keep = [v.__class__ is not Skip for v in values[i]]
+                if not all(keep):
+                    values = [list(compress(v, keep)) for v in values]
+                    plates = list(compress(plates, keep))
+                break
+
+        for i, column in enumerate(self.columns[:width]):
+            if column.__class__ is not PlateColumn:
+                values[i] = self.value_resolver.resolve_column(
+                    column, values[i], plates)
+            log.debug('Resolved %d values for %s',
+                      len(values[i]), column.name)
+            self.append_values(column, values[i])
+
+    def append_values(self, column, values):
+        if column.__class__ is StringColumn and values:
+            try:
+                column.size = max(column.size, max(len(v) for v in values))
+            except TypeError:
+                log.error('Column %s has values of bad type!' % column.name)
+                raise
+        column.values.extend(values)
+
+    def append_names(self, column, names, what, required=False):
+        """
+        Appends the names looked up for post processing to column. Where
+        no name was found an empty name is used, or if required is set a
+        MetadataError is raised.
+        """
+        missing = names.count(None)
+        if missing:
+            msg = 'Missing %s name for %d of %d rows!' % (
+                what, missing, len(names))
+            if required:
+                raise MetadataError(msg)
+            log.warn(msg)
+            names = ['' if name is None else name for name in names]
+        self.append_values(column, names)
 
     def post_process(self):
         target_class = self.target_object.__class__
@@ -919,68 +1100,40 @@ class ParsingContext(object):
             log.info('Nothing to do during post processing.')
             return
 
-        sz = max([len(x.values) for x in self.columns])
-        for i in range(0, sz):
-            if well_name_column is not None:
-
-                v = ''
-                try:
-                    well_id = well_column.values[i]
-                    plate = None
-                    if "Plate" in columns_by_name:  # FIXME
-                        plate = columns_by_name["Plate"].values[i]
-                    v = self.value_resolver.get_well_name(well_id, plate)
-                except KeyError:
-                    log.warn(
-                        'Skipping table row %d! Missing well row or column '
-                        'for well name population!' % i, exc_info=True
-                    )
-                well_name_column.size = max(well_name_column.size, len(v))
-                well_name_column.values.append(v)
-            else:
-                log.info('Missing well name column, skipping.')
-
-            if image_name_column is not None and (
-                    DatasetI is target_class or
-                    ProjectI is target_class):
-                iid = -1
-                try:
-                    iname = image_name_column.values[i]
-                    did = None
-                    if "Dataset Name" in columns_by_name:  # FIXME
-                        did = columns_by_name["Dataset Name"].values[i]
-                    iid = self.value_resolver.get_image_id_by_name(
-                        iname, did)
-                except KeyError:
-                    log.warn(
-                        "%s not found in image names" % iname)
-                assert i == len(image_column.values)
-                image_column.values.append(iid)
-                image_name_column.size = max(
-                    image_name_column.size, len(iname))
-            elif image_name_column is not None and (
-                    ScreenI is target_class or
-                    PlateI is target_class):
-                iid = image_column.values[i]
-                log.info("Checking image %s", iid)
-                pid = None
-                if 'Plate' in columns_by_name:
-                    pid = columns_by_name['Plate'].values[i]
-                iname = self.value_resolver.get_image_name_by_id(iid, pid)
-                image_name_column.values.append(iname)
-                image_name_column.size = max(
-                    image_name_column.size, len(iname)
-                )
-            else:
-                log.info('Missing image name column, skipping.')
+        if well_name_column is not None and well_column is not None:
+            names = self.value_resolver.get_well_names(well_column.values)
+            self.append_names(well_name_column, names, 'well')
+        else:
+            log.info('Missing well name column, skipping.')
+
+        if image_name_column is not None and (
+                DatasetI is target_class or
+                ProjectI is target_class):
+            dnames = None
+            if "Dataset Name" in columns_by_name:  # FIXME
+                dnames = columns_by_name["Dataset Name"].values
+            iids = self.value_resolver.get_image_ids_by_name(
+                image_name_column.values, dnames)
+            missing = iids.count(None)
+            if missing:
+                log.warn("%d of %d names not found in image names" % (
+                    missing, len(iids)))
+            assert not image_column.values
+            image_column.values.extend(
+                -1 if iid is None else iid for iid in iids)
+        elif image_name_column is not None and image_column is not None \
+                and (ScreenI is target_class or PlateI is target_class):
+            names = self.value_resolver.get_image_names(image_column.values)
+            self.append_names(image_name_column, names, 'image', True)
+        else:
+            log.info('Missing image name column, skipping.')
 
-            if plate_name_column is not None:
-                plate = columns_by_name['Plate'].values[i]   # FIXME
-                v = self.value_resolver.get_plate_name_by_id(plate)
-                plate_name_column.size = max(plate_name_column.size, len(v))
-                plate_name_column.values.append(v)
-            else:
-                log.info('Missing plate name column, skipping.')
+        if plate_name_column is not None:
+            plates = columns_by_name['Plate'].values   # FIXME
+            names = self.value_resolver.get_plate_names(plates)
+            self.append_names(plate_name_column, names, 'plate', True)
+        else:
+            log.info('Missing plate name column, skipping.')
 
     def write_to_omero(self, batch_size=1000, loops=10, ms=500):
         sf = self.client.getSession()
@@ -995,6 +1148,59 @@ class ParsingContext(object):
         original_file = table.getOriginalFile()
         log.info('Created new table OriginalFile:%d' % original_file.id.val)
 
+        if self.streaming:
+            self.write_batches(table, batch_size)
+        else:
+            self.write_columns(table, batch_size)
+
+        table.close()
+        file_annotation = FileAnnotationI()
+        file_annotation.ns = rstring(
+            'openmicroscopy.org/omero/bulk_annotations')
+        file_annotation.description = rstring(name)
+        file_annotation.file = OriginalFileI(original_file.id.val, False)
+        link = self.create_annotation_link()
+        link.parent = self.target_object
+        link.child = file_annotation
+        update_service.saveObject(link, {'omero.group': group})
+
+    def write_batches(self, table, batch_size):
+        """
+        Resolves and adds the rows of the file to the table batch_size rows
+        at a time.
+        """
+        widths = self.get_column_widths()
+        table.initialize(self.columns)
+        log.info('Table initialized with %d columns.' % (len(self.columns)))
+
+        i = 0
+        for rows in self.iter_batches(batch_size):
+            for column in self.columns:
+                column.values = []
+            self.populate(rows)
+            self.post_process()
+            for column, width in zip(self.columns, widths):
+                if width is not None and column.size > width:
+                    raise MetadataError(
+                        'Value of %d characters in column %s is longer '
+                        'than the column width of %d found when scanning '
+                        'the file (width_sample=%s)' % (
+                            column.size, column.name, width,
+                            self.width_sample))
+            count = len(self.columns[0].values)
+            if not count:
+                continue
+            i += 1
+            table.addData(self.columns)
+            log.info('Added %s rows of column data (batch %s)', count, i)
+        for column in self.columns:
+            column.values = None
+
+    def write_columns(self, table, batch_size):
+        """
+        Adds the values already held by the columns, as populated by
+        parse_from_handle(), to the table.
+        """
         values = []
         length = -1
         for x in self.columns:
@@ -1017,17 +1223,6 @@ class ParsingContext(object):
             count = min(batch_size, length - pos)
             log.info('Added %s rows of column data (batch %s)', count, i)
 
-        table.close()
-        file_annotation = FileAnnotationI()
-        file_annotation.ns = rstring(
-            'openmicroscopy.org/omero/bulk_annotations')
-        file_annotation.description = rstring(name)
-        file_annotation.file = OriginalFileI(original_file.id.val, False)
-        link = self.create_annotation_link()
-        link.parent = self.target_object
-        link.child = file_annotation
-        update_service.saveObject(link, {'omero.group': group})
-
 
 class _QueryContext(object):
     """
@@ -1173,6 +1368,7 @@ class BulkToMapAnnotationContext(_QueryContext):
 
         self.pkmap = {}
         self.mapannotations = MapAnnotationManager()
+        self.well_images = {}
         self._init_namespace_primarykeys()
 
         self.options = {}
@@ -1282,29 +1478,17 @@ class BulkToMapAnnotationContext(_QueryContext):
             links.append(link)
         return links, ma
 
-    def _save_annotation_links(self, links):
-        """
-        Save `AnnotationLinks` including the child annotation in one go.
-        See `_create_map_annotation_links`
-        """
-        sf = self.client.getSession()
-        group = str(self.target_object.details.group.id)
-        update_service = sf.getUpdateService()
-        arr = update_service.saveAndReturnArray(links, {'omero.group': group})
-        return arr
-
     def _save_annotation_and_links(self, links, ann, batch_size):
         """
         Save a single `Annotation`, followed by the `AnnotationLinks` to that
-        Annotation and return the number of links saved.
+        Annotation and return the number of links sent.
 
         All `AnnotationLinks` must have `ann` as their child.
-        Links will be saved in batches of `batch_size`.
+        Links will be sent in batches of `batch_size` by `_send_links`.
 
         See `_create_map_annotation_links`
         """
         sf = self.client.getSession()
-        group = str(self.target_object.details.group.id)
         update_service = sf.getUpdateService()
 
         annobj = update_service.saveAndReturnObject(ann)
@@ -1314,8 +1498,7 @@ class BulkToMapAnnotationContext(_QueryContext):
         for batch in self._batch(links, sz=batch_size):
             for link in batch:
                 link.setChild(annobj)
-            update_service.saveArray(
-                batch, {'omero.group': group})
+            self._send_links(batch)
             sz += len(batch)
         return sz
 
@@ -1335,13 +1518,45 @@ class BulkToMapAnnotationContext(_QueryContext):
         iids = []
         try:
             if self.advanced_cfgs['well_to_images'] and target[0] == 'Well':
-                q = 'SELECT image.id FROM WellSample WHERE well.id=:id'
-                iids = self.projection(q, target[1])
+                iids = self.well_images.get(target[1])
+                if iids is None:
+                    q = 'SELECT image.id FROM WellSample WHERE well.id=:id'
+                    iids = self.projection(q, target[1])
         except (KeyError, TypeError):
             pass
         return [('Image', i) for i in iids]
 
-    def populate(self, table):
+    def _load_additional_targets(self, idcols, data):
+        """
+        Loads the images of all the wells in a window of rows with a
+        single query, for use by `_get_additional_targets`
+        """
+        self.well_images = {}
+        try:
+            if not self.advanced_cfgs['well_to_images']:
+                return
+        except (KeyError, TypeError):
+            return
+        wellids = set()
+        for omerotype, n in idcols:
+            if omerotype == 'Well':
+                wellids.update(
+                    wid for wid in data.columns[n].values if wid > 0)
+        if wellids:
+            q = ('SELECT well.id, image.id FROM WellSample '
+                 'WHERE well.id IN (:ids)')
+            r = self.projection(q, list(wellids), batch_size=10000)
+            self.well_images = dict((wid, []) for wid in wellids)
+            for wid, iid in izip(r[::2], r[1::2]):
+                self.well_images[wid].append(iid)
+
+    def populate(self, table, window=10000):
+        """
+        Reads the table window rows at a time and adds a
+        `CanonicalMapAnnotation` for each row and namespace. Annotations
+        are de-duplicated across the whole table by the
+        `MapAnnotationManager`.
+        """
         def idcolumn_to_omeroclass(col):
             clsname = re.search('::(\w+)Column$', col.ice_staticId()).group(1)
             return clsname
@@ -1353,19 +1568,19 @@ class BulkToMapAnnotationContext(_QueryContext):
             ignore_missing_primary_key = False
 
         nrows = table.getNumberOfRows()
-        data = table.readCoordinates(range(nrows))
+        columns = table.getHeaders()
 
         # Don't create annotations on higher-level objects
         # idcoltypes = set(HeaderResolver.screen_keys.values())
         idcoltypes = set((ImageColumn, WellColumn))
         idcols = []
-        for n in xrange(len(data.columns)):
-            col = data.columns[n]
+        for n in xrange(len(columns)):
+            col = columns[n]
             if col.__class__ in idcoltypes:
                 omeroclass = idcolumn_to_omeroclass(col)
                 idcols.append((omeroclass, n))
 
-        headers = [c.name for c in data.columns]
+        headers = [c.name for c in columns]
         if self.default_cfg or self.column_cfgs:
             kvgl = KeyValueGroupList(
                 headers, self.default_cfg, self.column_cfgs)
@@ -1374,7 +1589,21 @@ class BulkToMapAnnotationContext(_QueryContext):
             trs = [KeyValueListPassThrough(headers)]
 
         selected_nss = self._get_selected_namespaces()
-        for row in izip(*(c.values for c in data.columns)):
+        start = time.time()
+        for pos in xrange(0, nrows, window):
+            stop = min(nrows, pos + window)
+            data = table.read(range(len(columns)), pos, stop)
+            self._load_additional_targets(idcols, data)
+            self._populate_rows(
+                izip(*(c.values for c in data.columns)), idcols, trs,
+                selected_nss, ignore_missing_primary_key)
+            elapsed = time.time() - start
+            log.info('Read %d/%d rows (%.0f rows/s)', stop, nrows,
+                     elapsed and (stop / elapsed) or 0)
+
+    def _populate_rows(self, rows, idcols, trs, selected_nss,
+                       ignore_missing_primary_key):
+        for row in rows:
             targets = []
             for omerotype, n in idcols:
                 if row[n] > 0:
@@ -1415,10 +1644,17 @@ class BulkToMapAnnotationContext(_QueryContext):
     def _write_log(self, text):
         log.debug("BulkToMapAnnotation:write_to_omero - %s" % text)
 
-    def write_to_omero(self, batch_size=1000, loops=10, ms=500):
-        i = 0
+    def write_to_omero(self, batch_size=1000, loops=10, ms=500, inflight=4):
+        """
+        Saves the annotation links in batches of up to batch_size,
+        keeping up to inflight asynchronous saveArray calls pending.
+        """
         cur = 0
         links = []
+        self._pending = deque()
+        self._inflight = max(inflight, 1)
+        self._written = 0
+        self._start = time.time()
 
         # This may be many-links-to-one-new-mapann so everything must
         # be kept together to avoid duplication of the mapann
@@ -1433,28 +1669,47 @@ class BulkToMapAnnotationContext(_QueryContext):
                 cur += len(batch)
                 if cur > 10 * batch_size:
                     self._write_log("running batches. accumulated: %s" % cur)
-                    i += self._write_links(links, batch_size, i)
+                    self._write_links(links, batch_size)
                     links = []
                     cur = 0
             else:
                 self._write_log("running grouped_batch")
-                sz = self._save_annotation_and_links(batch, ma, batch_size)
-                i += sz
-                log.info('Created/linked %d MapAnnotations (total %s)',
-                         sz, i)
+                self._save_annotation_and_links(batch, ma, batch_size)
         # Handle any remaining writes
-        i += self._write_links(links, batch_size, i)
+        self._write_links(links, batch_size)
+        while self._pending:
+            self._wait_links()
 
-    def _write_links(self, links, batch_size, i):
+    def _write_links(self, links, batch_size):
         count = 0
         for batch in self._grouped_batch(links, sz=batch_size):
             self._write_log("batch size: %s" % len(batch))
-            arr = self._save_annotation_links(batch)
-            count += len(arr)
-            log.info('Created/linked %d MapAnnotations (total %s)',
-                     len(arr), i+count)
+            self._send_links(batch)
+            count += len(batch)
         return count
 
+    def _send_links(self, batch):
+        """
+        Starts an asynchronous saveArray of batch, first waiting for the
+        oldest pending call if there are already `inflight` pending.
+        """
+        while len(self._pending) >= self._inflight:
+            self._wait_links()
+        group = str(self.target_object.details.group.id)
+        update_service = self.client.getSession().getUpdateService()
+        self._pending.append((update_service, len(batch),
+                              update_service.begin_saveArray(
+                                  batch, _ctx={'omero.group': group})))
+
+    def _wait_links(self):
+        update_service, count, result = self._pending.popleft()
+        update_service.end_saveArray(result)
+        self._written += count
+        elapsed = time.time() - self._start
+        log.info('Created/linked %d MapAnnotations (total %s, %.0f/s)',
+                 count, self._written,
+                 elapsed and (self._written / elapsed) or 0)
+
 
 class DeleteMapAnnotationContext(_QueryContext):
     """
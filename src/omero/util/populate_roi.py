@@ -29,7 +29,8 @@ import time
 import sys
 import csv
 import re
-from threading import Thread
+from threading import Thread, local
+from collections import deque
 from getpass import getpass
 from getopt import getopt, GetoptError
 from Queue import Queue
@@ -90,7 +91,12 @@ class Worker(Thread):
 
     def run(self):
         while True:
-            func, args, kargs = self.tasks.get()
+            task = self.tasks.get()
+            if task is None:
+                # Stop request from ThreadPool.resize()
+                self.tasks.task_done()
+                break
+            func, args, kargs = task
             try:
                 func(*args, **kargs)
             except Exception, e:
@@ -104,8 +110,25 @@ class ThreadPool:
 
     def __init__(self, num_threads):
         self.tasks = Queue(num_threads)
-        for _ in range(num_threads):
+        self.num_threads = 0
+        self.resize(num_threads)
+
+    def resize(self, num_threads):
+        """
+        Starts or stops workers so that num_threads are consuming the
+        queue. Surplus workers exit once they have finished their task.
+        """
+        self.tasks.mutex.acquire()
+        try:
+            self.tasks.maxsize = num_threads
+            self.tasks.not_full.notify_all()
+        finally:
+            self.tasks.mutex.release()
+        for _ in range(self.num_threads, num_threads):
             Worker(self.tasks)
+        for _ in range(num_threads, self.num_threads):
+            self.tasks.put(None)
+        self.num_threads = num_threads
 
     def add_task(self, func, *args, **kargs):
         """Add a task to the queue"""
@@ -118,14 +141,30 @@ class ThreadPool:
 # Global thread pool for use by ROI workers
 thread_pool = None
 
+# Number of workers in the global thread pool, see set_thread_count()
+thread_count = 1
+
 
 def get_thread_pool():
     global thread_pool
     if thread_pool is None:
-        thread_pool = ThreadPool(1)
+        thread_pool = ThreadPool(thread_count)
     return thread_pool
 
 
+def set_thread_count(count):
+    """
+    Sets the number of workers saving ROI in parallel. Each worker uses
+    its own update service proxy, see AbstractMeasurementCtx.update_rois.
+    An existing pool is resized rather than replaced so that its workers
+    are not leaked and contexts holding it keep a working pool.
+    """
+    global thread_count
+    thread_count = count
+    if thread_pool is not None:
+        thread_pool.resize(count)
+
+
 class MeasurementError(Exception):
 
     """
@@ -144,6 +183,12 @@ class DownloadingOriginalFileProvider(object):
     # Default raw file store buffer size
     BUFFER_SIZE = 1024 * 1024  # 1MB
 
+    # Number of asynchronous reads kept in flight while downloading
+    INFLIGHT = 4
+
+    # Number of files downloaded ahead by iter_original_file_data()
+    PREFETCH = 2
+
     def __init__(self, service_factory):
         self.service_factory = service_factory
         self.raw_file_store = self.service_factory.createRawFileStore()
@@ -159,14 +204,51 @@ class DownloadingOriginalFileProvider(object):
         self.raw_file_store.setFileId(original_file.id.val)
         temporary_file = tempfile.TemporaryFile(mode='rU+', dir=str(self.dir))
         size = original_file.size.val
-        for i in range((size / self.BUFFER_SIZE) + 1):
-            index = i * self.BUFFER_SIZE
-            data = self.raw_file_store.read(index, self.BUFFER_SIZE)
-            temporary_file.write(data)
+        pending = deque()
+        for index in xrange(0, size, self.BUFFER_SIZE):
+            if len(pending) >= self.INFLIGHT:
+                temporary_file.write(
+                    self.raw_file_store.end_read(pending.popleft()))
+            pending.append(
+                self.raw_file_store.begin_read(index, self.BUFFER_SIZE))
+        while pending:
+            temporary_file.write(
+                self.raw_file_store.end_read(pending.popleft()))
         temporary_file.seek(0L)
         temporary_file.truncate(size)
         return temporary_file
 
+    def iter_original_file_data(self, original_files):
+        """
+        Yields each of original_files with its data as returned by
+        get_original_file_data(). Up to PREFETCH files are downloaded
+        ahead by a background thread while the caller parses the current
+        one.
+        """
+        queue = Queue(self.PREFETCH)
+
+        def download():
+            try:
+                for original_file in original_files:
+                    data = self.get_original_file_data(original_file)
+                    queue.put((original_file, data, None))
+            except Exception:
+                queue.put((None, None, sys.exc_info()))
+            else:
+                queue.put(None)
+
+        thread = Thread(target=download)
+        thread.daemon = True
+        thread.start()
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            original_file, data, exc_info = item
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield original_file, data
+
     def __delete__(self):
         self.raw_file_store.close()
 
@@ -246,6 +328,23 @@ class AbstractPlateAnalysisCtx(object):
         """
         raise Exception("To be implemented by concrete implementations.")
 
+    def parse_and_populate(self, indexes=None):
+        """
+        Parses and populates the measurements at indexes, by default all.
+        Each measurement is downloaded and parsed in the background while
+        the ROI and table of the previous one are saved.
+        """
+        if indexes is None:
+            indexes = range(self.get_measurement_count())
+        previous = None
+        for index in indexes:
+            parser = MeasurementParser(self.get_measurement_ctx(index))
+            if previous is not None:
+                previous.populate()
+            previous = parser
+        if previous is not None:
+            previous.populate()
+
 
 class MIASPlateAnalysisCtx(AbstractPlateAnalysisCtx):
 
@@ -566,6 +665,35 @@ class PlateAnalysisCtxFactory(object):
             plate_id)
 
 
+class MeasurementParser(Thread):
+
+    """
+    Parses a measurement context in the background, see
+    AbstractPlateAnalysisCtx.parse_and_populate
+    """
+
+    def __init__(self, measurement_ctx):
+        Thread.__init__(self)
+        self.measurement_ctx = measurement_ctx
+        self.result = None
+        self.exc_info = None
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.measurement_ctx.parse()
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def populate(self):
+        """Waits for the parsing to finish and populates the result."""
+        self.join()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        self.measurement_ctx.populate_result(self.result)
+
+
 class MeasurementParsingResult(object):
 
     """
@@ -598,6 +726,7 @@ class AbstractMeasurementCtx(object):
                  original_file, result_files):
         super(AbstractMeasurementCtx, self).__init__()
         self.thread_pool = get_thread_pool()
+        self.local = local()
         self.analysis_ctx = analysis_ctx
         self.service_factory = service_factory
         self.original_file_provider = original_file_provider
@@ -696,18 +825,48 @@ class AbstractMeasurementCtx(object):
         name = self.get_name(set_of_columns)
         self.file_annotation.description = rstring(name)
 
+    def get_update_service(self):
+        """
+        Returns the update service proxy of the calling thread so that
+        each worker of the thread pool saves ROI with its own proxy.
+        """
+        try:
+            return self.local.update_service
+        except AttributeError:
+            self.local.update_service = \
+                self.service_factory.getUpdateService()
+            return self.local.update_service
+
     def update_rois(self, rois, batches, batch_no):
         """
         Updates a set of ROI for a given batch updating the batches
-        dictionary with the saved IDs.
+        dictionary with the saved IDs, or the exception raised.
         """
         log.debug("Saving %d ROI for batch %d" % (len(rois), batch_no))
         t0 = int(time.time() * 1000)
-        roi_ids = self.update_service.saveAndReturnIds(rois)
+        try:
+            roi_ids = self.get_update_service().saveAndReturnIds(rois)
+        except Exception, e:
+            batches[batch_no] = e
+            raise
         log.info("Batch %d ROI update took %sms" %
                  (batch_no, int(time.time() * 1000) - t0))
         batches[batch_no] = roi_ids
 
+    def wait_rois(self, batches):
+        """
+        Waits for the ROI batches queued on the thread pool and returns
+        the saved IDs in batch order.
+        """
+        self.thread_pool.wait_completion()
+        roi_ids = list()
+        for k in sorted(batches.keys()):
+            if isinstance(batches[k], Exception):
+                raise MeasurementError(
+                    "Failed to save ROI batch %d: %s" % (k, batches[k]))
+            roi_ids += batches[k]
+        return roi_ids
+
     def image_from_original_file(self, original_file):
         """Returns the image from which an original file has originated."""
         m = self.analysis_ctx.original_file_image_map
@@ -718,7 +877,13 @@ class AbstractMeasurementCtx(object):
         Calls parse and populate, updating the OmeroTables instance backing
         our results and the OMERO database itself.
         """
-        result = self.parse()
+        self.populate_result(self.parse())
+
+    def populate_result(self, result):
+        """
+        Populates the ROI and OmeroTables instances for a
+        MeasurementParsingResult returned by parse().
+        """
         if result is None:
             return
         for i, columns in enumerate(result.sets_of_columns):
@@ -818,11 +983,11 @@ class MIASMeasurementCtx(AbstractMeasurementCtx):
 
     def parse(self):
         columns = None
-        for result_file in self.result_files:
+        provider = self.original_file_provider
+        for result_file, data in provider.iter_original_file_data(
+                self.result_files):
             log.info("Parsing: %s" % result_file.name.val)
             image = self.image_from_original_file(result_file)
-            provider = self.original_file_provider
-            data = provider.get_original_file_data(result_file)
             try:
                 rows = list(csv.reader(data, delimiter='\t'))
             finally:
@@ -880,11 +1045,7 @@ class MIASMeasurementCtx(AbstractMeasurementCtx):
                 rois = list()
                 batch_no += 1
         self.thread_pool.add_task(self.update_rois, rois, batches, batch_no)
-        self.thread_pool.wait_completion()
-        batch_keys = batches.keys()
-        batch_keys.sort()
-        for k in batch_keys:
-            columns[self.ROI_COL].values += batches[k]
+        columns[self.ROI_COL].values += self.wait_rois(batches)
 
     def _parse_mnu_roi(self, columns):
         """Parses out ROI from OmeroTables columns for 'MNU' datasets."""
@@ -919,11 +1080,7 @@ class MIASMeasurementCtx(AbstractMeasurementCtx):
                 rois = list()
                 batch_no += 1
         self.thread_pool.add_task(self.update_rois, rois, batches, batch_no)
-        self.thread_pool.wait_completion()
-        batch_keys = batches.keys()
-        batch_keys.sort()
-        for k in batch_keys:
-            columns[self.ROI_COL].values += batches[k]
+        columns[self.ROI_COL].values += self.wait_rois(batches)
 
     def parse_and_populate_roi(self, columns):
         names = [column.name for column in columns]
@@ -1255,11 +1412,7 @@ class InCellMeasurementCtx(AbstractMeasurementCtx):
                 rois = list()
                 batch_no += 1
         self.thread_pool.add_task(self.update_rois, rois, batches, batch_no)
-        self.thread_pool.wait_completion()
-        batch_keys = batches.keys()
-        batch_keys.sort()
-        for k in batch_keys:
-            columns['ROI'].values += batches[k]
+        columns['ROI'].values += self.wait_rois(batches)
 
     def populate(self, columns):
         self.update_table(columns)
@@ -1319,7 +1472,7 @@ if __name__ == "__main__":
             service_factory = c.createSession(username, password)
 
         log.debug('Creating pool of %d threads' % thread_count)
-        thread_pool = ThreadPool(thread_count)
+        set_thread_count(thread_count)
         factory = PlateAnalysisCtxFactory(service_factory)
         analysis_ctx = factory.get_analysis_ctx(plate_id)
         n_measurements = analysis_ctx.get_measurement_count()
@@ -1335,8 +1488,6 @@ if __name__ == "__main__":
             measurement_ctx = analysis_ctx.get_measurement_ctx(measurement)
             measurement_ctx.parse_and_populate()
         else:
-            for i in range(n_measurements):
-                measurement_ctx = analysis_ctx.get_measurement_ctx(i)
-                measurement_ctx.parse_and_populate()
+            analysis_ctx.parse_and_populate()
     finally:
         c.closeSession()
@@ -349,6 +349,13 @@ class TestGetObject (object):
             "Project", None, opts={'offset': 0, 'limit': 2}))
         assert len(pros) == limit
 
+        # Keyset pagination returns all, ordered by ID
+        allIds = sorted([p.id for p in gatewaywrapper.gateway.getObjects(
+            "Project")])
+        pros = list(gatewaywrapper.gateway.getObjects(
+            "Project", None, opts={'page_size': limit}))
+        assert [p.id for p in pros] == allIds
+
     def testGetDatasetsByProject(self, gatewaywrapper):
         gatewaywrapper.loginAsAuthor()
         allDs = list(gatewaywrapper.gateway.getObjects("Dataset"))
@@ -607,6 +614,28 @@ class TestGetObject (object):
             else:
                 assert not pixels.isChannelsLoaded()
 
+    def testGetImagesPrefetch(self, gatewaywrapper, author_testimg_tiny):
+        testImage = author_testimg_tiny
+        conn = gatewaywrapper.gateway
+        prefetch = ('annotations', 'pixels', 'owners')
+        dataset = testImage.getParent()
+        for images in (
+                list(conn.getObjects("Image", [testImage.id],
+                                     prefetch=prefetch)),
+                list(dataset.listChildren(prefetch=prefetch))):
+            assert testImage.id in [i.id for i in images]
+            for image in images:
+                assert image._obj.isAnnotationLinksLoaded()
+                assert image._obj.isPixelsLoaded()
+                assert image._obj.details.owner.isLoaded()
+                expected = conn.getObject("Image", image.id)
+                assert (image.getPrimaryPixels().id ==
+                        expected.getPrimaryPixels().id)
+                assert (image.getOwner().omeName ==
+                        expected.getOwner().omeName)
+                assert (sorted([a.id for a in image.listAnnotations()]) ==
+                        sorted([a.id for a in expected.listAnnotations()]))
+
     def testGetProject(self, gatewaywrapper):
         gatewaywrapper.loginAsAuthor()
         testProj = gatewaywrapper.getTestProject()
@@ -716,6 +745,10 @@ class TestGetObject (object):
         reverseIds = [i.id for i in reverseImages]
         assert len(imageIds) - 1 == len(reverseIds), \
             "One image not found by ID: 0"
+        # Streamed in pages
+        reverseImages = gatewaywrapper.gateway.getObjects(
+            "Image", imageIds, respect_order=True, opts={'page_size': 2})
+        assert imageIds == [i.id for i in reverseImages]
 
         # Delete to clean up
         handle = gatewaywrapper.gateway.deleteObjects(
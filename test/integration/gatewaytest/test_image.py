@@ -100,6 +100,27 @@ class TestImage (object):
                 image_ids=[badimg_id])[badimg_id]
         # Big image (4k x 4k and up) thumb
 
+    def testThumbnails(self, author_testimg_bad, author_testimg_big):
+        conn = self.image._conn
+        badimg_id = author_testimg_bad.id  # no pixels
+        img_ids = [self.image.id, author_testimg_big.id, badimg_id, -1]
+        thumbs, errors = conn.getThumbnails(img_ids, size=(96,), threads=2,
+                                            batchSize=1)
+        assert set(thumbs) == set([self.image.id, author_testimg_big.id])
+        assert set(errors) == set([badimg_id, -1])
+        for img_id, thumb in thumbs.items():
+            assert thumb == conn.getObject("Image", img_id).getThumbnail(
+                size=(96,))
+            tfile = StringIO(thumb)
+            thumb = Image.open(tfile)  # Raises if invalid
+            thumb.verify()  # Raises if invalid
+            assert thumb.format == 'JPEG'
+            assert thumb.size == (96, 96)
+        # Wrappers and z/t
+        thumbs, errors = conn.getThumbnails([self.image], z=0, t=0)
+        assert not errors
+        assert thumbs[self.image.id] == self.image.getThumbnail(z=0, t=0)
+
     def testRenderingModels(self):
         # default is color model
         cimg = self.image.renderJpeg(0, 0)
@@ -176,6 +197,16 @@ class TestImage (object):
         assert badimage.renderColLinePlotGif(z=0, t=0, x=1) is None
         assert badimage.renderRowLinePlotGif(z=0, t=0, y=1) is None
 
+    def testPixelLines(self):
+        rows = [self.image.getRow(z=0, t=0, y=y) for y in (0, 1, 2)]
+        assert rows == self.image.getPixelLine(0, 0, [0, 1, 2], 'h')
+        assert len(rows[0][0]) == self.image.getSizeX()
+        cols = self.image.getPixelLine(0, 0, [1, 2], 'v', asarray=True)
+        assert len(cols) == 2
+        for x, col in zip((1, 2), cols):
+            assert [c.tolist() for c in col] == self.image.getCol(
+                z=0, t=0, x=x)
+
     def testProjections(self):
         """ Test image projections """
         for p in self.image.getProjections():
@@ -32,6 +32,7 @@ import os.path
 import re
 import shutil
 import sys
+import time
 
 from omero.api import RoiOptions
 from omero.grid import ImageColumn
@@ -49,11 +50,14 @@ from omero.util.populate_metadata import (
     ParsingContext,
     BulkToMapAnnotationContext,
     DeleteMapAnnotationContext,
+    MetadataError,
 )
 from omero.util.populate_roi import AbstractMeasurementCtx
 from omero.util.populate_roi import AbstractPlateAnalysisCtx
+from omero.util.populate_roi import MeasurementError
 from omero.util.populate_roi import MeasurementParsingResult
 from omero.util.populate_roi import PlateAnalysisCtxFactory
+from omero.util.populate_roi import set_thread_count
 from omero.constants.namespaces import NSBULKANNOTATIONS
 from omero.constants.namespaces import NSMEASUREMENT
 from omero.util.temp_files import create_path
@@ -939,7 +943,8 @@ class TestPopulateMetadataHelper(ITest):
             elif "A2" in rowValues or "a2" in rowValues:
                 assert "Treatment" in rowValues
 
-    def _test_bulk_to_map_annotation_context(self, fixture, batch_size):
+    def _test_bulk_to_map_annotation_context(self, fixture, batch_size,
+                                             window=None, inflight=None):
         # self._testPopulateMetadataPlate()
         assert len(fixture.get_all_map_annotations()) == 0
         assert len(fixture.get_child_annotations()) == 0
@@ -951,13 +956,24 @@ class TestPopulateMetadataHelper(ITest):
         fileid = anns[0].file.id.val
         ctx = BulkToMapAnnotationContext(
             self.client, target, fileid=fileid, cfg=cfg)
-        ctx.parse()
+        if window is None:
+            ctx.parse()
+        else:
+            r = self.client.sf.sharedResources()
+            t = r.openTable(OriginalFileI(fileid), None)
+            try:
+                assert t.getNumberOfRows() > window
+                ctx.populate(t, window=window)
+            finally:
+                t.close()
         assert len(fixture.get_child_annotations()) == 0
 
         if batch_size is None:
             ctx.write_to_omero()
-        else:
+        elif inflight is None:
             ctx.write_to_omero(batch_size=batch_size)
+        else:
+            ctx.write_to_omero(batch_size=batch_size, inflight=inflight)
         oas = fixture.get_child_annotations()
         assert len(oas) == fixture.annCount
         fixture.assert_child_annotations(oas)
@@ -1055,6 +1071,38 @@ class TestPopulateMetadata(TestPopulateMetadataHelper):
         self._test_bulk_to_map_annotation_context(fixture, 2)
         self._test_delete_map_annotation_context(fixture, 2)
 
+    def testPopulateMetadataNsAnnsWindow(self):
+        """
+        Read the table a few rows at a time, keeping several saves in
+        flight, and check that the same annotations are created
+        """
+        fixture = Plate2WellsNs()
+        fixture.init(self)
+        self._test_parsing_context(fixture, 2)
+        self._test_bulk_to_map_annotation_context(
+            fixture, 1, window=3, inflight=3)
+        self._test_delete_map_annotation_context(fixture, 1)
+
+    def testPopulateMetadataWidthSample(self):
+        """
+        Column widths taken from a sample of rows must hold every value
+        """
+        fixture = Plate2Wells()
+        fixture.init(self)
+        target = fixture.get_target()
+        ctx = ParsingContext(self.client, target, file=fixture.get_csv(),
+                             width_sample=1, streaming=True)
+        ctx.parse()
+        # "Treatment" in the second row is longer than "Control"
+        with raises(MetadataError):
+            ctx.write_to_omero(batch_size=1)
+
+        ctx = ParsingContext(self.client, target, file=fixture.get_csv(),
+                             width_sample=2, streaming=True)
+        ctx.parse()
+        ctx.write_to_omero(batch_size=1)
+        assert len(fixture.get_annotations()) == 1
+
     def testPopulateMetadataNsAnnsUnavailableHeader(self):
         """
         Similar to testPopulateMetadataNsAnns but use two plates and check
@@ -1363,8 +1411,58 @@ class MockMeasurementCtx(AbstractMeasurementCtx):
         self.update_table(columns)
 
 
+class MockBatchedMeasurementCtx(MockMeasurementCtx):
+
+    """Saves the ROI in batches through the thread pool"""
+
+    def parse(self):
+        provider = self.original_file_provider
+        data = provider.get_original_file_data(self.original_file)
+        try:
+            rows = list(csv.reader(data, delimiter=","))
+        finally:
+            data.close()
+
+        columns = [
+            ImageColumn("Image", "", list()),
+            RoiColumn("ROI", "", list()),
+            StringColumn("Type", "", 12, list()),
+        ]
+
+        rois = list()
+        batches = dict()
+        batch_no = 1
+        for row in rows[1:]:
+            wellnumber = self.well_name_to_number(row[0])
+            image = self.analysis_ctx.\
+                image_from_wellnumber(wellnumber)
+            roi = RoiI()
+            shape = PointI()
+            shape.x = rdouble(float(row[2]))
+            shape.y = rdouble(float(row[3]))
+            shape.textValue = rstring(row[4])
+            roi.addShape(shape)
+            roi.image = image.proxy()
+            rois.append(roi)
+            if len(rois) == self.ROI_UPDATE_LIMIT:
+                self.thread_pool.add_task(
+                    self.update_rois, rois, batches, batch_no)
+                rois = list()
+                batch_no += 1
+
+            columns[0].values.append(image.id.val)
+            columns[2].values.append(row[4])
+
+        self.thread_pool.add_task(
+            self.update_rois, rois, batches, batch_no)
+        columns[1].values = self.wait_rois(batches)
+        return MeasurementParsingResult([columns])
+
+
 class MockPlateAnalysisCtx(AbstractPlateAnalysisCtx):
 
+    MEASUREMENT_CTX = MockMeasurementCtx
+
     def __init__(self, images, original_files,
                  original_file_image_map,
                  plate_id, service_factory):
@@ -1392,7 +1490,7 @@ class MockPlateAnalysisCtx(AbstractPlateAnalysisCtx):
     def get_measurement_ctx(self, index):
         sf = self.service_factory
         provider = self.DEFAULT_ORIGINAL_FILE_PROVIDER(sf)
-        return MockMeasurementCtx(
+        return self.MEASUREMENT_CTX(
             self, sf, provider,
             self.measurements[index], None)
 
@@ -1400,14 +1498,34 @@ class MockPlateAnalysisCtx(AbstractPlateAnalysisCtx):
         return 1
 
 
+class MockBatchedPlateAnalysisCtx(MockPlateAnalysisCtx):
+
+    MEASUREMENT_CTX = MockBatchedMeasurementCtx
+
+
+class MockUpdateService(object):
+
+    """
+    Returns ten times each ROI "id", failing for the "bad" ones. The first
+    batch is the slowest so that later batches are saved before it.
+    """
+
+    def saveAndReturnIds(self, rois):
+        if 1 in rois:
+            time.sleep(0.5)
+        if "bad" in rois:
+            raise Exception("bad ROI")
+        return [roi * 10 for roi in rois]
+
+
 class ROICSV(Fixture):
 
-    def __init__(self):
+    def __init__(self, rowData=("A1,0,15,15,Test",)):
         self.count = 1
         self.annCount = 2
         self.csvName = self.createCsv(
             colNames="Well,Field,X,Y,Type",
-            rowData=("A1,0,15,15,Test",))
+            rowData=rowData)
 
         self.rowCount = 1
         self.colCount = 1
@@ -1480,3 +1598,90 @@ class TestPopulateRois(ITest):
         rois = self.client.sf.getRoiService()
         anns = rois.getRoiMeasurements(imag, RoiOptions())
         assert anns
+
+    def link_csv(self, fixture):
+        """Links the fixture CSV to its plate and returns the plate"""
+        fixture.init(self)
+        plate = fixture.get_target()
+        ofile = self.client.upload(fixture.csvName).proxy()
+        ann = FileAnnotationI()
+        ann.file = ofile
+        link = PlateAnnotationLinkI()
+        link.parent = plate.proxy()
+        link.child = ann
+        self.client.sf.getUpdateService().saveObject(link)
+        return plate
+
+    def testPopulateRoisPlateThreads(self, monkeypatch):
+        """
+            As testPopulateRoisPlate but saving more than ROI_UPDATE_LIMIT
+            ROI in batches through a pool of two workers, checking that
+            the ROI column follows the order of the CSV rows
+        """
+        types = ["T%s" % i for i in range(7)]
+        fixture = ROICSV(rowData=[
+            "A1,0,%s,15,%s" % (i, t) for i, t in enumerate(types)])
+        plate = self.link_csv(fixture)
+
+        monkeypatch.setattr(MockBatchedMeasurementCtx, "ROI_UPDATE_LIMIT", 2)
+        set_thread_count(2)
+        try:
+            factory = PlateAnalysisCtxFactory(self.client.sf)
+            factory.implementations = (MockBatchedPlateAnalysisCtx,)
+            ctx = factory.get_analysis_ctx(plate.id.val)
+            ctx.parse_and_populate()
+        finally:
+            set_thread_count(1)
+
+        query = """select a.file.id from PlateAnnotationLink l
+            join l.child as a where l.parent.id = :id and a.ns = :ns"""
+        params = ParametersI().addId(plate.id.val)
+        params.addString("ns", NSMEASUREMENT)
+        qs = self.client.sf.getQueryService()
+        fileids = unwrap(qs.projection(query, params))
+        assert 1 == len(fileids)
+        t = self.client.sf.sharedResources().openTable(
+            OriginalFileI(fileids[0][0]), None)
+        try:
+            assert len(types) == t.getNumberOfRows()
+            data = t.read([1, 2], 0, len(types))
+        finally:
+            t.close()
+        roi_ids = data.columns[0].values
+        assert types == data.columns[1].values
+
+        query = """select r.id, s.textValue from Roi r join r.shapes s
+            where r.id in (:ids)"""
+        text = dict(unwrap(qs.projection(
+            query, ParametersI().addIds(roi_ids))))
+        assert types == [text[roi_id] for roi_id in roi_ids]
+
+    def testPopulateRoisBatchOrder(self):
+        """
+            Batches saved out of order are returned in batch order by
+            wait_rois and a failed batch is raised as a MeasurementError
+        """
+        plate = self.link_csv(ROICSV())
+        factory = PlateAnalysisCtxFactory(self.client.sf)
+        factory.implementations = (MockPlateAnalysisCtx,)
+        ctx = factory.get_analysis_ctx(plate.id.val)
+        meas = ctx.get_measurement_ctx(0)
+        meas.get_update_service = MockUpdateService
+
+        set_thread_count(3)
+        try:
+            batches = dict()
+            for batch_no, rois in enumerate([[1, 2], [3, 4], [5]], 1):
+                meas.thread_pool.add_task(
+                    meas.update_rois, rois, batches, batch_no)
+            assert [10, 20, 30, 40, 50] == meas.wait_rois(batches)
+
+            batches = dict()
+            for batch_no, rois in enumerate([[1], ["bad"], [3]], 1):
+                meas.thread_pool.add_task(
+                    meas.update_rois, rois, batches, batch_no)
+            with raises(MeasurementError) as e:
+                meas.wait_rois(batches)
+            assert "batch 2" in str(e.value)
+        finally:
+            set_thread_count(1)
@@ -71,3 +71,39 @@ class TestFiles(ITest):
         sha1_download = self.client.sha1(str(downloaded))
         assert sha1_upload == sha1_download, "%s!=%s" % (
             sha1_upload, sha1_download)
+
+    def testUploadDownloadInFlight(self):
+        uploaded = create_path()
+        uploaded.write_bytes("".join(chr(x % 256) for x in range(10000)))
+        seen = []
+
+        def progress(done, size, rate):
+            seen.append((done, size))
+
+        ofile = self.client.upload(
+            str(uploaded), block_size=1000, inflight=3, progress=progress)
+        assert (10000, 10000) == seen[-1]
+        assert 10 == len(seen)
+        assert self.client.sha1(str(uploaded)) == ofile.hash.val
+        assert 10000 == ofile.size.val
+
+        downloaded = create_path()
+        self.client.download(ofile, str(downloaded), block_size=999,
+                             inflight=3)
+        assert uploaded.bytes() == downloaded.bytes()
+
+    def testResumeDownload(self):
+        uploaded = tmpfile()
+        ofile = self.client.upload(str(uploaded), type="text/plain")
+        downloaded = create_path()
+        downloaded.write_bytes(uploaded.bytes()[:5])
+        self.client.download(ofile, str(downloaded), resume=True)
+        assert uploaded.bytes() == downloaded.bytes()
+
+    def testResumeUpload(self):
+        uploaded = tmpfile()
+        ofile = self.client.upload(str(uploaded), type="text/plain")
+        ofile = self.client.upload(
+            str(uploaded), ofile=ofile, block_size=4, inflight=1,
+            resume=True)
+        assert self.client.sha1(str(uploaded)) == ofile.hash.val
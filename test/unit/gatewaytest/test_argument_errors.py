@@ -56,3 +56,11 @@ class TestArgumentErrors(object):
             self.g.deleteObjects("Image", object_ids)
         with pytest.raises(AttributeError):
             self.g.chgrpObjects("Image", object_ids, 1L)
+
+    @pytest.mark.parametrize("prefetch", [("owner",), ("pixels", "rois")])
+    def test_bad_prefetch(self, prefetch):
+        """
+        prefetch must only name supported relationships
+        """
+        with pytest.raises(AttributeError):
+            list(self.g.getObjects("Image", prefetch=prefetch))
@@ -23,10 +23,15 @@
 
 from omero.gateway import _BlitzGateway, BlitzObjectWrapper, KNOWN_WRAPPERS
 from omero.sys import Parameters, ParametersI, Filter
+from omero.model import ImageI
 import pytest
 from omero.rtypes import wrap
 
 
+# Types whose queries always load a collection
+COLLECTION_TYPES = ["plate", "experimenter", "experimentergroup", "fileset"]
+
+
 @pytest.fixture(scope='function')
 def gateway():
     """Create a BlitzGateway object."""
@@ -87,3 +92,106 @@ class TestBuildQuery(object):
             assert isinstance(wrapper(), BlitzObjectWrapper)
             assert params.theFilter.offset.val == offset
             assert params.theFilter.limit.val == limit
+
+    @pytest.mark.parametrize("dtype", [
+        k for k in KNOWN_WRAPPERS.keys() if k not in COLLECTION_TYPES])
+    def test_page_size(self, gateway, dtype):
+        """Query should use keyset pagination on obj.id."""
+        query, params, wrapper = gateway.buildQuery(
+            dtype, opts={'page_size': 50})
+        assert "obj.id > :lastId" in query
+        assert query.endswith(" order by obj.id")
+        assert params.map["lastId"].val == -1
+        assert params.theFilter.offset.val == 0
+        assert params.theFilter.limit.val == 50
+
+    @pytest.mark.parametrize("opts", [
+        {'page_size': 50, 'order_by': 'obj.name'},
+        {'page_size': 50, 'offset': 0, 'limit': 10}])
+    def test_page_size_conflicts(self, gateway, opts):
+        """page_size can't be combined with other ordering or paging."""
+        with pytest.raises(AttributeError):
+            gateway.buildQuery("Image", opts=opts)
+
+    @pytest.mark.parametrize("dtype, opts", [
+        (dtype, {}) for dtype in COLLECTION_TYPES] + [
+        ("Image", {'load_pixels': True}),
+        ("Roi", {'load_shapes': True})])
+    def test_page_size_collections(self, gateway, dtype, opts):
+        """page_size can't be used when loading collections."""
+        opts['page_size'] = 50
+        with pytest.raises(AttributeError):
+            gateway.buildQuery(dtype, opts=opts)
+
+
+class MockQueryService(object):
+    """Returns an Image for each of the 'ids' in the query parameters."""
+
+    def __init__(self):
+        self.calls = []
+
+    def findAllByQuery(self, query, params, ctx=None):
+        ids = [i.val for i in params.map["ids"].val]
+        self.calls.append(ids)
+        return [ImageI(i, True) for i in ids]
+
+
+class TestQueryBatches(object):
+    """Test splitting of long id lists by getObjects() etc."""
+
+    @pytest.mark.parametrize("threads", [1, 3])
+    def test_query_batches(self, gateway, threads):
+        gateway.QUERY_BATCH_THREADS = threads
+        ids = range(10)
+        rv = list(gateway._queryBatches(ids, lambda b: b, size=3))
+        assert rv == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+
+    @pytest.mark.parametrize("threads", [1, 3])
+    def test_query_batches_error(self, gateway, threads):
+        gateway.QUERY_BATCH_THREADS = threads
+
+        def query(batch):
+            if 4 in batch:
+                raise ValueError(batch)
+            return batch
+        rv = gateway._queryBatches(range(10), query, size=3)
+        assert next(rv) == [0, 1, 2]
+        with pytest.raises(ValueError):
+            next(rv)
+
+    @pytest.mark.parametrize("threads", [1, 2])
+    def test_get_objects(self, gateway, monkeypatch, threads):
+        qs = MockQueryService()
+        monkeypatch.setattr(gateway, "getQueryService", lambda: qs)
+        gateway.SERVICE_OPTS = dict()
+        gateway.QUERY_BATCH_SIZE = 4
+        gateway.QUERY_BATCH_THREADS = threads
+        ids = [9, 3, 7, 1, 5, 2, 8, 6, 4]
+        rv = gateway.getObjects("Image", ids, respect_order=True)
+        assert [i.id for i in rv] == ids
+        assert qs.calls == [ids[0:4], ids[4:8], ids[8:]]
+        # Sorted with page_size
+        qs.calls = []
+        rv = gateway.getObjects("Image", ids, opts={'page_size': 3})
+        assert [i.id for i in rv] == sorted(ids)
+        assert len(qs.calls) == 3
+
+    def test_annotation_links(self, gateway, monkeypatch):
+        calls = []
+
+        class MockLinkService(object):
+            def findAllByQuery(self, query, params, ctx=None):
+                calls.append([i.val for i in params.map["pids"].val])
+                return []
+        monkeypatch.setattr(gateway, "getQueryService", MockLinkService)
+        gateway.SERVICE_OPTS = dict()
+        gateway.QUERY_BATCH_SIZE = 4
+        ids = range(9)
+        assert [] == list(gateway.getAnnotationLinks("Image", ids))
+        assert calls == [ids[0:4], ids[4:8], ids[8:]]
+        # Paging must apply to the whole result, not to each batch
+        calls[:] = []
+        params = ParametersI().page(0, 5)
+        assert [] == list(gateway.getAnnotationLinks(
+            "Image", ids, params=params))
+        assert calls == [ids]
@@ -12,6 +12,8 @@
 from omero.gateway.utils import ServiceOptsDict
 from omero.gateway.utils import toBoolean
 from omero.gateway.utils import propertiesToDict
+from omero.gateway.utils import PixelsCache
+import numpy
 import pytest
 
 
@@ -304,3 +306,67 @@ class TestHelpers (object):
 
         assert dictprop['str']['1']['enabled'] == 't'
         assert dictprop['str']['2']['enabled'] == 'f'
+
+
+class TestPixelsCache (object):
+
+    def test_lru(self):
+        cache = PixelsCache(maxBytes=10)
+        cache.put("a", "1234")
+        cache.put("b", "1234")
+        assert cache.get("a") == "1234"
+        cache.put("c", "1234")
+        assert "b" not in cache
+        assert cache.get("b") is None
+        assert cache.get("a") == "1234"
+        assert cache.get("c") == "1234"
+        stats = cache.getStats()
+        assert stats["hits"] == 3
+        assert stats["misses"] == 1
+        assert stats["evictions"] == 1
+        assert stats["bytes"] == 8
+
+    def test_too_large(self):
+        cache = PixelsCache(maxBytes=10)
+        cache.put("a", "x" * 11)
+        assert "a" not in cache
+        assert cache.getStats()["bytes"] == 0
+
+    def test_replace(self):
+        cache = PixelsCache(maxBytes=10)
+        cache.put("a", "1234")
+        cache.put("a", "123456")
+        assert cache.get("a") == "123456"
+        assert cache.getStats()["bytes"] == 6
+
+    def test_ndarray(self):
+        cache = PixelsCache(maxBytes=1024)
+        plane = numpy.zeros((8, 8), dtype=numpy.uint16)
+        cache.put(("tile", 1L, 2L, 0, 0, 0, None), plane)
+        assert cache.getStats()["bytes"] == plane.nbytes
+        assert cache.get(("tile", 1L, 2L, 0, 0, 0, None)) is plane
+
+    def test_spill(self, tmpdir):
+        directory = str(tmpdir.join("cache"))
+        cache = PixelsCache(maxBytes=128, directory=directory,
+                            maxDiskBytes=256)
+        planes = [numpy.ones((8, 8), dtype=numpy.uint8) * i
+                  for i in range(5)]
+        for i, plane in enumerate(planes):
+            cache.put(i, plane)
+        cache.put("jpeg", "x" * 64)
+        stats = cache.getStats()
+        assert stats["entries"] == 2
+        assert stats["diskEntries"] == 4
+        assert stats["diskBytes"] == 256
+        # Promoted back into memory, evicting 4 to disk
+        assert (cache.get(1) == planes[1]).all()
+        assert 1 not in cache._disk
+        assert 4 in cache._disk
+        # The disk is full so the oldest spilled entry is removed
+        cache.put("other", "y" * 64)
+        assert 0 not in cache
+        assert cache.get("jpeg") == "x" * 64
+        cache.clear()
+        assert len(cache) == 0
+        assert tmpdir.join("cache").listdir() == []
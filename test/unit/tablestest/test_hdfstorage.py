@@ -10,6 +10,7 @@
 """
 
 import time
+import numpy
 import pytest
 import omero.columns
 import logging
@@ -135,6 +136,37 @@ class TestHdfStorage(TestCase):
         hdf.readCoordinates(hdf._stamp, [0, 1], self.current)
         hdf.cleanup()
 
+    def testModifySparseRows(self):
+        hdf = HdfStorage(self.hdfpath(), self.lock)
+        self.init(hdf, True)
+        for i in range(6):
+            self.append(hdf, {"a": i, "b": i, "c": i})
+        # Unordered, with gaps and a duplicate which must win last
+        rows = [4, 0, 1, 5, 0]
+        col = omero.columns.LongColumnI("b", "", [40, 0, 10, 50, 100])
+        data = omero.grid.Data(columns=[col], rowNumbers=rows)
+        hdf.update(hdf._stamp, data)
+        data = hdf.read(hdf._stamp, [0, 1], 0, 6, self.current)
+        assert [0, 1, 2, 3, 4, 5] == data.columns[0].values
+        assert [100, 10, 2, 3, 40, 50] == data.columns[1].values
+        hdf.cleanup()
+
+    def testColumnsToRecords(self):
+        cols = [omero.columns.LongColumnI("l", "", [1, 2, 3]),
+                omero.columns.DoubleColumnI("d", "", [0.5, 1.5, 2.5]),
+                omero.columns.StringColumnI("s", "", 2, ["a", "bc", ""])]
+        arrays = []
+        dtypes = []
+        for col in cols:
+            arrays.extend(col.arrays())
+            dtypes.extend(col.dtypes())
+        expected = numpy.array(zip(*arrays), dtype=dtypes)
+        records = storage_module.columns2records(arrays, dtypes, 3)
+        assert (expected == records).all()
+        arrays = [numpy.asarray(a) for a in arrays]
+        records = storage_module.columns2records(arrays, dtypes, 3)
+        assert (expected == records).all()
+
     def testReadTicket1951(self):
         hdf = HdfStorage(self.hdfpath(), self.lock)
         self.init(hdf, True)
@@ -143,6 +175,138 @@ class TestHdfStorage(TestCase):
         hdf.read(hdf._stamp, [0, 1, 2], 0, 1, self.current)
         hdf.cleanup()
 
+    def testReadColumnSubset(self):
+        hdf = HdfStorage(self.hdfpath(), self.lock)
+        self.init(hdf, True)
+        self.append(hdf, {"a": 1, "b": 2, "c": 3})
+        self.append(hdf, {"a": 5, "b": 6, "c": 7})
+        data = hdf.read(hdf._stamp, [2, 0], 0, 2, self.current)
+        assert ["c", "a"] == [col.name for col in data.columns]
+        assert [3, 7] == data.columns[0].values
+        assert [1, 5] == data.columns[1].values
+        data = hdf.slice(hdf._stamp, [1], [1], self.current)
+        assert [6] == data.columns[0].values
+        hdf.cleanup()
+
+    def testReadNdarray(self):
+        hdf = HdfStorage(self.hdfpath(), self.lock)
+        self.init(hdf, True)
+        self.append(hdf, {"a": 1, "b": 2, "c": 3})
+        self.append(hdf, {"a": 5, "b": 6, "c": 7})
+
+        data = hdf.read(hdf._stamp, [0, 1], 0, 2, self.current)
+        assert isinstance(data.columns[0].values, list)
+
+        self.current.ctx = {storage_module.NDARRAY: "true"}
+        data = hdf.read(hdf._stamp, [0, 1], 0, 2, self.current)
+        assert isinstance(data.columns[0].values, numpy.ndarray)
+        assert [1, 5] == data.columns[0].values.tolist()
+        data = hdf.readCoordinates(hdf._stamp, [1], self.current)
+        assert [7] == data.columns[2].values.tolist()
+        hdf.cleanup()
+
+    def testAggregate(self, monkeypatch):
+        monkeypatch.setattr(storage_module, "CHUNKSIZE", 2)
+        hdf = HdfStorage(self.hdfpath(), self.lock)
+        self.init(hdf, True)
+        for x in range(5):
+            self.append(hdf, {"a": x, "b": x % 2, "c": 3})
+
+        rv = hdf.aggregate(hdf._stamp, 0, storage_module.AGGREGATES,
+                           None, None, None, None)
+        assert 5 == rv["count"]
+        assert 10 == rv["sum"]
+        assert 0 == rv["min"]
+        assert 4 == rv["max"]
+        assert 2.0 == rv["mean"]
+        pytest.assertAlmostEqual(numpy.std(range(5)), rv["std"])
+
+        rv = hdf.aggregate(hdf._stamp, 0, ["count", "sum"], "(b==1)", None,
+                           None, None, bins=2, quantiles=[0.5])
+        assert 2 == rv["count"]
+        assert 4 == rv["sum"]
+        assert [1, 1] == rv["histogram"]
+        assert [1.0, 2.0, 3.0] == rv["bins"]
+        assert [2.0] == rv["quantiles"]
+
+        rv = hdf.aggregate(hdf._stamp, 0, ["count", "mean"], "(b==2)", None,
+                           None, None)
+        assert {"count": 0, "mean": None} == rv
+
+        with pytest.raises(omero.ApiUsageException):
+            hdf.aggregate(hdf._stamp, 0, ["median"], None, None, None, None)
+        with pytest.raises(omero.ApiUsageException):
+            hdf.aggregate(hdf._stamp, 0, ["count"], "(d==1)", None,
+                          None, None)
+        hdf.cleanup()
+
+    def testIndexes(self):
+        p = self.hdfpath()
+        hdf = HdfStorage(p, self.lock)
+        self.init(hdf, True)
+        for x in range(10):
+            self.append(hdf, {"a": x, "b": x % 3, "c": 3})
+        assert {} == hdf.get_indexes()
+
+        hdf.create_index(1, "full", 9)
+        assert {"b": ("full", 9)} == hdf.get_indexes()
+        self.append(hdf, {"a": 10, "b": 1, "c": 3})
+        rows = hdf.getWhereList(time.time(), '(b==1)', None, None,
+                                None, None, None)
+        assert [1, 4, 7, 10] == rows
+
+        data = hdf.readCoordinates(hdf._stamp, [0], self.current)
+        data.columns[1].values[0] = 1
+        hdf.update(hdf._stamp, data)
+        rows = hdf.getWhereList(time.time(), '(b==1)', None, None,
+                                None, None, None)
+        assert [0, 1, 4, 7, 10] == rows
+
+        with pytest.raises(omero.ApiUsageException):
+            hdf.create_index(0, "csi", 9)
+        hdf.cleanup()
+
+        hdf = HdfStorage(p, self.lock)
+        assert {"b": ("full", 9)} == hdf.get_indexes()
+        assert ["b"] == hdf._HdfStorage__ome.ColumnIndexes[:]
+        hdf.remove_index(1)
+        assert {} == hdf.get_indexes()
+        hdf.cleanup()
+
+    def testReadBatch(self):
+        hdf = HdfStorage(self.hdfpath(), self.lock)
+        self.init(hdf, True)
+        for x in range(5):
+            self.append(hdf, {"a": x, "b": x % 2, "c": 3})
+        assert 16 == hdf.rowsize([0, 1])
+
+        stamp = time.time()
+        data, pos = hdf.read_batch(stamp, [0], 0, 2, None, None,
+                                   self.current)
+        assert [0, 1] == data.columns[0].values
+        data, pos = hdf.read_batch(stamp, [0], pos, 2, None, None,
+                                   self.current)
+        assert [2, 3] == data.columns[0].values
+        data, pos = hdf.read_batch(stamp, [0], pos, 2, None, None,
+                                   self.current)
+        assert [4] == data.rowNumbers
+        data, pos = hdf.read_batch(stamp, [0], pos, 2, None, None,
+                                   self.current)
+        assert data is None
+
+        data, pos = hdf.read_batch(stamp, [0], 0, 2, "(b==0)", None,
+                                   self.current)
+        assert [0, 2] == data.rowNumbers
+        assert 3 == pos
+        data, pos = hdf.read_batch(stamp, [0], pos, 2, "(b==0)", None,
+                                   self.current)
+        assert [4] == data.rowNumbers
+
+        self.append(hdf, {"a": 5, "b": 1, "c": 3})
+        with pytest.raises(omero.OptimisticLockException):
+            hdf.read_batch(stamp, [0], pos, 2, None, None, self.current)
+        hdf.cleanup()
+
     def testSorting(self):  # Probably shouldn't work
         hdf = HdfStorage(self.hdfpath(), self.lock)
         self.init(hdf, True)
@@ -156,6 +320,25 @@ class TestHdfStorage(TestCase):
         # Doesn't work yet.
         hdf.cleanup()
 
+    def testCreationWithCompression(self):
+        hdf = HdfStorage(self.hdfpath(), self.lock)
+        hdf.initialize(self.cols(), None, complib="zlib", complevel=3,
+                       chunkshape=128)
+        mea = hdf._HdfStorage__mea
+        assert "zlib" == mea.filters.complib
+        assert 3 == mea.filters.complevel
+        assert (128,) == mea.chunkshape
+        m = hdf.get_meta_map()
+        assert rstring("zlib") == m["__complib"]
+        assert rint(3) == m["__complevel"]
+        assert rint(128) == m["__chunkshape"]
+        hdf.cleanup()
+
+        hdf = HdfStorage(self.hdfpath(), self.lock)
+        with pytest.raises(omero.ApiUsageException):
+            hdf.initialize(self.cols(), None, complib="unknown")
+        hdf.cleanup()
+
     def testInitializeInvalidColoumnNames(self):
         hdf = HdfStorage(self.hdfpath(), self.lock)
 
@@ -250,6 +433,49 @@ class TestHdfStorage(TestCase):
         # Doesn't work yet.
         hdf.cleanup()
 
+    def testVariableSizeStringCol(self):
+        p = self.hdfpath()
+        hdf = HdfStorage(p, self.lock)
+        cols = [omero.columns.StringColumnI(
+            "name", "description", omero.columns.VARIABLE_SIZE, None)]
+        hdf.initialize(cols)
+        cols[0].values = ["foo", "a much longer string", "foo"]
+        hdf.append(cols)
+        cols[0].values = ["bar", "foo"]
+        hdf.append(cols)
+
+        mea = hdf._HdfStorage__mea
+        assert [0, 1, 0, 2, 0] == mea.read(field="name").tolist()
+        data = hdf.read(time.time(), [0], 0, 5, self.current)
+        assert omero.columns.VARIABLE_SIZE == data.columns[0].size
+        assert ["foo", "a much longer string", "foo", "bar", "foo"] == \
+            data.columns[0].values
+
+        data = hdf.readCoordinates(time.time(), [1, 3], self.current)
+        data.columns[0].values = ["baz", "foo"]
+        hdf.update(hdf._stamp, data)
+        hdf.cleanup()
+
+        hdf = HdfStorage(p, self.lock, read_only=True)
+        data = hdf.slice(time.time(), [0], [1, 2, 3], self.current)
+        assert ["baz", "foo", "foo"] == data.columns[0].values
+        # Codes plus the mean length of the stored strings
+        assert 4 < hdf.rowsize([0])
+        # Conditions would compare the codes, not the strings
+        with pytest.raises(omero.ApiUsageException):
+            hdf.getWhereList(time.time(), '(name=="foo")', None, None,
+                             None, None, None)
+        with pytest.raises(omero.ApiUsageException):
+            hdf.aggregate(time.time(), 0, ["mean"], None, None, None, None)
+        hdf.cleanup()
+
+    def testZeroSizeStringCol(self):
+        hdf = HdfStorage(self.hdfpath(), self.lock)
+        cols = [omero.columns.StringColumnI("name", "description", 0, None)]
+        with pytest.raises(omero.ApiUsageException):
+            hdf.initialize(cols)
+        hdf.cleanup()
+
     #
     # ROIs
     #
@@ -286,6 +512,9 @@ class TestHdfStorage(TestCase):
         assert 6 == test.w[1]
         assert 7 == test.h[1]
         assert [0 == 1, 2, 3, 4], test.bytes[1]
+
+        itemsize = hdf._HdfStorage__mea.coldtypes["mask"].itemsize
+        assert itemsize + 3 == hdf.rowsize([0])
         hdf.cleanup()
 
 
@@ -347,3 +576,21 @@ class TestHdfList(TestCase):
 
         self.mox.UnsetStubs()
         self.mox.VerifyAll()
+
+    def testReadOnlyLocks(self):
+        hdflist = HdfList()
+        tmp = str(self.hdfpath())
+        hdf = hdflist.getOrCreate(tmp)
+        hdf.cleanup()
+
+        hdf = hdflist.getOrCreate(tmp, read_only=True)
+        assert hdf._lock is hdflist._lock
+        hdf.cleanup()
+
+        hdflist.threadsafe = True
+        hdf = hdflist.getOrCreate(tmp, read_only=True)
+        assert hdf._lock is not hdflist._lock
+        hdf.cleanup()
+        hdf = hdflist.getOrCreate(tmp)
+        assert hdf._lock is hdflist._lock
+        hdf.cleanup()
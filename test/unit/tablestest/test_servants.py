@@ -362,6 +362,43 @@ class TestTables(TestCase):
             assert 2.0 == data.columns[1].values[i]
         table.cleanup()
 
+    def testTableCursors(self):
+        table = self.testTableAddData(True, False)
+        cursorId = table.openCursor([0], None, None, 16, self.current)
+        data = table.nextBatch(cursorId, self.current)
+        assert [1, 1] == data.columns[0].values
+        assert [0, 1] == data.rowNumbers
+        assert [2, 3] == table.nextBatch(cursorId, self.current).rowNumbers
+        assert [4] == table.nextBatch(cursorId, self.current).rowNumbers
+        assert table.nextBatch(cursorId, self.current) is None
+        pytest.raises(omero.ApiUsageException, table.nextBatch, cursorId,
+                      self.current)
+        table.cleanup()
+
+    def testTableCursorLimit(self, monkeypatch):
+        monkeypatch.setattr(omero.tables, "MAX_CURSORS", 2)
+        table = self.testTableAddData(True, False)
+        first = table.openCursor([0], None, None, 16, self.current)
+        second = table.openCursor([0], None, None, 16, self.current)
+        table.nextBatch(first, self.current)
+        # The least recently used cursor is closed
+        third = table.openCursor([0], None, None, 16, self.current)
+        pytest.raises(omero.ApiUsageException, table.nextBatch, second,
+                      self.current)
+        table.nextBatch(first, self.current)
+        table.nextBatch(third, self.current)
+        table.cleanup()
+
+    def testTableCursorTimeout(self):
+        table = self.testTableAddData(True, False)
+        idle = table.openCursor([0], None, None, 16, self.current)
+        used = table.openCursor([0], None, None, 16, self.current)
+        table._cursors[idle].used -= omero.tables.CURSOR_TIMEOUT + 1
+        table.nextBatch(used, self.current)
+        pytest.raises(omero.ApiUsageException, table.nextBatch, idle,
+                      self.current)
+        table.cleanup()
+
     def testErrorInStorage(self):
         self.repofile(self.sf.db_uuid)
         of = omero.model.OriginalFileI(1, False)
@@ -25,10 +25,17 @@ Test of various things under omero.gateway
 """
 
 import Ice
+import numpy
 import pytest
 
-from omero.gateway import BlitzGateway, ImageWrapper
+from struct import unpack
+
+from omero.gateway import BlitzGateway, ImageWrapper, PixelsWrapper
+from omero.gateway import ProxyObjectWrapper
+from omero.gateway.utils import PixelsCache, ServiceOptsDict
 from omero.model import ImageI, PixelsI, ExperimenterI, EventI
+from omero.model import ExperimenterGroupI
+from omero.model import PixelsTypeI
 from omero.rtypes import rstring, rtime, rlong, rint
 
 
@@ -45,6 +52,12 @@ class MockConnection(object):
 
     SERVICE_OPTS = dict()
 
+    def __init__(self):
+        self.pixelsCache = None
+
+    def getPixelsCache(self):
+        return self.pixelsCache
+
     def getQueryService(self):
         return MockQueryService()
 
@@ -52,6 +65,194 @@ class MockConnection(object):
         return (64, 64)
 
 
+class MockRawPixelsStore(object):
+    """
+    Returns canned big-endian planes and tiles, as the server would.
+    """
+
+    def __init__(self, plane):
+        self.plane = plane
+        self.raw = plane.astype(plane.dtype.newbyteorder('>')).tostring()
+        self.closed = False
+        self.inflight = 0
+        self.maxInflight = 0
+        self.calls = 0
+
+    def getPlane(self, z, c, t, _ctx=None):
+        self.calls += 1
+        return self.raw
+
+    def getTile(self, z, c, t, x, y, w, h, _ctx=None):
+        self.calls += 1
+        tile = self.plane[y:y+h, x:x+w]
+        return tile.astype(tile.dtype.newbyteorder('>')).tostring()
+
+    def begin_getPlane(self, *args):
+        self.inflight += 1
+        self.maxInflight = max(self.maxInflight, self.inflight)
+        return self.getPlane(*args)
+
+    def end_getPlane(self, result):
+        self.inflight -= 1
+        return result
+
+    def begin_getTile(self, *args):
+        self.inflight += 1
+        self.maxInflight = max(self.maxInflight, self.inflight)
+        return self.getTile(*args)
+
+    def end_getTile(self, result):
+        self.inflight -= 1
+        return result
+
+    def close(self, _ctx=None):
+        self.closed = True
+
+
+class MockPixelsWrapper(PixelsWrapper):
+
+    def __init__(self, plane, pixelsType):
+        pixels = PixelsI(1L, True)
+        pixels.sizeY = rint(plane.shape[0])
+        pixels.sizeX = rint(plane.shape[1])
+        pixels.pixelsType = PixelsTypeI()
+        pixels.pixelsType.value = rstring(pixelsType)
+        pixels.details.updateEvent = EventI(1L, False)
+        super(MockPixelsWrapper, self).__init__(
+            conn=MockConnection(), obj=pixels)
+        self.store = MockRawPixelsStore(plane)
+
+    def _prepareRawPixelsStore(self):
+        return self.store
+
+
+class MockService(object):
+
+    def __init__(self, fail=0):
+        self.fail = fail
+        self.lost = 0
+
+    def getEventContext(self, _ctx=None):
+        if self.lost:
+            self.lost -= 1
+            raise Ice.ConnectionLostException()
+        if self.fail:
+            self.fail -= 1
+            raise Ice.ObjectNotExistException()
+        return "ec"
+
+    def updateSelf(self, experimenter, _ctx=None):
+        if self.lost:
+            self.lost -= 1
+            raise Ice.ConnectionLostException()
+
+
+class MockServiceFactory(object):
+
+    def __init__(self):
+        self.created = []
+        self.pings = 0
+        self.fail = 0
+
+    def getAdminService(self):
+        self.created.append(MockService(self.fail))
+        return self.created[-1]
+
+    def keepAlive(self, proxy):
+        self.pings += 1
+        return True
+
+
+class MockClient(object):
+
+    def __init__(self):
+        self.sf = MockServiceFactory()
+
+
+class MockServiceConnection(MockConnection):
+
+    def __init__(self):
+        super(MockServiceConnection, self).__init__()
+        self.c = MockClient()
+
+
+class MockUploadStore(object):
+    """
+    Records the planes and tiles written by createImageFromNumpySeq.
+    """
+
+    def __init__(self):
+        self.writes = []
+        self.inflight = 0
+        self.maxInflight = 0
+        self.closed = False
+
+    def setPixelsId(self, pixelsId, bypass, _ctx=None):
+        self.pixelsId = pixelsId
+
+    def getTileSize(self, _ctx=None):
+        return [4, 4]
+
+    def setPlane(self, buf, z, c, t, _ctx=None):
+        self.writes.append((buf, z, c, t, None))
+
+    def setTile(self, buf, z, c, t, x, y, w, h, _ctx=None):
+        self.writes.append((buf, z, c, t, (x, y, w, h)))
+
+    def begin_setPlane(self, *args, **kwargs):
+        self.inflight += 1
+        self.maxInflight = max(self.maxInflight, self.inflight)
+        return self.setPlane(*args, **kwargs)
+
+    def end_setPlane(self, result):
+        self.inflight -= 1
+
+    def begin_setTile(self, *args, **kwargs):
+        self.inflight += 1
+        self.maxInflight = max(self.maxInflight, self.inflight)
+        return self.setTile(*args, **kwargs)
+
+    def end_setTile(self, result):
+        self.inflight -= 1
+
+    def close(self, _ctx=None):
+        self.closed = True
+
+
+class MockUploadServices(object):
+    """
+    Query, Pixels, Container and Update services for creating an image.
+    """
+
+    def __init__(self):
+        self.minMax = {}
+
+    def findByQuery(self, query, params, _ctx=None):
+        return PixelsTypeI()
+
+    def createImage(self, *args):
+        return rlong(1L)
+
+    def getImages(self, type, ids, options, _ctx=None):
+        image = ImageI(1L, True)
+        image.addPixels(PixelsI(2L, True))
+        return [image]
+
+    def setChannelGlobalMinMax(self, pixelsId, c, minValue, maxValue,
+                               _ctx=None):
+        self.minMax[c] = (minValue, maxValue)
+
+
+class MockUploadClient(object):
+
+    def __init__(self):
+        self.sf = self
+        self.store = MockUploadStore()
+
+    def createRawPixelsStore(self):
+        return self.store
+
+
 @pytest.fixture(scope='function')
 def wrapped_image():
     image = ImageI()
@@ -118,3 +319,244 @@ class TestBlitzGatewayImageWrapper(object):
         data = wrapped_image.simpleMarshal(xtra={'tiled': True})
         self.assert_data(data)
         assert data['tiled'] is False
+
+    def test_rendering_key(self, wrapped_image):
+        calls = []
+
+        class MockRenderingEngine(object):
+            def getRenderingDefId(self, ctx=None):
+                calls.append("getRenderingDefId")
+                return 5L
+
+            def close(self):
+                pass
+
+        class MockRDefQueryService(object):
+            def projection(self, query, params, ctx=None):
+                calls.append("projection")
+                return [[rlong(7L)]]
+
+        image = wrapped_image
+        image._obj.details.group = ExperimenterGroupI(3L, False)
+        image._conn.SERVICE_OPTS = ServiceOptsDict()
+        image._conn.getQueryService = MockRDefQueryService
+        image._re = MockRenderingEngine()
+        assert (5L, 7L, None) == image._getRenderingKey()
+        assert (5L, 7L, None) == image._getRenderingKey()
+        assert 2 == len(calls)
+        # Unsaved changes are unique to this wrapper
+        image._onRenderingChange()
+        edited = image._getRenderingKey()
+        assert (5L, 7L) == edited[:2]
+        assert edited[2] is not None
+        image._onRenderingChange()
+        assert edited != image._getRenderingKey()
+        assert 2 == len(calls)
+        image._closeRE()
+        assert image._renderingKey is None
+        assert image._renderingEdit is None
+
+
+class TestProxyObjectWrapper(object):
+    """Liveness checking of services in `ProxyObjectWrapper`."""
+
+    def test_ping_when_idle(self):
+        conn = MockServiceConnection()
+        proxy = ProxyObjectWrapper(conn, "getAdminService")
+        for i in range(3):
+            assert "ec" == proxy.getEventContext()
+        assert 1 == len(conn.c.sf.created)
+        assert 0 == conn.c.sf.pings
+        proxy._lastUsed -= proxy.PING_INTERVAL
+        # Calls never ping, only an explicit _getObj() of an idle service
+        assert "ec" == proxy.getEventContext()
+        assert 0 == conn.c.sf.pings
+        proxy._getObj()
+        assert 1 == conn.c.sf.pings
+        proxy._getObj()
+        assert 1 == conn.c.sf.pings
+
+    def test_retry_once(self):
+        conn = MockServiceConnection()
+        proxy = ProxyObjectWrapper(conn, "getAdminService")
+        conn.c.sf.fail = 1
+        proxy._getObj()
+        conn.c.sf.fail = 0
+        assert "ec" == proxy.getEventContext()
+        assert 2 == len(conn.c.sf.created)
+        # Only retried once
+        conn.c.sf.fail = 2
+        proxy._obj = conn.c.sf.getAdminService()
+        with pytest.raises(Ice.ObjectNotExistException):
+            proxy.getEventContext()
+
+    def test_no_retry_after_connection_lost(self):
+        conn = MockServiceConnection()
+        proxy = ProxyObjectWrapper(conn, "getAdminService")
+        proxy._getObj()
+        proxy._obj.lost = 1
+        with pytest.raises(Ice.ConnectionLostException):
+            proxy.updateSelf("x")
+        assert 1 == len(conn.c.sf.created)
+        # Read-only methods are retried
+        proxy._obj.lost = 1
+        assert "ec" == proxy.getEventContext()
+        assert 2 == len(conn.c.sf.created)
+
+
+class TestCreateImageFromNumpySeq(object):
+    """Writing of planes and tiles in `createImageFromNumpySeq`."""
+
+    @pytest.fixture
+    def gateway(self, monkeypatch):
+        gateway = BlitzGateway(host='localhost', port=65535)
+        services = MockUploadServices()
+        for method in ("getQueryService", "getPixelsService",
+                       "getContainerService", "getUpdateService"):
+            monkeypatch.setattr(gateway, method, lambda: services)
+        monkeypatch.setattr(gateway, "getMaxPlaneSize", lambda: (64, 64))
+        gateway.c = MockUploadClient()
+        gateway.SERVICE_OPTS = dict()
+        gateway.services = services
+        return gateway
+
+    def decode(self, buf, shape, dtype):
+        be = numpy.dtype(dtype).newbyteorder('>')
+        return numpy.frombuffer(buf, dtype=be).reshape(shape)
+
+    @pytest.mark.parametrize("pipeline", [0, 1, 4])
+    @pytest.mark.parametrize("blockSize", [16, 40, 1024])
+    def test_planes(self, gateway, monkeypatch, pipeline, blockSize):
+        monkeypatch.setattr(
+            "omero.gateway.CONVERT_BLOCK_SIZE", blockSize)
+        planes = [numpy.arange(48, dtype=numpy.uint16).reshape(6, 8) * i
+                  for i in range(1, 7)]
+        planes[4][5, 7] = 1000
+        gateway.createImageFromNumpySeq(
+            iter(planes), "test", sizeZ=1, sizeC=2, sizeT=3,
+            pipeline=pipeline)
+        store = gateway.c.store
+        assert store.closed
+        assert min(pipeline, len(planes)) == store.maxInflight
+        assert 0 == store.inflight
+        zct = [(0, c, t) for c in range(2) for t in range(3)]
+        for plane, pos, write in zip(planes, zct, store.writes):
+            assert pos == write[1:4]
+            assert (plane == self.decode(
+                write[0], plane.shape, numpy.uint16)).all()
+        assert gateway.services.minMax == {0: (0, 47 * 3), 1: (0, 1000)}
+
+    def test_planes_error(self, gateway):
+        """Calls in flight are completed when a plane fails"""
+        def planes():
+            for i in range(3):
+                yield numpy.zeros((6, 8), dtype=numpy.uint16)
+            raise ValueError("bad plane")
+
+        with pytest.raises(ValueError):
+            gateway.createImageFromNumpySeq(
+                planes(), "test", sizeT=6, pipeline=4)
+        store = gateway.c.store
+        assert 3 == store.maxInflight
+        assert 0 == store.inflight
+        assert store.closed
+
+    def test_tiles(self, gateway, monkeypatch):
+        monkeypatch.setattr(gateway, "getMaxPlaneSize", lambda: (4, 4))
+        plane = numpy.arange(48, dtype=numpy.float32).reshape(6, 8)
+        gateway.createImageFromNumpySeq(iter([plane]), "test")
+        writes = gateway.c.store.writes
+        assert [w[4] for w in writes] == [
+            (0, 0, 4, 4), (4, 0, 4, 4), (0, 4, 4, 2), (4, 4, 4, 2)]
+        for buf, z, c, t, (x, y, w, h) in writes:
+            assert (plane[y:y+h, x:x+w] == self.decode(
+                buf, (h, w), numpy.float32)).all()
+
+
+class TestPixelsWrapperGetTiles(object):
+    """Decoding of raw planes and tiles in `PixelsWrapper.getTiles`."""
+
+    @pytest.mark.parametrize("pixelsType, dtype", [
+        ("int8", numpy.int8), ("uint8", numpy.uint8),
+        ("int16", numpy.int16), ("uint16", numpy.uint16),
+        ("int32", numpy.int32), ("uint32", numpy.uint32),
+        ("float", numpy.float32), ("double", numpy.float64)])
+    def test_decode(self, pixelsType, dtype):
+        plane = (numpy.arange(48) - 24).astype(dtype).reshape(6, 8)
+        pixels = MockPixelsWrapper(plane, pixelsType)
+        rv = pixels.getPlane()
+        assert rv.dtype == numpy.dtype(dtype)
+        assert rv.dtype.isnative
+        assert (rv == plane).all()
+        rv[0, 0] = 1  # Writable
+        tile = pixels.getTile(tile=(2, 1, 3, 4))
+        assert (tile == plane[1:5, 2:5]).all()
+        assert pixels.store.closed
+
+    @pytest.mark.parametrize("prefetch", [1, 3, 10])
+    def test_prefetch(self, prefetch):
+        plane = numpy.arange(64, dtype=numpy.uint16).reshape(8, 8)
+        pixels = MockPixelsWrapper(plane, "uint16")
+        tiles = [(0, 0, 0, (x, y, 2, 2))
+                 for y in range(0, 8, 2) for x in range(0, 8, 2)]
+        rv = list(pixels.getTiles(tiles, prefetch=prefetch))
+        assert len(tiles) == len(rv)
+        for (z, c, t, (x, y, w, h)), tile in zip(tiles, rv):
+            assert (tile == plane[y:y+h, x:x+w]).all()
+        assert min(prefetch, len(tiles)) == pixels.store.maxInflight
+        assert 0 == pixels.store.inflight
+
+    @pytest.mark.parametrize("prefetch", [0, 2])
+    def test_cache(self, prefetch):
+        plane = numpy.arange(64, dtype=numpy.uint16).reshape(8, 8)
+        pixels = MockPixelsWrapper(plane, "uint16")
+        cache = PixelsCache()
+        pixels._conn.pixelsCache = cache
+        tiles = [(0, 0, 0, (x, 0, 2, 2)) for x in range(0, 8, 2)]
+        list(pixels.getTiles(tiles[:2], prefetch=prefetch))
+        assert 2 == pixels.store.calls
+        rv = list(pixels.getTiles(tiles, prefetch=prefetch))
+        assert 4 == pixels.store.calls
+        for (z, c, t, (x, y, w, h)), tile in zip(tiles, rv):
+            assert (tile == plane[y:y+h, x:x+w]).all()
+        stats = cache.getStats()
+        assert 2 == stats["hits"]
+        assert 4 == stats["misses"]
+        # Callers get a copy
+        rv[0][0, 0] = 99
+        assert 0 == pixels.getTile(tile=(0, 0, 2, 2))[0, 0]
+        # Modified pixels are fetched again
+        pixels._obj.details.updateEvent = EventI(2L, False)
+        pixels.getTile(tile=(0, 0, 2, 2))
+        assert 5 == pixels.store.calls
+
+    @pytest.mark.parametrize("prefetch", [1, 2, 4])
+    def test_cache_prefetch(self, prefetch):
+        """Cached tiles queued behind a request count towards prefetch"""
+        plane = numpy.arange(64, dtype=numpy.uint16).reshape(8, 8)
+        pixels = MockPixelsWrapper(plane, "uint16")
+        cache = PixelsCache()
+        pixels._conn.pixelsCache = cache
+        tiles = [(0, 0, 0, (x, y, 2, 2))
+                 for y in range(0, 8, 2) for x in range(0, 8, 2)]
+        list(pixels.getTiles(tiles[1:]))
+        hits = cache.hits
+        rv = pixels.getTiles(tiles, prefetch=prefetch)
+        assert (rv.next() == plane[0:2, 0:2]).all()
+        # No more than prefetch cached tiles are queued behind the request
+        assert prefetch == cache.hits - hits
+        rv = list(rv)
+        assert len(tiles) - 1 == len(rv)
+        for (z, c, t, (x, y, w, h)), tile in zip(tiles[1:], rv):
+            assert (tile == plane[y:y+h, x:x+w]).all()
+        assert 0 == pixels.store.inflight
+
+    def test_unpack(self):
+        """Decoding matches the previous struct.unpack decoding"""
+        plane = numpy.random.randint(0, 65535, (16, 16)).astype(
+            numpy.uint16)
+        pixels = MockPixelsWrapper(plane, "uint16")
+        old = numpy.array(unpack('>%dH' % plane.size, pixels.store.raw),
+                          numpy.uint16)
+        old.resize(plane.shape)
+        assert (old == pixels.getPlane()).all()
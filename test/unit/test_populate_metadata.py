@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment.
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Test of the populate_metadata resolution index
+"""
+
+
+import pytest
+
+from omero.util.populate_metadata import (
+    MetadataError, SPWIndex, SPWWrapper, ValueResolver)
+
+
+PLATES = [(1L, 'P1'), (2L, 'P2')]
+ROWS = [
+    # plate, well, row, column, image, image name
+    (1L, 10L, 0, 0, 100L, 'a1-0'),
+    (1L, 10L, 0, 0, 101L, 'a1-1'),
+    (1L, 11L, 0, 1, 102L, 'a2-0'),
+    (2L, 20L, 1, 0, 200L, 'b1-0'),
+]
+
+
+class MockWrapper(SPWWrapper):
+
+    def __init__(self, plates=PLATES, rows=ROWS):
+        self.AS_ALPHA = ValueResolver.AS_ALPHA
+        self.WELL_REGEX = ValueResolver.WELL_REGEX
+        self.index = SPWIndex(plates, rows, self.AS_ALPHA)
+
+
+class TestSPWIndex(object):
+
+    def test_well_names(self):
+        index = SPWIndex(PLATES, ROWS, ValueResolver.AS_ALPHA)
+        assert ['a2', 'a1', None, 'b1'] == index.get_well_names(
+            [11, 10, 99, 20])
+
+    def test_images(self):
+        index = SPWIndex(PLATES, ROWS, ValueResolver.AS_ALPHA)
+        assert [100, None, 200] == index.find_images([100, 103, 200])
+        assert [100, None, None] == index.find_images(
+            [100, 200, 102], [1, 1, None])
+        assert ['a2-0', None] == index.get_image_names([102, 1])
+
+    def test_empty(self):
+        index = SPWIndex([], [], ValueResolver.AS_ALPHA)
+        assert [None, None] == index.get_well_names([1, 2])
+        assert [None] == index.find_images([1])
+
+
+class TestSPWWrapper(object):
+
+    def test_resolve_wells(self):
+        wrapper = MockWrapper()
+        assert [10, 11, 20, -1, -1] == wrapper.resolve_wells(
+            ['A1', 'a2', 'B1', 'A1', 'Z9'], ['P1', 'P1', 'P2', 'P2', 'P1'])
+
+    def test_resolve_wells_single_plate(self):
+        wrapper = MockWrapper(PLATES[:1], ROWS[:3])
+        assert [11, 10, 11] == wrapper.resolve_wells(['A2', 'A1', 'A2'])
+
+    def test_resolve_wells_needs_plate(self):
+        wrapper = MockWrapper()
+        with pytest.raises(MetadataError):
+            wrapper.resolve_wells(['A1'])
+
+    def test_bad_well(self):
+        wrapper = MockWrapper()
+        with pytest.raises(MetadataError):
+            wrapper.resolve_wells(['1A'], ['P1'])
+
+    def test_resolve_images(self):
+        wrapper = MockWrapper()
+        assert [101, -1, 200, -1] == wrapper.resolve_images(
+            ['101', '7', '200', '200'], ['P1', 'P1', 'P2', 'P1'])
+
+    def test_resolve_images_single_plate(self):
+        wrapper = MockWrapper(PLATES[:1], ROWS[:3])
+        assert [101, -1] == wrapper.resolve_images(['101', '7'])
+
+    def test_resolve_images_needs_plate(self):
+        wrapper = MockWrapper()
+        with pytest.raises(MetadataError):
+            wrapper.resolve_images(['101'])
+
+    def test_name_widths(self):
+        widths = MockWrapper().get_name_widths()
+        assert 2 == widths['Well Name']
+        assert 4 == widths['Image Name']
+        assert 2 == widths['Plate Name']